@@ -0,0 +1,244 @@
+'''
+    Static assets
+
+    -------------
+
+    Fingerprinted, precompressed static files with far-future caching.
+
+    ``flask assets build`` copies every file under the static folder to
+    ``ASSETS_BUILD_DIR`` with a content hash in its name, e.g.
+    ``css/styles.3f2a9c1e0b7d4a55.css``, next to gzip and brotli versions of
+    the text formats, and writes a manifest mapping the original names to
+    the hashed ones. Templates link files with ``asset_url(filename)``,
+    which resolves through the manifest and falls back to the plain static
+    URL for files the last build didn't see, such as new uploads.
+
+    A hashed name never changes content, so it is served with a one-year
+    ``immutable`` Cache-Control: browsers stop revalidating it altogether.
+    The best encoding the client accepts is picked from the precompressed
+    files, with ``Vary: Accept-Encoding``. ETags, conditional and range
+    requests are handled by ``send_file``.
+
+'''
+
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import shutil
+import tempfile
+import time
+
+import click
+from flask import abort, request, url_for
+from flask.cli import AppGroup
+from werkzeug.exceptions import NotFound
+from werkzeug.security import safe_join
+from werkzeug.utils import send_file
+from werkzeug.wrappers import Request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+ONE_YEAR = 365 * 24 * 60 * 60
+
+COMPRESSIBLE = ("text/", "application/javascript", "application/json", "image/svg+xml")
+
+# Leading bytes of the image formats uploads can have, for files without an extension
+SIGNATURES = [
+    (b"\xff\xd8\xff", ".jpg"),
+    (b"\x89PNG\r\n\x1a\n", ".png"),
+    (b"GIF87a", ".gif"),
+    (b"GIF89a", ".gif"),
+]
+
+
+def sniff_extension(path):
+    with open(path, "rb") as source:
+        head = source.read(12)
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return ".webp"
+    for signature, extension in SIGNATURES:
+        if head.startswith(signature):
+            return extension
+    return ""
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as source:
+        for block in iter(lambda: source.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()[:16]
+
+
+def _write_atomic(path, data):
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    handle, temporary = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(handle, "wb") as output:
+            output.write(data)
+        os.replace(temporary, path)
+    except BaseException:
+        os.unlink(temporary)
+        raise
+
+
+class Assets(object):
+    '''Builds and serves fingerprinted copies of the static folder.
+
+    To initialize, pass your flask app's object::
+
+        assets = Assets(app)
+
+    Config variables read from the app:
+
+        ASSETS_BUILD_DIR = "<instance>/assets"    # hashed files and manifest.json
+
+    '''
+
+    encodings = (("br", ".br"), ("gzip", ".gz"))
+
+    def __init__(self, app=None):
+        self.manifest = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.static_folder = app.static_folder
+        self.build_dir = app.config.get('ASSETS_BUILD_DIR', os.path.join(app.instance_path, "assets"))
+        self.manifest_path = os.path.join(self.build_dir, "manifest.json")
+        self.load()
+        self.url_path = "/assets/"
+        # The route builds asset URLs; requests are answered by the middleware
+        app.add_url_rule(self.url_path + "<path:filename>", "assets", self.serve)
+        app.wsgi_app = self.wsgi_middleware(app.wsgi_app)
+        app.add_template_global(self.url, "asset_url")
+        app.cli.add_command(self._cli())
+        app.extensions['assets'] = self
+
+    def load(self):
+        try:
+            with open(self.manifest_path) as manifest:
+                self.manifest = json.load(manifest)
+        except (OSError, ValueError):
+            self.manifest = {}
+
+    def url(self, filename):
+        '''The URL of a static file: its hashed copy if built, the plain static URL otherwise.'''
+        entry = self.manifest.get(filename)
+        if entry is None:
+            return url_for('static', filename=filename)
+        return url_for('assets', filename=entry["path"])
+
+    def build(self):
+        '''Fingerprints and compresses every static file; returns the number of files.
+
+        Hashed names are content-addressed, so files already built are skipped
+        and earlier builds stay servable to pages that still link them.
+        '''
+        manifest = {}
+        for directory, _subdirectories, files in os.walk(self.static_folder):
+            for name in files:
+                source = os.path.join(directory, name)
+                logical = os.path.relpath(source, self.static_folder).replace(os.sep, "/")
+                manifest[logical] = self._build_file(source, logical)
+        _write_atomic(self.manifest_path, json.dumps(manifest, indent=1, sort_keys=True).encode("utf-8"))
+        self.manifest = manifest
+        return len(manifest)
+
+    def _build_file(self, source, logical):
+        digest = file_hash(source)
+        stem, extension = os.path.splitext(logical)
+        if not extension:
+            extension = sniff_extension(source)
+        path = "%s.%s%s" % (stem, digest, extension)
+        mimetype = mimetypes.guess_type("file" + extension)[0] or "application/octet-stream"
+        target = os.path.join(self.build_dir, path)
+        if not os.path.exists(target):
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.copyfile(source, target + ".tmp")
+            os.replace(target + ".tmp", target)
+        encodings = []
+        if mimetype.startswith(COMPRESSIBLE):
+            with open(source, "rb") as original:
+                data = original.read()
+            for encoding, suffix in self.encodings:
+                if not os.path.exists(target + suffix):
+                    compressed = self._compress(encoding, data)
+                    # Not worth a variant if it barely shrinks
+                    if compressed is None or len(compressed) > len(data) * 0.9:
+                        continue
+                    _write_atomic(target + suffix, compressed)
+                encodings.append(encoding)
+        return {"path": path, "type": mimetype, "hash": digest, "encodings": encodings}
+
+    @staticmethod
+    def _compress(encoding, data):
+        if encoding == "gzip":
+            return gzip.compress(data, compresslevel=9, mtime=0)
+        if encoding == "br" and brotli is not None:
+            return brotli.compress(data, quality=11)
+        return None
+
+    def response(self, environ, filename):
+        '''Returns the response for a hashed file, or None if there is no such file.'''
+        path = safe_join(self.build_dir, filename)
+        stem, extension = os.path.splitext(filename)
+        # Compressed variants are only served through content negotiation
+        if path is None or filename == "manifest.json" or extension in (".br", ".gz") or not os.path.isfile(path):
+            return None
+        mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        etag = os.path.splitext(stem)[1].lstrip(".") or None
+
+        encoding = None
+        if mimetype.startswith(COMPRESSIBLE):
+            accept_encodings = Request(environ).accept_encodings
+            for candidate, suffix in self.encodings:
+                if accept_encodings[candidate] > 0 and os.path.isfile(path + suffix):
+                    encoding, path = candidate, path + suffix
+                    break
+
+        response = send_file(path, environ, mimetype=mimetype,
+                             etag=etag and "%s-%s" % (etag, encoding or "identity"),
+                             conditional=True, max_age=ONE_YEAR)
+        if encoding is not None:
+            response.headers['Content-Encoding'] = encoding
+        if mimetype.startswith(COMPRESSIBLE):
+            response.vary.add("Accept-Encoding")
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        return response
+
+    def wsgi_middleware(self, wsgi_app):
+        # Answer asset requests before Flask, so no session, login or Vary: Cookie is involved
+        def middleware(environ, start_response):
+            path = environ.get("PATH_INFO", "")
+            if path.startswith(self.url_path):
+                response = self.response(environ, path[len(self.url_path):]) or NotFound()
+                return response(environ, start_response)
+            return wsgi_app(environ, start_response)
+        return middleware
+
+    def serve(self, filename):
+        response = self.response(request.environ, filename)
+        if response is None:
+            abort(404)
+        return response
+
+    def _cli(self):
+        group = AppGroup("assets", help="Build fingerprinted static assets.")
+
+        @group.command("build")
+        def build():
+            '''Hash, copy and precompress the static folder into ASSETS_BUILD_DIR.'''
+            start = time.perf_counter()
+            count = self.build()
+            click.echo("Built %d assets into %s in %.2fs" % (count, self.build_dir, time.perf_counter() - start))
+
+        return group
@@ -0,0 +1,317 @@
+'''
+    Async serving
+
+    -------------
+
+    An ASGI entry point where the I/O-bound routes run as coroutines.
+
+    Under a WSGI server every request holds a thread until it is answered,
+    waits on the database, Stripe or wkhtmltopdf included, so a process
+    serves as many requests at once as it has threads. Served by an ASGI
+    server instead::
+
+        uvicorn --factory main:create_asgi_app
+
+    the endpoints that have an ``async def`` view registered with
+    ``@async_views.view(endpoint)`` are dispatched on the event loop, where a
+    request waiting on a query, an HTTP call or a subprocess is a suspended
+    coroutine rather than a blocked thread. Their database access goes
+    through an async SQLAlchemy engine on the app's database, e.g.
+    ``sqlite+aiosqlite``. Every other route is served by its usual view
+    through the WSGI app, on a bounded thread pool, so nothing has to be
+    ported to keep working.
+
+    The async views get the same request handling as the sync ones: Flask's
+    request context, session, before/after request hooks, error handlers and
+    teardown, with only the view itself awaited. URLs are matched against
+    the app's url_map, so ``url_for`` is unchanged, and the sync views go on
+    serving the app under WSGI and in the test client.
+
+    Needs an ASGI server, ``greenlet`` for SQLAlchemy's asyncio extension and
+    the database's async driver, e.g. ``aiosqlite``. SQLite takes one writer
+    at a time, and a coroutine keeps the write lock across the awaits of its
+    transaction, so with many concurrent writes a writer can wait out the
+    busy timeout; use a server database for write-heavy async serving.
+
+'''
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import io
+import sys
+
+from flask import request
+from flask.signals import request_started
+from sqlalchemy.engine import make_url
+from werkzeug.exceptions import HTTPException
+from werkzeug.routing import RequestRedirect
+
+from db_profile import engine_options
+
+
+# The asyncio driver used for each database backend
+ASYNC_DRIVERS = {"sqlite": "aiosqlite", "postgresql": "asyncpg", "mysql": "aiomysql"}
+
+
+def async_url(url):
+    '''Returns ``url`` with its backend's async driver, e.g. ``sqlite:///x.db`` -> ``sqlite+aiosqlite:///x.db``.'''
+    url = make_url(url)
+    backend = url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError("No async driver known for %s databases; set ASYNC_DATABASE_URL" % backend)
+    return url.set(drivername="%s+%s" % (backend, ASYNC_DRIVERS[backend]))
+
+
+def build_environ(scope, body):
+    '''Returns the WSGI environ for an ASGI HTTP ``scope`` whose request body is ``body``.'''
+    script_name = scope.get("root_path", "")
+    path = scope["path"]
+    if script_name and path.startswith(script_name):
+        path = path[len(script_name):]
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client")
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": script_name.encode("utf-8").decode("latin-1"),
+        "PATH_INFO": path.encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("ascii"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1] or 80),
+        "SERVER_PROTOCOL": "HTTP/%s" % scope.get("http_version", "1.1"),
+        "REMOTE_ADDR": client[0] if client else "",
+        "REMOTE_PORT": str(client[1]) if client else "",
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope.get("headers", ()):
+        name = name.decode("latin-1")
+        if name == "content-length":
+            key = "CONTENT_LENGTH"
+        elif name == "content-type":
+            key = "CONTENT_TYPE"
+        else:
+            key = "HTTP_" + name.upper().replace("-", "_")
+        value = value.decode("latin-1")
+        # Repeated headers are joined, as a WSGI server does
+        environ[key] = environ[key] + "," + value if key in environ else value
+    return environ
+
+
+def start_message(status, headers):
+    return {"type": "http.response.start", "status": int(str(status).split(" ", 1)[0]),
+            "headers": [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers]}
+
+
+class AsyncServing(object):
+    '''Serves the app over ASGI, running the endpoints that have an async view on the event loop.
+
+    To initialize, create it before the views so they can register, then pass your flask app's object::
+
+        async_views = AsyncServing()
+
+        @async_views.view("show_product")
+        async def show_product(id):
+            async with async_views.session() as session:
+                product = await session.get(Product, id)
+            ...
+
+        async_views.init_app(app)
+
+    The ASGI application is the extension itself, ``app.extensions['async_serving']``.
+    Coroutines registered with ``@async_views.before_request`` run before every
+    async view, after the app's own before_request functions.
+
+    Config variables read from the app:
+
+        ASYNC_DATABASE_URL = None      # defaults to the app's database with its async driver
+        ASYNC_WSGI_THREADS = 32        # threads serving the routes that have no async view
+
+    '''
+
+    def __init__(self, app=None):
+        self.views = {}
+        self.before_request_funcs = []
+        self.app = None
+        self._engine = None
+        self._sessionmaker = None
+        self._executor = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.database_url = app.config.get('ASYNC_DATABASE_URL')
+        self.wsgi_threads = app.config.get('ASYNC_WSGI_THREADS', 32)
+        self._executor = ThreadPoolExecutor(max_workers=self.wsgi_threads, thread_name_prefix="wsgi")
+        app.extensions['async_serving'] = self
+
+    def view(self, endpoint):
+        '''Registers an ``async def`` view for ``endpoint``, used in place of the sync one when served over ASGI.'''
+        def decorator(view):
+            self.views[endpoint] = view
+            return view
+        return decorator
+
+    def before_request(self, func):
+        self.before_request_funcs.append(func)
+        return func
+
+    @property
+    def engine(self):
+        '''The AsyncEngine, created on first use so it belongs to the server's event loop.'''
+        if self._engine is None:
+            from sqlalchemy.ext.asyncio import create_async_engine
+
+            url = self.database_url
+            if url is None:
+                # The engine's URL, with relative SQLite paths already resolved against the instance folder
+                with self.app.app_context():
+                    url = async_url(self.app.extensions['sqlalchemy'].engine.url)
+            self._engine = create_async_engine(url, **engine_options(url, self.app.config))
+            profile = self.app.extensions.get('database_profile')
+            if profile is not None:
+                profile.watch(self._engine.sync_engine)
+        return self._engine
+
+    def session(self):
+        '''Returns a new AsyncSession; use it as ``async with async_views.session() as session:``.'''
+        if self._sessionmaker is None:
+            from sqlalchemy.ext.asyncio import async_sessionmaker
+
+            self._sessionmaker = async_sessionmaker(self.engine, expire_on_commit=False)
+        return self._sessionmaker()
+
+    async def close(self):
+        if self._engine is not None:
+            await self._engine.dispose()
+        self._executor.shutdown(wait=False)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self._lifespan(receive, send)
+        if scope["type"] != "http":
+            raise ValueError("Unsupported ASGI scope type %r" % scope["type"])
+        environ = build_environ(scope, await self._read_body(receive))
+        view = self._match(environ)
+        if view is None:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(self._executor, self._run_wsgi, environ, send, loop)
+            return
+        status, headers, body = await self._dispatch(view, environ)
+        await send(start_message(status, headers))
+        await send({"type": "http.response.body", "body": body})
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.close()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    @staticmethod
+    async def _read_body(receive):
+        chunks = []
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                break
+            chunks.append(message.get("body", b""))
+            if not message.get("more_body"):
+                break
+        return b"".join(chunks)
+
+    def _match(self, environ):
+        '''Returns the async view for the request's endpoint, or None to serve it through WSGI.'''
+        if not self.views:
+            return None
+        try:
+            endpoint, _arguments = self.app.url_map.bind_to_environ(environ).match()
+        except (HTTPException, RequestRedirect):
+            # Not found, wrong method or a redirect: the WSGI app answers those
+            return None
+        return self.views.get(endpoint)
+
+    async def _dispatch(self, view, environ):
+        '''Flask's wsgi_app() and full_dispatch_request(), awaiting the view.
+
+        Flask keeps its contexts in context variables, so each request's task sees only its own.
+        '''
+        app = self.app
+        ctx = app.request_context(environ)
+        error = None
+        try:
+            try:
+                ctx.push()
+                response = await self._full_dispatch(view)
+            except Exception as e:
+                error = e
+                response = app.handle_exception(e)
+            except:  # noqa: E722
+                error = sys.exc_info()[1]
+                raise
+            app_iter, status, headers = response.get_wsgi_response(environ)
+            try:
+                body = b"".join(app_iter)
+            finally:
+                if hasattr(app_iter, "close"):
+                    app_iter.close()
+            return status, headers, body
+        finally:
+            if error is not None and app.should_ignore_error(error):
+                error = None
+            ctx.pop(error)
+
+    async def _full_dispatch(self, view):
+        app = self.app
+        app._got_first_request = True
+        try:
+            request_started.send(app, _async_wrapper=app.ensure_sync)
+            rv = app.preprocess_request()
+            for func in self.before_request_funcs:
+                if rv is not None:
+                    break
+                rv = await func()
+            if rv is None:
+                rv = await view(**request.view_args)
+        except Exception as e:
+            rv = app.handle_user_exception(e)
+        return app.finalize_request(rv)
+
+    def _run_wsgi(self, environ, send, loop):
+        '''Runs the WSGI app on a pool thread, streaming its response back through the event loop.'''
+        started = []
+        sent = []
+
+        def send_now(message):
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and sent:
+                raise exc_info[1].with_traceback(exc_info[2])
+            started[:] = [status, headers]
+            return write
+
+        def write(data):
+            if not sent:
+                send_now(start_message(*started))
+                sent.append(True)
+            if data:
+                send_now({"type": "http.response.body", "body": data, "more_body": True})
+
+        iterable = self.app(environ, start_response)
+        try:
+            for data in iterable:
+                write(data)
+        finally:
+            if hasattr(iterable, "close"):
+                iterable.close()
+        write(b"")
+        send_now({"type": "http.response.body", "body": b""})
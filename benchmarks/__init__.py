@@ -0,0 +1,28 @@
+'''
+    Benchmarks
+
+    ----------
+
+    Standalone benchmark scripts for the shop's hot paths. Run one with::
+
+        python -m benchmarks.totals
+        python -m benchmarks.search
+        python -m benchmarks.suggest
+        python -m benchmarks.query_plans
+        python -m benchmarks.checkout
+        python -m benchmarks.login
+        python -m benchmarks.reservations
+        python -m benchmarks.startup
+
+    ``benchmarks.routes`` seeds a throwaway shop with ``benchmarks.seed``,
+    drives the storefront and checkout routes and compares the result with
+    ``benchmarks/baseline.json``::
+
+        python -m benchmarks.routes --baseline benchmarks/baseline.json
+
+    ``benchmarks.concurrency`` compares how many concurrent requests one
+    process serves under the sync WSGI setup and the ASGI async views::
+
+        python -m benchmarks.concurrency
+
+'''
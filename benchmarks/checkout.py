@@ -0,0 +1,121 @@
+'''Concurrent checkout throughput on SQLite, default engine vs. the tuned profile.
+
+    python -m benchmarks.checkout [--workers 8] [--checkouts 200] [--profile both]
+
+Each worker process places orders the way get_order does: read the cart's
+products, insert the order and its lines, decrement stock, commit. It
+browses a product listing between checkouts, so readers and writers
+contend as they do on a busy shop. Reports checkouts per second and the
+transactions that failed with "database is locked".
+'''
+
+import argparse
+import multiprocessing
+import os
+import random
+import secrets
+import tempfile
+import time
+
+from sqlalchemy import (Column, ForeignKey, Integer, MetaData, String, Table, create_engine, event, insert,
+                        select, update)
+from sqlalchemy.exc import OperationalError
+
+from db_profile import SQLITE_PRAGMAS, apply_pragmas, engine_options
+
+
+metadata = MetaData()
+products = Table("products", metadata,
+                 Column("id", Integer, primary_key=True),
+                 Column("product_name", String(250), nullable=False),
+                 Column("price", Integer, nullable=False),
+                 Column("stock", Integer, nullable=False))
+orders = Table("customer_order", metadata,
+               Column("id", Integer, primary_key=True),
+               Column("invoice", String(100), nullable=False, unique=True),
+               Column("customer_id", Integer, nullable=False))
+order_items = Table("order_items", metadata,
+                    Column("id", Integer, primary_key=True),
+                    Column("order_id", Integer, ForeignKey("customer_order.id"), nullable=False, index=True),
+                    Column("product_id", Integer, nullable=False),
+                    Column("unit_price_cents", Integer, nullable=False),
+                    Column("quantity", Integer, nullable=False))
+
+PRODUCTS = 500
+
+
+def make_engine(url, profile):
+    if profile == "default":
+        return create_engine(url)
+    engine = create_engine(url, **engine_options(url, {}))
+    event.listen(engine, "connect", lambda connection, record: apply_pragmas(connection, SQLITE_PRAGMAS))
+    return engine
+
+
+def worker(url, profile, checkouts, seed, results):
+    engine = make_engine(url, profile)
+    rng = random.Random(seed)
+    done = locked = 0
+    for _ in range(checkouts):
+        with engine.connect() as conn:
+            conn.execute(select(products).where(products.c.stock > 0).order_by(products.c.id.desc()).limit(8)).all()
+        cart = {rng.randint(1, PRODUCTS): rng.randint(1, 3) for _ in range(rng.randint(1, 4))}
+        try:
+            with engine.begin() as conn:
+                prices = dict(conn.execute(
+                    select(products.c.id, products.c.price).where(products.c.id.in_(list(cart)))).all())
+                order_id = conn.execute(insert(orders).values(
+                    invoice=secrets.token_hex(8), customer_id=seed)).inserted_primary_key[0]
+                conn.execute(insert(order_items), [
+                    {"order_id": order_id, "product_id": product_id, "unit_price_cents": prices[product_id] * 100,
+                     "quantity": quantity} for product_id, quantity in cart.items()])
+                for product_id, quantity in cart.items():
+                    conn.execute(update(products).where(products.c.id == product_id)
+                                 .values(stock=products.c.stock - quantity))
+            done += 1
+        except OperationalError as error:
+            if "locked" not in str(error):
+                raise
+            locked += 1
+    engine.dispose()
+    results.put((done, locked))
+
+
+def run(profile, workers, checkouts):
+    directory = tempfile.mkdtemp()
+    url = "sqlite:///" + os.path.join(directory, "bench.db")
+    engine = make_engine(url, profile)
+    metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(insert(products), [{"product_name": "Product %d" % i, "price": 100 + i, "stock": 10 ** 6}
+                                        for i in range(1, PRODUCTS + 1)])
+    engine.dispose()
+
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=worker, args=(url, profile, checkouts, seed, results))
+                 for seed in range(workers)]
+    start = time.perf_counter()
+    for process in processes:
+        process.start()
+    totals = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    elapsed = time.perf_counter() - start
+    done = sum(result[0] for result in totals)
+    locked = sum(result[1] for result in totals)
+    print("%-8s workers=%d checkouts=%d in %.2fs  %.0f checkouts/s  locked=%d" % (
+        profile, workers, done, elapsed, done / elapsed, locked))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--checkouts", type=int, default=200, help="per worker")
+    parser.add_argument("--profile", choices=("default", "tuned", "both"), default="both")
+    args = parser.parse_args(argv)
+    for profile in ("default", "tuned") if args.profile == "both" else (args.profile,):
+        run(profile, args.workers, args.checkouts)
+
+
+if __name__ == "__main__":
+    main()
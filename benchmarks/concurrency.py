@@ -0,0 +1,396 @@
+'''Concurrent I/O-bound requests per process: sync WSGI threads vs. the async views over ASGI.
+
+    python -m benchmarks.concurrency [--clients 10,50,200] [--operations 200] [--threads 8]
+                                     [--flows product,pdf,payment] [--stripe-latency 0.2] [--pdf-seconds 0.3]
+                                     [--output report.json]
+
+Seeds a throwaway shop, then serves it from a single process, first as a
+WSGI server answering on ``--threads`` threads, like one gthread worker,
+then under uvicorn with the async views (main.create_asgi_app). For each
+number of concurrent clients, ``--operations`` of each flow are run
+against it:
+
+    product    a logged-in customer opens a product page, which the page cache doesn't serve
+    pdf        ask for an order's invoice and wait until it can be downloaded
+    payment    pay a pending order and poll until the charge has gone through
+
+Stripe is stripe_stub.py, answering after ``--stripe-latency`` seconds,
+and wkhtmltopdf a shell script that reads the HTML, sleeps
+``--pdf-seconds`` and prints a small PDF, so the waits are real network
+and process waits. Both servers get the same worker settings:
+``--pdf-workers`` concurrent renders and ``--payment-workers`` charge
+threads, which the async charges don't use. Reports operations per
+second, p50/p95 time per operation, HTTP requests per operation, errors
+and the server's peak thread count; each server's output is logged next
+to its database. Needs httpx and uvicorn.
+'''
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+
+FLOWS = ("product", "pdf", "payment")
+
+# Seconds between status polls, as templates/order.html waits
+PDF_POLL = 0.5
+PAYMENT_POLL = 1.0
+
+# Applied to the app in both servers; the benchmark posts forms without CSRF tokens
+CONFIG = {'WTF_CSRF_ENABLED': False}
+
+WKHTMLTOPDF_STUB = '''#!/bin/sh
+cat > /dev/null
+sleep %s
+printf '%%%%PDF-1.4\\n%%%%%%%%EOF\\n'
+'''
+
+
+def percentile(ordered, fraction):
+    '''Nearest-rank percentile of an already sorted list.'''
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, max(0, int(round(fraction * len(ordered) + 0.5)) - 1))]
+
+
+def wsgi_app():
+    import main
+    return main.create_app(CONFIG)
+
+
+def asgi_app():
+    import main
+    return main.create_asgi_app(CONFIG)
+
+
+def serve_sync(port, threads):
+    '''Runs the WSGI app with a fixed pool of request threads until killed.'''
+    from concurrent.futures import ThreadPoolExecutor
+    from werkzeug.serving import BaseWSGIServer
+
+    class PooledWSGIServer(BaseWSGIServer):
+        request_queue_size = 2048
+
+        def __init__(self, host, port, app):
+            super().__init__(host, port, app)
+            self.pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="request")
+
+        def process_request(self, request, client_address):
+            self.pool.submit(self._handle, request, client_address)
+
+        def _handle(self, request, client_address):
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    PooledWSGIServer("127.0.0.1", port, wsgi_app()).serve_forever()
+
+
+def serve_async(port):
+    '''Runs the app under uvicorn until killed.'''
+    import uvicorn
+
+    uvicorn.run(asgi_app(), host="127.0.0.1", port=port, log_level="warning", access_log=False, lifespan="on")
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def prepare(directory, args):
+    '''Migrates and seeds the database; returns the env for the servers and the orders to work through.'''
+    from flask_migrate import upgrade
+    from stripe_stub import StubStripe
+
+    bin_dir = os.path.join(directory, "bin")
+    os.makedirs(bin_dir)
+    with open(os.path.join(bin_dir, "wkhtmltopdf"), "w") as stub_binary:
+        stub_binary.write(WKHTMLTOPDF_STUB % args.pdf_seconds)
+    os.chmod(os.path.join(bin_dir, "wkhtmltopdf"), 0o755)
+
+    stub = StubStripe(latency=args.stripe_latency).start()
+    env = dict(os.environ, **{
+        "DATABASE_URL": "sqlite:///" + os.path.join(directory, "shop.db"),
+        "PDF_RENDERER": "wkhtmltopdf",
+        "PDF_DIR_PATH": os.path.join(directory, "pdf"),
+        "PDF_RENDER_WORKERS": str(args.pdf_workers),
+        # Every request is accepted, so both servers are measured on the same work
+        "PDF_RENDER_QUEUE_SIZE": "100000",
+        "PAYMENT_WORKERS": str(args.payment_workers),
+        "ASYNC_WSGI_THREADS": str(args.threads),
+        "STRIPE_API_BASE": stub.url,
+        "PATH": bin_dir + os.pathsep + os.environ.get("PATH", ""),
+    })
+    os.environ.update(env)
+
+    import main
+    from benchmarks.seed import PASSWORD, seed
+
+    app = main.create_app(CONFIG)
+    with app.app_context():
+        upgrade()
+    # One order for the PDFs, and one per payment, for both servers and every client count
+    orders = args.operations * (1 + 2 * len(args.clients))
+    data = seed(main, app, products=args.products, users=args.users, orders=orders, seed=args.seed)
+    with app.app_context():
+        main.db.session.execute(main.db.update(main.CustomerOrder).values(status="Pending"))
+        main.db.session.commit()
+        main.sales.rebuild()
+        rows = main.db.session.execute(
+            main.db.select(main.CustomerOrder.invoice, main.User.email)
+            .join(main.User, main.User.id == main.CustomerOrder.customer_id)
+            .order_by(main.CustomerOrder.id)).all()
+    data["orders"] = [(invoice, email) for invoice, email in rows]
+    data["password"] = PASSWORD
+    return env, data, stub
+
+
+class Server(object):
+    '''One server process for the benchmark.'''
+
+    def __init__(self, kind, env, threads, log):
+        self.kind = kind
+        self.port = free_port()
+        call = ("serve_sync(%d, %d)" % (self.port, threads) if kind == "sync" else "serve_async(%d)" % self.port)
+        self.process = subprocess.Popen(
+            [sys.executable, "-c", "from benchmarks.concurrency import serve_sync, serve_async; " + call],
+            env=env, stdout=log, stderr=subprocess.STDOUT)
+        self.url = "http://127.0.0.1:%d" % self.port
+
+    def wait(self, timeout=60):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise SystemExit("The %s server exited with status %d" % (self.kind, self.process.returncode))
+            try:
+                with socket.create_connection(("127.0.0.1", self.port), timeout=1):
+                    return
+            except OSError:
+                time.sleep(0.1)
+        raise SystemExit("The %s server didn't start" % self.kind)
+
+    def threads(self):
+        try:
+            with open("/proc/%d/status" % self.process.pid) as status:
+                for line in status:
+                    if line.startswith("Threads:"):
+                        return int(line.split()[1])
+        except OSError:
+            return None
+
+    def stop(self):
+        self.process.terminate()
+        self.process.wait()
+
+
+class Failed(Exception):
+    pass
+
+
+async def product(http, data, cookies, rng):
+    response = await http.get("/product/%d" % rng.choice(data["product_ids"]),
+                              headers=cookies[rng.choice(data["users"])])
+    if response.status_code != 200:
+        raise Failed(response.status_code)
+    return 1
+
+
+async def pdf(http, order, cookies):
+    invoice, email = order
+    response = await http.post("/get_pdf/" + invoice, headers=cookies[email])
+    if response.status_code not in (200, 202):
+        raise Failed(response.status_code)
+    job, requests = response.json(), 1
+    # The sync view queues a job to poll; the async one answers once the PDF is ready
+    status_url = job.get("status_url")
+    while job["status"] != "done":
+        if job["status"] == "failed":
+            raise Failed("render failed")
+        await asyncio.sleep(PDF_POLL)
+        job, requests = (await http.get(status_url, headers=cookies[email])).json(), requests + 1
+    return requests
+
+
+async def payment(http, order, cookies):
+    invoice, email = order
+    response = await http.post("/payment", headers=cookies[email],
+                               data={"invoice": invoice, "stripeToken": "tok_visa", "stripeEmail": email})
+    if response.status_code != 302:
+        raise Failed(response.status_code)
+    requests = 1
+    # Both servers answer before the charge is made; the order page polls until it is confirmed
+    while True:
+        await asyncio.sleep(PAYMENT_POLL)
+        status, requests = (await http.get("/payment/%s/status" % invoice, headers=cookies[email])).json(), \
+            requests + 1
+        if status["status"] == "succeeded":
+            return requests
+        if status["status"] == "failed":
+            raise Failed("charge failed")
+
+
+async def log_in(http, data):
+    cookies = {}
+    for email in data["users"]:
+        response = await http.post("/login", data={"email": email, "password": data["password"]})
+        if response.status_code != 302 or "session" not in response.cookies:
+            raise SystemExit("Logging in %s answered %d" % (email, response.status_code))
+        cookies[email] = {"Cookie": "session=" + response.cookies["session"]}
+    return cookies
+
+
+async def run_flow(server, flow, clients, work, data, cookies, args):
+    import httpx
+
+    rng = random.Random(args.seed)
+    queue = asyncio.Queue()
+    for item in work:
+        queue.put_nowait(item)
+    times, requests, errors = [], 0, {}
+    peak_threads = server.threads()
+
+    # A new connection per request, so neither server holds a thread for an idle keep-alive connection
+    limits = httpx.Limits(max_connections=clients, max_keepalive_connections=0)
+    async with httpx.AsyncClient(base_url=server.url, limits=limits, timeout=120) as http:
+        async def client():
+            nonlocal requests
+            while not queue.empty():
+                item = queue.get_nowait()
+                start = time.perf_counter()
+                try:
+                    if flow == "product":
+                        operation = product(http, data, cookies, rng)
+                    else:
+                        operation = globals()[flow](http, item, cookies)
+                    # A charge or render that never settles is an error, not a stalled run
+                    sent = await asyncio.wait_for(operation, args.deadline)
+                    requests += sent
+                    times.append(time.perf_counter() - start)
+                except (Failed, httpx.HTTPError, asyncio.TimeoutError) as e:
+                    key = str(e) or e.__class__.__name__
+                    errors[key] = errors.get(key, 0) + 1
+
+        async def watch():
+            nonlocal peak_threads
+            while True:
+                await asyncio.sleep(0.1)
+                peak_threads = max(peak_threads or 0, server.threads() or 0) or None
+
+        watcher = asyncio.ensure_future(watch())
+        start = time.perf_counter()
+        await asyncio.gather(*[client() for _ in range(clients)])
+        elapsed = time.perf_counter() - start
+        watcher.cancel()
+
+    times.sort()
+    return {
+        "server": server.kind, "flow": flow, "clients": clients, "operations": len(times),
+        "errors": errors, "seconds": round(elapsed, 3),
+        "ops_per_second": round(len(times) / elapsed, 1) if elapsed else None,
+        "p50_ms": round(percentile(times, 0.5) * 1000, 1) if times else None,
+        "p95_ms": round(percentile(times, 0.95) * 1000, 1) if times else None,
+        "requests_per_op": round(requests / len(times), 2) if times else None,
+        "peak_threads": peak_threads,
+    }
+
+
+async def bench_server(server, data, args, pdf_dir):
+    import httpx
+
+    async with httpx.AsyncClient(base_url=server.url, timeout=120) as http:
+        cookies = await log_in(http, data)
+    results = []
+    orders = data["orders"]
+    pdf_orders = orders[:args.operations]
+    payment_orders = orders[args.operations:]
+    # The sync server pays the first half of the pending orders, the async one the second
+    if server.kind == "async":
+        payment_orders = payment_orders[len(payment_orders) // 2:]
+    for clients in args.clients:
+        for flow in args.flows.split(","):
+            if flow == "pdf":
+                # Every run renders, instead of finding the previous run's invoices cached
+                shutil.rmtree(pdf_dir, ignore_errors=True)
+                work = pdf_orders
+            elif flow == "payment":
+                work, payment_orders = payment_orders[:args.operations], payment_orders[args.operations:]
+            else:
+                work = range(args.operations)
+            result = await run_flow(server, flow, clients, work, data, cookies, args)
+            results.append(result)
+            print_row(result)
+    return results
+
+
+def print_row(result):
+    print("%-6s %-8s %7d %6d %8s %9s %9s %9s %8s  %s" % (
+        result["server"], result["flow"], result["clients"], result["operations"], result["ops_per_second"],
+        result["p50_ms"], result["p95_ms"], result["requests_per_op"], result["peak_threads"],
+        ", ".join("%s x%d" % item for item in sorted(result["errors"].items())) or "-"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clients", type=lambda value: [int(part) for part in value.split(",")],
+                        default=[10, 50, 200], help="comma separated concurrency levels")
+    parser.add_argument("--operations", type=int, default=200, help="operations per flow and level")
+    parser.add_argument("--threads", type=int, default=8, help="request threads of the sync server")
+    parser.add_argument("--servers", default="sync,async")
+    parser.add_argument("--flows", default=",".join(FLOWS))
+    parser.add_argument("--stripe-latency", type=float, default=0.2)
+    parser.add_argument("--pdf-seconds", type=float, default=0.3)
+    parser.add_argument("--pdf-workers", type=int, default=4)
+    parser.add_argument("--payment-workers", type=int, default=4)
+    parser.add_argument("--deadline", type=float, default=60, help="seconds an operation may take")
+    parser.add_argument("--products", type=int, default=500)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the results as JSON")
+    args = parser.parse_args()
+    try:
+        import httpx  # noqa: F401
+        import uvicorn  # noqa: F401
+    except ImportError as e:
+        raise SystemExit("This benchmark needs httpx and uvicorn: %s" % e)
+
+    directory = tempfile.mkdtemp(prefix="shop-concurrency-")
+    env, data, stub = prepare(directory, args)
+    print("Database and server logs in " + directory)
+    print("One process per server; sync: %d request threads. Stripe %.0f ms, wkhtmltopdf %.0f ms, "
+          "%d renders at once" % (args.threads, args.stripe_latency * 1000, args.pdf_seconds * 1000,
+                                  args.pdf_workers))
+    print("%-6s %-8s %7s %6s %8s %9s %9s %9s %8s  %s" % ("server", "flow", "clients", "ops", "ops/s", "p50 ms",
+                                                         "p95 ms", "req/op", "threads", "errors"))
+    results = []
+    try:
+        for kind in args.servers.split(","):
+            log = open(os.path.join(directory, kind + ".log"), "w")
+            server = Server(kind, env, args.threads, log)
+            try:
+                server.wait()
+                results.extend(asyncio.run(bench_server(server, data, args, env["PDF_DIR_PATH"])))
+            finally:
+                server.stop()
+                log.close()
+    finally:
+        stub.stop()
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump({"args": vars(args), "results": results}, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
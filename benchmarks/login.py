@@ -0,0 +1,104 @@
+'''Login throughput next to catalog traffic, hashing inline vs. on the bounded pool.
+
+    python -m benchmarks.login [--logins 8] [--browsers 4] [--seconds 5] [--workers 2]
+
+Login threads check a password over and over while browser threads render
+a product grid, both through a Flask test client. "inline" verifies the
+password on the request thread, as the login view used to; "pooled" goes
+through PasswordHasher, which caps how many hashes run at once. Reports
+logins and catalog pages per second and the catalog's 95th percentile
+latency: the cap trades some login throughput for a responsive catalog.
+'''
+
+import argparse
+import os
+import statistics
+import threading
+import time
+
+from flask import Flask, render_template_string
+from werkzeug.security import check_password_hash, generate_password_hash
+
+from password_hashing import HashingBusy, PasswordHasher
+
+
+CATALOG = '''<div class="row">{% for product in products %}
+<div class="card"><h5>{{ product.name }}</h5><p>{{ product.description|truncate(60) }}</p>
+<span>${{ "%.2f"|format(product.price) }}</span>{% if product.stock < 5 %}<em>Only {{ product.stock }} left</em>{% endif %}
+</div>{% endfor %}</div>'''
+
+PRODUCTS = [{"name": "Product %d" % number, "description": "A fine product " * 8, "price": number * 1.25,
+             "stock": number % 9} for number in range(48)]
+
+
+def make_app(mode, method, workers):
+    app = Flask(__name__)
+    app.config['PASSWORD_HASH_METHOD'] = method
+    app.config['PASSWORD_HASH_WORKERS'] = workers
+    app.config['PASSWORD_HASH_QUEUE_SIZE'] = 1024
+    app.config['PASSWORD_HASH_TIMEOUT'] = 60
+    passwords = PasswordHasher(app)
+    stored = generate_password_hash("correct horse", method=method)
+
+    @app.route("/catalog")
+    def catalog():
+        return render_template_string(CATALOG, products=PRODUCTS)
+
+    @app.route("/login")
+    def login():
+        try:
+            if mode == "inline":
+                valid = check_password_hash(stored, "correct horse")
+            else:
+                valid = passwords.verify(stored, "correct horse")
+        except HashingBusy:
+            return "busy", 503
+        return ("ok", 200) if valid else ("no", 401)
+
+    return app
+
+
+def client_loop(app, path, deadline, latencies):
+    client = app.test_client()
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        response = client.get(path)
+        if response.status_code == 200:
+            latencies.append(time.perf_counter() - start)
+
+
+def run(mode, method, args):
+    app = make_app(mode, method, args.workers)
+    app.test_client().get("/catalog")
+    deadline = time.perf_counter() + args.seconds
+    logins, pages = [], []
+    threads = [threading.Thread(target=client_loop, args=(app, "/login", deadline, logins))
+               for _ in range(args.logins)]
+    threads += [threading.Thread(target=client_loop, args=(app, "/catalog", deadline, pages))
+                for _ in range(args.browsers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    p95 = statistics.quantiles(pages, n=20)[-1] * 1000 if len(pages) >= 20 else float("nan")
+    print("%-7s %8.1f logins/s %9.1f pages/s   catalog p95 %7.1f ms"
+          % (mode, len(logins) / args.seconds, len(pages) / args.seconds, p95))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--logins", type=int, default=8, help="concurrent login threads")
+    parser.add_argument("--browsers", type=int, default=4, help="concurrent catalog threads")
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 2) // 2),
+                        help="PASSWORD_HASH_WORKERS for the pooled run")
+    parser.add_argument("--method", default="scrypt:32768:8:1")
+    args = parser.parse_args()
+    print("%s, %d login and %d catalog threads, %d CPUs, %d hash workers"
+          % (args.method, args.logins, args.browsers, os.cpu_count() or 1, args.workers))
+    for mode in ("inline", "pooled"):
+        run(mode, args.method, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+'''Checks that the hot storefront queries are served by an index.
+
+    python -m benchmarks.query_plans
+
+Runs EXPLAIN QUERY PLAN on an empty in-memory copy of the schema and
+exits non-zero if any of the queries below full-scans a table, so a
+dropped index or a rewritten query that can no longer use one is caught
+before it reaches production. A scan of an index that already holds the
+rows in ORDER BY order and stops at a LIMIT, like the partial index of
+in-stock products behind the first page of the home listing, reads no
+more than one page and is allowed; a scan of the table itself never is.
+'''
+
+import sys
+
+from sqlalchemy import create_engine, select, text, tuple_
+
+from main import db, Product, CustomerOrder, OrderItem, User
+
+# Tables too large to scan on a request path
+HOT_TABLES = ("products", "customer_order", "order_items", "users")
+
+
+def hot_queries():
+    return {
+        "home, first page": select(Product).where(Product.stock > 0).order_by(Product.id.desc()).limit(9),
+        "home, next page": select(Product).where(Product.stock > 0, Product.id < 500)
+                                          .order_by(Product.id.desc()).limit(9),
+        "brand, first page": select(Product).where(Product.brand_id == 1).order_by(Product.id.desc()).limit(9),
+        "brand, next page": select(Product).where(Product.brand_id == 1, Product.id < 500)
+                                           .order_by(Product.id.desc()).limit(9),
+        "category, next page": select(Product).where(Product.category_id == 1, Product.id < 500)
+                                              .order_by(Product.id.desc()).limit(9),
+        "price sort, next page": select(Product).where(tuple_(Product.price, Product.id) > tuple_(100, 5))
+                                                .order_by(Product.price, Product.id).limit(9),
+        "cart lines": select(Product).where(Product.id.in_([1, 2, 3])),
+        "order by invoice": select(CustomerOrder).where(CustomerOrder.customer_id == 1,
+                                                        CustomerOrder.invoice == "abc"),
+        "customer orders": select(CustomerOrder).where(CustomerOrder.customer_id == 1)
+                                                .order_by(CustomerOrder.id.desc()),
+        "order lines": select(OrderItem).where(OrderItem.order_id == 1).order_by(OrderItem.id),
+        "login": select(User).where(User.email == "someone@example.com"),
+        "load user": select(User).where(User.id == 1),
+    }
+
+
+def table_scans(conn, statement):
+    compiled = statement.compile(conn, compile_kwargs={"literal_binds": True})
+    plan = conn.execute(text("EXPLAIN QUERY PLAN " + str(compiled))).all()
+    details = [row[-1] for row in plan]
+    bounded = " LIMIT " in str(compiled) and not any("TEMP B-TREE" in detail for detail in details)
+    scans = [detail for detail in details
+             if detail.startswith("SCAN ") and detail.split()[1] in HOT_TABLES
+             and not (bounded and " USING " in detail and "INDEX" in detail)]
+    return details, scans
+
+
+def main():
+    engine = create_engine("sqlite://")
+    db.metadata.create_all(engine)
+    failures = 0
+    with engine.connect() as conn:
+        for name, statement in hot_queries().items():
+            details, scans = table_scans(conn, statement)
+            status = "FAIL" if scans else "ok"
+            failures += bool(scans)
+            print("%-4s %-22s %s" % (status, name, "; ".join(details)))
+    if failures:
+        print("%d hot queries scan a whole table" % failures)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
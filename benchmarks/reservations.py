@@ -0,0 +1,143 @@
+'''Stock reservation stress test: concurrent checkouts must never oversell.
+
+    python -m benchmarks.reservations [--threads 16] [--orders 300] [--products 20] [--stock 25]
+
+Threads place orders for a few scarce products through Inventory.reserve,
+one transaction per order, until each has placed its share. Afterwards
+every product's stock must equal its starting stock minus the quantities
+held for it, and never be negative. Reports reservations per second and
+the orders turned away for lack of stock. Pass ``--database-url`` to run
+against another database than a temporary SQLite file.
+'''
+
+import argparse
+import os
+import random
+import tempfile
+import threading
+import time
+
+from flask import Flask
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import DateTime, ForeignKey, Integer, String, func, select
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
+
+from db_profile import DatabaseProfile
+from inventory import HELD, Inventory, OutOfStock
+
+
+class Base(DeclarativeBase):
+    pass
+
+
+db = SQLAlchemy(model_class=Base)
+
+
+class Product(db.Model):
+    __tablename__ = "products"
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    stock: Mapped[int] = mapped_column(Integer, nullable=False)
+
+
+class CustomerOrder(db.Model):
+    __tablename__ = "customer_order"
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    status: Mapped[str] = mapped_column(String(100), nullable=False, default="Pending")
+
+
+class StockReservation(db.Model):
+    __tablename__ = "stock_reservations"
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    order_id: Mapped[int] = mapped_column(Integer, ForeignKey("customer_order.id"), nullable=False, index=True)
+    product_id: Mapped[int] = mapped_column(Integer, nullable=False)
+    quantity: Mapped[int] = mapped_column(Integer, nullable=False)
+    status: Mapped[str] = mapped_column(String(20), nullable=False)
+    expires_at: Mapped[str] = mapped_column(DateTime, nullable=False)
+    created_at: Mapped[str] = mapped_column(DateTime, nullable=False)
+
+
+def worker(app, inventory, orders, seed, results):
+    rng = random.Random(seed)
+    products = app.config['BENCH_PRODUCTS']
+    reserved = rejected = locked = 0
+    with app.app_context():
+        for _ in range(orders):
+            lines = [(rng.randint(1, products), rng.randint(1, 3)) for _ in range(rng.randint(1, 3))]
+            try:
+                order = CustomerOrder()
+                db.session.add(order)
+                db.session.flush()
+                inventory.reserve(order.id, lines)
+                db.session.commit()
+                reserved += 1
+            except OutOfStock:
+                db.session.rollback()
+                rejected += 1
+            except OperationalError as error:
+                db.session.rollback()
+                if "locked" not in str(error):
+                    raise
+                locked += 1
+    results.append((reserved, rejected, locked))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--orders", type=int, default=300, help="orders per thread")
+    parser.add_argument("--products", type=int, default=20)
+    parser.add_argument("--stock", type=int, default=25, help="starting stock of each product")
+    parser.add_argument("--database-url")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    app = Flask(__name__)
+    app.config['DATABASE_URL'] = args.database_url or "sqlite:///" + os.path.join(directory, "reservations.db")
+    app.config['BENCH_PRODUCTS'] = args.products
+    profile = DatabaseProfile(app)
+    db.init_app(app)
+    with app.app_context():
+        profile.watch(db.engine)
+    inventory = Inventory(db, Product, StockReservation, CustomerOrder, app)
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        db.session.add_all([Product(id=number, stock=args.stock) for number in range(1, args.products + 1)])
+        db.session.commit()
+
+    results = []
+    threads = [threading.Thread(target=worker, args=(app, inventory, args.orders, seed, results))
+               for seed in range(args.threads)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    reserved = sum(result[0] for result in results)
+    rejected = sum(result[1] for result in results)
+    locked = sum(result[2] for result in results)
+    with app.app_context():
+        stock = dict(db.session.execute(select(Product.id, Product.stock)).all())
+        held = dict(db.session.execute(
+            select(StockReservation.product_id, func.sum(StockReservation.quantity))
+            .where(StockReservation.status == HELD).group_by(StockReservation.product_id)).all())
+        db.session.remove()
+    oversold = [product_id for product_id, left in stock.items()
+                if left < 0 or left != args.stock - held.get(product_id, 0)]
+
+    print("%d threads, %d orders: %d reserved, %d out of stock, %d locked in %.2fs"
+          % (args.threads, args.threads * args.orders, reserved, rejected, locked, elapsed))
+    print("%.1f reservations/s, %.1f orders/s" % (reserved / elapsed, (reserved + rejected) / elapsed))
+    print("units held %d of %d, products sold out %d of %d"
+          % (sum(held.values()), args.stock * args.products, sum(1 for left in stock.values() if left == 0),
+             args.products))
+    if oversold:
+        raise SystemExit("Oversold or inconsistent stock for products %s" % oversold)
+    print("No oversell: every product's stock matches its reservations")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,317 @@
+'''Storefront and checkout latency, throughput and SQL per request, against a baseline.
+
+    python -m benchmarks.routes [--driver client|http] [--threads 4] [--iterations 25]
+                                [--output report.json] [--baseline benchmarks/baseline.json]
+                                [--save-baseline benchmarks/baseline.json]
+
+Seeds a synthetic shop (benchmarks.seed) into a throwaway SQLite database
+and drives the real routes. Each thread is one visitor browsing
+anonymously (home, brand, search, product), and one logged-in shopper
+who adds to the cart, views it, places the order and opens the order
+page. ``client`` drives the app through Flask test clients; ``http``
+starts a threaded local server and drives it over keep-alive HTTP
+connections. Stripe calls go to stripe_stub.py and invoices use the fake
+PDF renderer.
+
+The JSON report has p50/p95/p99 latency, requests per second and the
+mean number of SQL statements per request, for each route. With
+``--baseline`` the run fails, exit status 1, when a route's p95 grows by
+more than ``--tolerance`` (and ``--min-delta-ms``), it runs more SQL
+statements, it returns errors, or total throughput drops by more than the
+tolerance. Latency depends on the machine: save the baseline on the
+machine that runs the comparison.
+'''
+
+import argparse
+from collections import defaultdict
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import threading
+import time
+
+from sqlalchemy import event
+
+
+ROUTES = ["home", "get_brand", "search", "show_product", "add_cart", "get_carts", "get_order", "orders"]
+
+# Status codes each route answers a well-formed request with
+EXPECTED = {"add_cart": (302,), "get_order": (302,)}
+
+
+def percentile(ordered, fraction):
+    '''Nearest-rank percentile of an already sorted list.'''
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, max(0, int(round(fraction * len(ordered) + 0.5)) - 1))]
+
+
+def prepare(args):
+    '''Points the app at a throwaway database and the stubs, builds it, migrates and seeds the database.'''
+    from flask_migrate import upgrade
+    from stripe_stub import StubStripe
+
+    directory = tempfile.mkdtemp(prefix="shop-bench-")
+    stub = StubStripe().start()
+    os.environ.update({
+        "DATABASE_URL": "sqlite:///" + os.path.join(directory, "shop.db"),
+        "PDF_RENDERER": "fake",
+        "PDF_DIR_PATH": os.path.join(directory, "pdf"),
+        "STRIPE_API_BASE": stub.url,
+        "STRIPE_WEBHOOK_SECRET": "whsec_bench",
+    })
+    import main
+    from benchmarks.seed import seed
+
+    app = main.create_app({'WTF_CSRF_ENABLED': False})
+    with app.app_context():
+        upgrade()
+    data = seed(main, app, products=args.products, brands=args.brands, categories=args.categories,
+                users=max(args.users, args.threads), orders=args.orders, seed=args.seed)
+    return app, data
+
+
+class SqlCounter(object):
+    '''WSGI middleware counting the SQL statements run for each labelled request.'''
+
+    def __init__(self, app, engine):
+        self.wsgi_app = app.wsgi_app
+        self.counts = defaultdict(list)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        event.listen(engine, "before_cursor_execute", self._count)
+        app.wsgi_app = self
+
+    def _count(self, *args):
+        self._local.count = getattr(self._local, "count", 0) + 1
+
+    def __call__(self, environ, start_response):
+        self._local.count = 0
+        iterable = self.wsgi_app(environ, start_response)
+        try:
+            body = list(iterable)
+        finally:
+            if hasattr(iterable, "close"):
+                iterable.close()
+        label = environ.get("HTTP_X_BENCH_ROUTE")
+        if label:
+            with self._lock:
+                self.counts[label].append(self._local.count)
+        return body
+
+
+class ClientDriver(object):
+    '''One Flask test client per visitor.'''
+
+    def __init__(self, app):
+        self.app = app
+
+    def session(self):
+        client = self.app.test_client()
+
+        def request(method, path, data=None, headers=None):
+            response = client.open(path, method=method, data=data, headers=headers)
+            return response.status_code, response.headers.get("Location")
+        return request
+
+    def close(self):
+        pass
+
+
+class HttpDriver(object):
+    '''A threaded local server, with one keep-alive requests session per visitor.'''
+
+    def __init__(self, app):
+        from werkzeug.serving import make_server
+        self.server = make_server("127.0.0.1", 0, app, threaded=True)
+        self.base = "http://127.0.0.1:%d" % self.server.server_port
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def session(self):
+        import requests
+        http = requests.Session()
+
+        def request(method, path, data=None, headers=None):
+            response = http.request(method, self.base + path, data=data, headers=headers, allow_redirects=False)
+            location = response.headers.get("Location")
+            if location and location.startswith(self.base):
+                location = location[len(self.base):]
+            return response.status_code, location
+        return request
+
+    def close(self):
+        self.server.shutdown()
+
+
+def visitor(driver, data, args, number, results, errors):
+    rng = random.Random(args.seed * 1000 + number)
+    anonymous = driver.session()
+    shopper = driver.session()
+    email = data["users"][number % len(data["users"])]
+    status, _location = shopper("POST", "/login", {"email": email, "password": "benchmark"})
+    if status != 302:
+        raise RuntimeError("Login as %s failed with %d" % (email, status))
+
+    def timed(request, label, method, path, form=None, headers=None, record=True):
+        headers = dict(headers or {}, **{"X-Bench-Route": label if record else ""})
+        start = time.perf_counter()
+        try:
+            status, location = request(method, path, form, headers)
+        except Exception:
+            status, location = None, None
+        elapsed = time.perf_counter() - start
+        if record:
+            results[label].append(elapsed)
+            if status not in EXPECTED.get(label, (200,)):
+                errors[label] += 1
+        return location
+
+    for iteration in range(args.warmup + args.iterations):
+        record = iteration >= args.warmup
+        timed(anonymous, "home", "GET", "/", record=record)
+        timed(anonymous, "get_brand", "GET", "/brand/%d" % rng.choice(data["brand_ids"]), record=record)
+        timed(anonymous, "search", "GET", "/search?q=%s" % rng.choice(data["search_terms"]), record=record)
+        product_id = rng.choice(data["product_ids"])
+        timed(anonymous, "show_product", "GET", "/product/%d" % product_id, record=record)
+
+        for product_id in rng.sample(data["product_ids"], rng.randint(1, 3)):
+            timed(shopper, "add_cart", "POST", "/add_cart",
+                  {"product_id": str(product_id), "quantity": str(rng.randint(1, 2)), "colors": "red"},
+                  {"Referer": "/product/%d" % product_id}, record=record)
+        timed(shopper, "get_carts", "GET", "/cart", record=record)
+        location = timed(shopper, "get_order", "GET", "/get_order", record=record)
+        if location and location.startswith("/orders/"):
+            timed(shopper, "orders", "GET", location, record=record)
+        elif record:
+            errors["orders"] += 1
+
+
+def run(app, data, args):
+    with app.app_context():
+        counter = SqlCounter(app, app.extensions['sqlalchemy'].engine)
+    driver = HttpDriver(app) if args.driver == "http" else ClientDriver(app)
+    results = defaultdict(list)
+    errors = defaultdict(int)
+    threads = [threading.Thread(target=visitor, args=(driver, data, args, number, results, errors))
+               for number in range(args.threads)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    driver.close()
+    return report(results, errors, counter, elapsed, args)
+
+
+def report(results, errors, counter, elapsed, args):
+    routes = {}
+    total = 0
+    for route in ROUTES:
+        latencies = sorted(results.get(route, ()))
+        total += len(latencies)
+        statements = counter.counts.get(route, ())
+        routes[route] = {
+            "requests": len(latencies),
+            "errors": errors.get(route, 0),
+            "rps": round(len(latencies) / elapsed, 1),
+            "p50_ms": round(percentile(latencies, 0.50) * 1000, 2) if latencies else None,
+            "p95_ms": round(percentile(latencies, 0.95) * 1000, 2) if latencies else None,
+            "p99_ms": round(percentile(latencies, 0.99) * 1000, 2) if latencies else None,
+            "sql_per_request": round(sum(statements) / len(statements), 2) if statements else None,
+        }
+    return {
+        "meta": {
+            "driver": args.driver, "threads": args.threads, "iterations": args.iterations,
+            "products": args.products, "orders": args.orders, "seed": args.seed,
+            "python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count(),
+        },
+        "total": {"requests": total, "seconds": round(elapsed, 3), "rps": round(total / elapsed, 1)},
+        "routes": routes,
+    }
+
+
+def compare(current, baseline, tolerance, min_delta_ms):
+    '''Returns a list of regressions of ``current`` against ``baseline``.'''
+    regressions = []
+    for route, base in baseline["routes"].items():
+        now = current["routes"].get(route)
+        if now is None or not now["requests"]:
+            regressions.append("%s: no requests" % route)
+            continue
+        if now["errors"]:
+            regressions.append("%s: %d errors" % (route, now["errors"]))
+        if base.get("p95_ms") is not None and now["p95_ms"] > base["p95_ms"] * (1 + tolerance) \
+                and now["p95_ms"] - base["p95_ms"] > min_delta_ms:
+            regressions.append("%s: p95 %.2fms, baseline %.2fms" % (route, now["p95_ms"], base["p95_ms"]))
+        # Statement counts barely vary between runs (periodic sweeps, cache expiry), so a
+        # quarter of a statement more per request means a new query
+        if base.get("sql_per_request") is not None and now["sql_per_request"] is not None \
+                and now["sql_per_request"] > base["sql_per_request"] + 0.25:
+            regressions.append("%s: %.2f SQL statements per request, baseline %.2f"
+                               % (route, now["sql_per_request"], base["sql_per_request"]))
+    if current["total"]["rps"] < baseline["total"]["rps"] * (1 - tolerance):
+        regressions.append("throughput %.1f requests/s, baseline %.1f"
+                           % (current["total"]["rps"], baseline["total"]["rps"]))
+    return regressions
+
+
+def print_table(result, stream):
+    stream.write("%-14s %8s %8s %9s %9s %9s %7s %6s\n"
+                 % ("route", "requests", "req/s", "p50 ms", "p95 ms", "p99 ms", "sql", "errors"))
+    for route, row in result["routes"].items():
+        stream.write("%-14s %8d %8.1f %9s %9s %9s %7s %6d\n" % (
+            route, row["requests"], row["rps"], row["p50_ms"], row["p95_ms"], row["p99_ms"],
+            row["sql_per_request"], row["errors"]))
+    total = result["total"]
+    stream.write("%d requests in %.2fs, %.1f requests/s\n" % (total["requests"], total["seconds"], total["rps"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--driver", choices=("client", "http"), default="client")
+    parser.add_argument("--threads", type=int, default=4, help="concurrent visitors")
+    parser.add_argument("--iterations", type=int, default=25, help="visits per thread")
+    parser.add_argument("--warmup", type=int, default=2, help="visits per thread before measuring")
+    parser.add_argument("--products", type=int, default=2000)
+    parser.add_argument("--brands", type=int, default=20)
+    parser.add_argument("--categories", type=int, default=10)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--orders", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the JSON report here; - for stdout")
+    parser.add_argument("--baseline", help="fail on a regression against this report")
+    parser.add_argument("--save-baseline", help="write the report here as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed p95 and throughput change")
+    parser.add_argument("--min-delta-ms", type=float, default=2.0, help="ignore p95 changes smaller than this")
+    args = parser.parse_args()
+
+    app, data = prepare(args)
+    result = run(app, data, args)
+    print_table(result, sys.stderr)
+
+    if args.output == "-":
+        json.dump(result, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    elif args.output:
+        with open(args.output, "w") as output:
+            json.dump(result, output, indent=2)
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as output:
+            json.dump(result, output, indent=2)
+            output.write("\n")
+    if args.baseline:
+        with open(args.baseline) as stored:
+            regressions = compare(result, json.load(stored), args.tolerance, args.min_delta_ms)
+        if regressions:
+            sys.stderr.write("Regressions against %s:\n  %s\n" % (args.baseline, "\n  ".join(regressions)))
+            sys.exit(1)
+        sys.stderr.write("No regressions against %s\n" % args.baseline)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+'''Query latency of the FTS5 product search over a synthetic catalog.
+
+    python -m benchmarks.search [--products 100000] [--queries 500]
+
+Builds a throwaway SQLite database with the same products_fts table and
+triggers as the app's migration, then times ranked, filtered and paginated
+queries.
+'''
+
+import argparse
+import importlib.util
+import os
+import random
+import sqlite3
+import statistics
+import tempfile
+import time
+
+from search_index import match_expression, search_sql
+
+MIGRATION = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                         "migrations", "versions", "6a9d4c1e8b37_product_search_index.py")
+
+WORDS = ("phone watch laptop tablet pro max ultra mini plus lite camera battery display screen "
+         "wireless charger fast zoom night mode titanium glass aluminium silver black gold blue").split()
+
+
+def load_schema():
+    '''The FTS table and triggers, as the migration that creates them has them.'''
+    spec = importlib.util.spec_from_file_location("product_search_index", MIGRATION)
+    migration = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(migration)
+    return migration.SCHEMA
+
+
+def build(path, count, seed=1):
+    rng = random.Random(seed)
+    # A long tail of filler words so common terms match a realistic share of the catalog
+    vocabulary = WORDS + ["w%04d" % i for i in range(5000)]
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE products (id INTEGER PRIMARY KEY, product_name TEXT, description TEXT,"
+                 " brand_id INTEGER, category_id INTEGER, stock INTEGER)")
+    for statement in load_schema():
+        conn.execute(statement)
+    rows = ((" ".join(rng.sample(WORDS, 3)) + " %d" % i, " ".join(rng.choices(vocabulary, k=25)),
+             rng.randint(1, 50), rng.randint(1, 10), rng.randint(0, 20)) for i in range(count))
+    start = time.perf_counter()
+    conn.executemany("INSERT INTO products (product_name, description, brand_id, category_id, stock)"
+                     " VALUES (?, ?, ?, ?, ?)", rows)
+    conn.commit()
+    return conn, time.perf_counter() - start
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--products", type=int, default=100000)
+    parser.add_argument("--queries", type=int, default=500)
+    args = parser.parse_args(argv)
+
+    rng = random.Random(2)
+    with tempfile.TemporaryDirectory() as directory:
+        conn, load_time = build(os.path.join(directory, "bench.db"), args.products)
+        print("indexed %d products in %.1fs" % (args.products, load_time))
+        cases = {
+            "one word": lambda: (rng.choice(WORDS), {}),
+            "prefix": lambda: (rng.choice(WORDS)[:3], {}),
+            "two words": lambda: (" ".join(rng.sample(WORDS, 2)), {}),
+            "filtered": lambda: (rng.choice(WORDS), {"brand_id": rng.randint(1, 50), "in_stock": True}),
+            "page 5": lambda: (rng.choice(WORDS), {"page": 5}),
+        }
+        for name, make in cases.items():
+            timings = []
+            for _ in range(args.queries):
+                query, filters = make()
+                page = filters.pop("page", 1)
+                params = {"match": match_expression(query), "brand_id": filters.get("brand_id"),
+                          "category_id": None, "limit": 13, "offset": (page - 1) * 12}
+                start = time.perf_counter()
+                conn.execute(search_sql(**filters), params).fetchall()
+                timings.append(time.perf_counter() - start)
+            timings.sort()
+            print("%-10s p50 %6.2f ms  p95 %6.2f ms  p99 %6.2f ms" % (
+                name, statistics.median(timings) * 1000, percentile(timings, 0.95) * 1000,
+                percentile(timings, 0.99) * 1000))
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
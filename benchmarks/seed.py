@@ -0,0 +1,130 @@
+'''Synthetic catalog, users and order history for the benchmarks.
+
+    python -m benchmarks.seed --database-url sqlite:////tmp/shop.db [--products 2000] [--orders 500]
+
+Seeding is deterministic for a given ``--seed``: the same sizes always
+produce the same rows, so runs of the route benchmark are comparable.
+Rows are inserted with executemany; the caches and rollups that normally
+follow ORM writes are rebuilt at the end. Every user's password is
+``benchmark``.
+'''
+
+import argparse
+from datetime import datetime, timedelta
+import os
+import random
+import time
+
+
+PASSWORD = "benchmark"
+
+ADJECTIVES = ["Quantum", "Nova", "Lumen", "Vertex", "Aero", "Pixel", "Titan", "Echo", "Zen", "Orbit",
+              "Nimbus", "Flux", "Pulse", "Atlas", "Vivid", "Prism"]
+NOUNS = ["Phone", "Watch", "Tablet", "Laptop", "Speaker", "Camera", "Headphones", "Monitor", "Keyboard",
+         "Router", "Charger", "Drone"]
+COLORS = ["red", "blue", "black", "white", "green", "silver"]
+
+# Words the route benchmark searches for
+SEARCH_TERMS = [word.lower() for word in ADJECTIVES[:8] + NOUNS[:6]]
+
+
+def seed(main, app, products=2000, brands=20, categories=10, users=20, orders=500, seed=0):
+    '''Fills the app's empty database; returns the ids the route benchmark requests.
+
+    :param main: The imported ``main`` module.
+    :param app: An app from ``main.create_app()``, its database migrated.
+    '''
+    rng = random.Random(seed)
+    db = main.db
+    with app.app_context():
+        connection = db.session.connection()
+        connection.execute(main.Brand.__table__.insert(),
+                           [{"name": "Brand %03d" % number} for number in range(1, brands + 1)])
+        connection.execute(main.Category.__table__.insert(),
+                           [{"name": "Category %02d" % number} for number in range(1, categories + 1)])
+        brand_ids = [id for id, in connection.execute(db.select(main.Brand.id).order_by(main.Brand.id))]
+        category_ids = [id for id, in connection.execute(db.select(main.Category.id).order_by(main.Category.id))]
+
+        rows = []
+        for number in range(1, products + 1):
+            name = "%s %s %d" % (rng.choice(ADJECTIVES), rng.choice(NOUNS), number)
+            rows.append({
+                "product_name": name, "price": rng.randint(5, 900), "discount": rng.choice((0, 0, 0, 10, 25)),
+                # Plenty, so checkouts are never turned away for stock
+                "stock": 1000000 if rng.random() > 0.05 else 0,
+                "description": "The %s, in %d colors." % (name, rng.randint(1, 4)),
+                "colors": ",".join(rng.sample(COLORS, 2)), "brand_id": rng.choice(brand_ids),
+                "category_id": rng.choice(category_ids), "image_1": "image.jpg", "image_2": "image.jpg",
+                "image_3": "image.jpg", "image_variants": {},
+            })
+        connection.execute(main.Product.__table__.insert(), rows)
+        product_rows = connection.execute(db.select(main.Product.id, main.Product.product_name, main.Product.price,
+                                                    main.Product.discount, main.Product.stock)).all()
+        in_stock = [row for row in product_rows if row.stock > 0]
+
+        # One hash for everyone: hashing thousands of passwords would dominate seeding
+        password = main.passwords.hash(PASSWORD)
+        connection.execute(main.User.__table__.insert(), [
+            {"name": "Shopper %d" % number, "email": "shopper%d@bench.test" % number, "password": password,
+             "country": "US", "state": "CA", "city": "San Jose", "contact": "555-0100", "address": "1 Main St",
+             "zipcode": "95113"} for number in range(1, users + 1)])
+        user_ids = [id for id, in connection.execute(db.select(main.User.id).order_by(main.User.id))]
+
+        now = datetime.utcnow()
+        order_rows = [{"invoice": "%010x" % rng.getrandbits(40), "customer_id": rng.choice(user_ids),
+                       "status": "Paid" if rng.random() < 0.7 else "Pending", "orders": None,
+                       "date_created": now - timedelta(minutes=rng.randint(0, 60 * 24 * 90))}
+                      for _ in range(orders)]
+        if order_rows:
+            connection.execute(main.CustomerOrder.__table__.insert(), order_rows)
+        order_ids = [id for id, in connection.execute(db.select(main.CustomerOrder.id))]
+        item_rows = []
+        for order_id in order_ids:
+            for product in rng.sample(in_stock, rng.randint(1, 4)):
+                item_rows.append({"order_id": order_id, "product_id": product.id,
+                                  "product_name": product.product_name, "unit_price_cents": product.price * 100,
+                                  "discount": product.discount, "quantity": rng.randint(1, 3),
+                                  "color": rng.choice(COLORS)})
+        if item_rows:
+            connection.execute(main.OrderItem.__table__.insert(), item_rows)
+        db.session.commit()
+
+        # The inserts bypassed the ORM events these are normally kept current by
+        main.sales.rebuild()
+        main.suggestions.build()
+        main.nav_facets.invalidate()
+        main.page_cache.invalidate()
+
+    return {
+        "brand_ids": brand_ids,
+        "category_ids": category_ids,
+        "product_ids": [row.id for row in in_stock],
+        "users": ["shopper%d@bench.test" % number for number in range(1, users + 1)],
+        "search_terms": SEARCH_TERMS,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--database-url", required=True, help="an empty database; it is migrated first")
+    parser.add_argument("--products", type=int, default=2000)
+    parser.add_argument("--brands", type=int, default=20)
+    parser.add_argument("--categories", type=int, default=10)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--orders", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    os.environ["DATABASE_URL"] = args.database_url
+    from flask_migrate import upgrade
+    import main as shop
+    app = shop.create_app()
+    with app.app_context():
+        upgrade()
+    start = time.perf_counter()
+    seed(shop, app, args.products, args.brands, args.categories, args.users, args.orders, args.seed)
+    print("Seeded %d products, %d users and %d orders in %.2fs"
+          % (args.products, args.users, args.orders, time.perf_counter() - start))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+'''Cold start: fresh interpreter to the first response.
+
+    python -m benchmarks.startup [--runs 10] [--products 200]
+
+Migrates and seeds a throwaway SQLite database once, then starts the app
+``--runs`` times, each in a new Python process as a worker or CLI
+invocation would. Every run imports ``main``, calls ``create_app()`` and
+requests the home page. Reports the median and best time of each step,
+the whole process included, and which of the slow optional libraries were
+imported by then.
+'''
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+
+CHILD = '''
+import json, sys, time
+start = time.perf_counter()
+import main
+imported = time.perf_counter()
+app = main.create_app()
+created = time.perf_counter()
+response = app.test_client().get("/")
+answered = time.perf_counter()
+json.dump({"import": imported - start, "create_app": created - imported, "first_response": answered - created,
+           "status": response.status_code, "modules": len(sys.modules),
+           "loaded": [name for name in %r if name in sys.modules]}, sys.stdout)
+'''
+
+# Imported on first use only
+DEFERRED = ("stripe", "celery", "requests", "PIL")
+
+STEPS = ("import", "create_app", "first_response", "process")
+
+
+def prepare(directory, products):
+    env = dict(os.environ, DATABASE_URL="sqlite:///" + os.path.join(directory, "shop.db"), PDF_RENDERER="fake",
+               PDF_DIR_PATH=os.path.join(directory, "pdf"))
+    setup = ("from benchmarks.seed import seed\n"
+             "from flask_migrate import upgrade\n"
+             "import main\n"
+             "app = main.create_app()\n"
+             "with app.app_context():\n"
+             "    upgrade()\n"
+             "seed(main, app, products=%d, orders=0)\n" % products)
+    subprocess.run([sys.executable, "-c", setup], env=env, check=True, stdout=subprocess.DEVNULL,
+                   stderr=subprocess.DEVNULL)
+    return env
+
+
+def run_once(env):
+    start = time.perf_counter()
+    process = subprocess.run([sys.executable, "-c", CHILD % (DEFERRED,)], env=env, check=True,
+                             stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    result = json.loads(process.stdout)
+    result["process"] = time.perf_counter() - start
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--products", type=int, default=200)
+    args = parser.parse_args()
+
+    env = prepare(tempfile.mkdtemp(prefix="shop-startup-"), args.products)
+    runs = [run_once(env) for _ in range(args.runs)]
+    if any(run["status"] != 200 for run in runs):
+        raise SystemExit("The home page answered %s" % sorted({run["status"] for run in runs}))
+
+    print("%d cold starts, %d modules loaded" % (len(runs), runs[-1]["modules"]))
+    print("%-16s %10s %10s" % ("step", "median ms", "best ms"))
+    for step in STEPS:
+        times = [run[step] * 1000 for run in runs]
+        print("%-16s %10.1f %10.1f" % (step, statistics.median(times), min(times)))
+    print("Loaded by the first response: %s" % (", ".join(runs[-1]["loaded"]) or "none of " + ", ".join(DEFERRED)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+'''Lookup latency of the search-as-you-type prefix index.
+
+    python -m benchmarks.suggest [--products 100000] [--lookups 20000]
+'''
+
+import argparse
+import random
+import time
+
+from suggest import PrefixIndex
+
+WORDS = "phone watch laptop tablet pro max ultra mini plus lite galaxy iphone pixel note series air".split()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--products", type=int, default=100000)
+    parser.add_argument("--lookups", type=int, default=20000)
+    args = parser.parse_args(argv)
+
+    rng = random.Random(1)
+    index = PrefixIndex()
+    start = time.perf_counter()
+    index.load(("product", i, " ".join(rng.sample(WORDS, 3)) + " %d" % i) for i in range(args.products))
+    print("built index of %d names in %.2fs" % (len(index), time.perf_counter() - start))
+
+    prefixes = [word[:length] for word in WORDS for length in (1, 2, 3)] + ["note 1", "pro max", "zz"]
+    timings = []
+    for _ in range(args.lookups):
+        prefix = rng.choice(prefixes)
+        start = time.perf_counter()
+        index.lookup(prefix, 8)
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    print("top-8 lookup p50 %.1f us  p99 %.1f us  max %.1f us" % (
+        timings[len(timings) // 2] * 1e6, timings[int(len(timings) * 0.99)] * 1e6, timings[-1] * 1e6))
+
+    start = time.perf_counter()
+    for i in range(1000):
+        index.add("product", args.products + i, "new product %d" % i)
+    print("incremental add %.1f us each" % ((time.perf_counter() - start) * 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+'''Micro-benchmark for the order totals engine over large orders.
+
+    python -m benchmarks.totals [--lines 10000] [--repeat 50]
+'''
+
+import argparse
+import random
+import statistics
+import time
+
+from line_items import LineItem
+from totals import compute_totals
+
+
+def make_items(count, seed=1):
+    rng = random.Random(seed)
+    return [LineItem(product_id, "Product %d" % product_id, rng.randint(1, 2000), rng.choice((0, 0, 5, 10, 15)),
+                     rng.randint(1, 5), "black")
+            for product_id in range(1, count + 1)]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--lines", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args(argv)
+
+    items = make_items(args.lines)
+    timings = []
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        totals = compute_totals(items, "0.06")
+        timings.append(time.perf_counter() - start)
+
+    timings.sort()
+    print("lines=%d repeat=%d grand_total=%s" % (args.lines, args.repeat, totals.grand_total))
+    print("median %.3f ms  p95 %.3f ms  %.0f lines/s" % (
+        statistics.median(timings) * 1000, timings[int(len(timings) * 0.95) - 1] * 1000,
+        args.lines / statistics.median(timings)))
+
+
+if __name__ == "__main__":
+    main()
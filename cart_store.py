@@ -0,0 +1,249 @@
+'''
+    Cart store
+
+    ----------
+
+    Server-side shopping carts.
+
+    The cookie session only carries a random cart ID; the cart itself lives
+    in a store as ``product_id -> CartLine(quantity, color, price)``, where
+    price is only the price shown when the line was added, kept to spot
+    repricing. Names, images and current prices are looked up from the
+    products when the cart is displayed.
+
+    Two backends are provided:
+
+    - MemoryCartStore, an LRU dict for a single process
+    - SqliteCartStore, a SQLite table shared by every worker on the host
+
+'''
+
+from collections import OrderedDict, namedtuple
+import asyncio
+import os
+import secrets
+import sqlite3
+import threading
+import time
+
+from flask import g, session
+
+
+CartLine = namedtuple("CartLine", ["quantity", "color", "price"], defaults=(None,))
+
+
+class MemoryCartStore(object):
+    '''Keeps carts in process, dropping the least recently used ones past ``max_carts``.'''
+
+    def __init__(self, max_carts=10000):
+        self.max_carts = max_carts
+        self._carts = OrderedDict()
+        self._lock = threading.Lock()
+
+    def lines(self, cart_id):
+        with self._lock:
+            cart = self._carts.get(cart_id)
+            if cart is None:
+                return {}
+            self._carts.move_to_end(cart_id)
+            return dict(cart)
+
+    def count(self, cart_id):
+        with self._lock:
+            return len(self._carts.get(cart_id, ()))
+
+    def add(self, cart_id, product_id, quantity, color, price=None):
+        '''Adds a line unless the product is already in the cart. Returns True if added.'''
+        with self._lock:
+            cart = self._touch(cart_id)
+            if product_id in cart:
+                return False
+            cart[product_id] = CartLine(quantity, color, price)
+            return True
+
+    def update(self, cart_id, product_id, quantity, color):
+        with self._lock:
+            cart = self._touch(cart_id)
+            if product_id not in cart:
+                return False
+            cart[product_id] = cart[product_id]._replace(quantity=quantity, color=color)
+            return True
+
+    def remove(self, cart_id, product_id):
+        with self._lock:
+            self._carts.get(cart_id, {}).pop(product_id, None)
+
+    def clear(self, cart_id):
+        with self._lock:
+            self._carts.pop(cart_id, None)
+
+    def _touch(self, cart_id):
+        cart = self._carts.get(cart_id)
+        if cart is None:
+            cart = self._carts[cart_id] = {}
+            while len(self._carts) > self.max_carts:
+                self._carts.popitem(last=False)
+        else:
+            self._carts.move_to_end(cart_id)
+        return cart
+
+
+class SqliteCartStore(object):
+    '''Keeps carts in a SQLite file so every worker process sees the same cart.
+
+    Each line is one row keyed on ``(cart_id, product_id)``; carts not touched
+    for ``max_age`` seconds are purged now and then.
+    '''
+
+    def __init__(self, path, max_age=30 * 24 * 3600):
+        self.path = path
+        self.max_age = max_age
+        self._local = threading.local()
+        self._writes = 0
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with self._connection() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS cart_lines ("
+                         " cart_id TEXT NOT NULL,"
+                         " product_id INTEGER NOT NULL,"
+                         " quantity INTEGER NOT NULL,"
+                         " color TEXT,"
+                         " price INTEGER,"
+                         " updated REAL NOT NULL,"
+                         " PRIMARY KEY (cart_id, product_id)"
+                         ") WITHOUT ROWID")
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_cart_lines_updated ON cart_lines (updated)")
+            # Cart files created before prices were tracked
+            if "price" not in [column[1] for column in conn.execute("PRAGMA table_info(cart_lines)")]:
+                conn.execute("ALTER TABLE cart_lines ADD COLUMN price INTEGER")
+
+    def lines(self, cart_id):
+        rows = self._connection().execute(
+            "SELECT product_id, quantity, color, price FROM cart_lines WHERE cart_id = ?", (cart_id,))
+        return {row[0]: CartLine(*row[1:]) for row in rows}
+
+    def count(self, cart_id):
+        return self._connection().execute(
+            "SELECT count(*) FROM cart_lines WHERE cart_id = ?", (cart_id,)).fetchone()[0]
+
+    def add(self, cart_id, product_id, quantity, color, price=None):
+        '''Adds a line unless the product is already in the cart. Returns True if added.'''
+        with self._connection() as conn:
+            cursor = conn.execute("INSERT OR IGNORE INTO cart_lines"
+                                  " (cart_id, product_id, quantity, color, price, updated) VALUES (?, ?, ?, ?, ?, ?)",
+                                  (cart_id, product_id, quantity, color, price, time.time()))
+        self._maybe_purge()
+        return cursor.rowcount == 1
+
+    def update(self, cart_id, product_id, quantity, color):
+        with self._connection() as conn:
+            cursor = conn.execute("UPDATE cart_lines SET quantity = ?, color = ?, updated = ?"
+                                  " WHERE cart_id = ? AND product_id = ?",
+                                  (quantity, color, time.time(), cart_id, product_id))
+        return cursor.rowcount == 1
+
+    def remove(self, cart_id, product_id):
+        with self._connection() as conn:
+            conn.execute("DELETE FROM cart_lines WHERE cart_id = ? AND product_id = ?", (cart_id, product_id))
+
+    def clear(self, cart_id):
+        with self._connection() as conn:
+            conn.execute("DELETE FROM cart_lines WHERE cart_id = ?", (cart_id,))
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _maybe_purge(self):
+        self._writes += 1
+        if self._writes % 1000 == 0:
+            with self._connection() as conn:
+                conn.execute("DELETE FROM cart_lines WHERE updated < ?", (time.time() - self.max_age,))
+
+
+class CartStore(object):
+    '''Binds a cart backend to the current session's cart ID.
+
+    To initialize, pass your flask app's object::
+
+        cart = CartStore(app)
+
+    Config variables read from the app:
+
+        CART_STORE = 'memory'           # or 'sqlite'
+        CART_STORE_PATH = 'carts.db'    # SQLite file, for the sqlite backend
+        CART_STORE_MAX_CARTS = 10000    # carts kept by the memory backend
+
+    Templates get ``cart_count``, the number of lines in the current cart.
+    Async views count it beforehand with count_async(), into
+    ``g.cart_count``, so rendering doesn't query SQLite from the event loop.
+
+    '''
+
+    session_key = "cart_id"
+
+    def __init__(self, app=None, backend=None):
+        self.backend = backend
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        if self.backend is None:
+            if app.config.get('CART_STORE', 'memory') == 'sqlite':
+                path = app.config.get('CART_STORE_PATH') or os.path.join(app.instance_path, 'carts.db')
+                self.backend = SqliteCartStore(path)
+            else:
+                self.backend = MemoryCartStore(app.config.get('CART_STORE_MAX_CARTS', 10000))
+        app.context_processor(lambda: {"cart_count": g.cart_count if "cart_count" in g else self.count()})
+        app.extensions['cart_store'] = self
+
+    @property
+    def cart_id(self):
+        '''The current session's cart ID, or None if it has no cart yet.'''
+        return session.get(self.session_key)
+
+    def _cart_id_or_create(self):
+        if self.session_key not in session:
+            session[self.session_key] = secrets.token_urlsafe(16)
+        return session[self.session_key]
+
+    def lines(self):
+        '''Returns ``{product_id: CartLine}`` for the current cart.'''
+        if self.cart_id is None:
+            return {}
+        return self.backend.lines(self.cart_id)
+
+    def count(self):
+        if self.cart_id is None:
+            return 0
+        return self.backend.count(self.cart_id)
+
+    async def count_async(self):
+        '''count() for the async views; a store other than the in-memory one is read on a thread.'''
+        if self.cart_id is None:
+            return 0
+        if isinstance(self.backend, MemoryCartStore):
+            return self.backend.count(self.cart_id)
+        return await asyncio.to_thread(self.backend.count, self.cart_id)
+
+    def add(self, product_id, quantity, color, price=None):
+        return self.backend.add(self._cart_id_or_create(), product_id, quantity, color, price)
+
+    def update(self, product_id, quantity, color):
+        if self.cart_id is None:
+            return False
+        return self.backend.update(self.cart_id, product_id, quantity, color)
+
+    def remove(self, product_id):
+        if self.cart_id is not None:
+            self.backend.remove(self.cart_id, product_id)
+
+    def clear(self):
+        cart_id = session.pop(self.session_key, None)
+        if cart_id is not None:
+            self.backend.clear(cart_id)
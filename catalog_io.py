@@ -0,0 +1,318 @@
+'''
+    Catalog import and export
+
+    -------------------------
+
+    Bulk loading and dumping of products as CSV or JSON Lines.
+
+    ``flask catalog import`` streams the feed and never holds more than one
+    batch in memory. Brand and category names are resolved through a map
+    loaded once, creating the ones that don't exist yet. Each batch's image
+    files are copied into the upload folder by a thread pool, named by the
+    hash of their content, so an image shared by many products, or
+    imported twice, is stored once. The batch's products are then inserted
+    with one executemany in one transaction. A bad row is reported with its
+    line number and skipped.
+
+    ``flask catalog export`` streams the products with ``yield_per``, so
+    memory stays flat however large the catalog is.
+
+    The inserts bypass the ORM, so the caches that follow catalog writes
+    are refreshed once the import is done. The web workers see the import
+    through the page cache's shared catalog version, with the filesystem
+    backend, or once their caches expire.
+
+'''
+
+from concurrent.futures import ThreadPoolExecutor
+import csv
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import select
+
+
+FIELDS = ["id", "product_name", "price", "discount", "stock", "description", "colors", "brand", "category",
+          "image_1", "image_2", "image_3"]
+
+IMAGE_FIELDS = ("image_1", "image_2", "image_3")
+
+DEFAULT_IMAGE = "image.jpg"
+
+
+class RowError(ValueError):
+    '''A feed row that can't be imported.'''
+
+
+def read_rows(stream, file_format):
+    '''Yields ``(line number, dict)`` for each record of a CSV or JSONL stream.'''
+    if file_format == "csv":
+        reader = csv.DictReader(stream)
+        for row in reader:
+            yield reader.line_num, row
+        return
+    for number, line in enumerate(stream, start=1):
+        if line.strip():
+            try:
+                yield number, json.loads(line)
+            except ValueError as e:
+                yield number, RowError("invalid JSON: %s" % e)
+
+
+def copy_image(source, folder):
+    '''Copies ``source`` into ``folder`` under a name derived from its content; returns the name.'''
+    digest = hashlib.sha256()
+    handle, temporary = tempfile.mkstemp(dir=folder, suffix=".tmp")
+    try:
+        with open(source, "rb") as original, os.fdopen(handle, "wb") as output:
+            for block in iter(lambda: original.read(1024 * 1024), b""):
+                digest.update(block)
+                output.write(block)
+        name = digest.hexdigest()[:20] + os.path.splitext(source)[1].lower()
+        target = os.path.join(folder, name)
+        if os.path.exists(target):
+            os.unlink(temporary)
+        else:
+            os.replace(temporary, target)
+        return name
+    except BaseException:
+        if os.path.exists(temporary):
+            os.unlink(temporary)
+        raise
+
+
+class CatalogTransfer(object):
+    '''The ``flask catalog`` import and export commands.
+
+    To initialize, pass the database and catalog models, then your flask app's object::
+
+        CatalogTransfer(db, Product, Brand, Category, app)
+
+    Config variables read from the app:
+
+        UPLOADED_PHOTOS_DEST                  # where imported images are copied to
+        CATALOG_IMPORT_BATCH_SIZE = 1000      # products per transaction
+        CATALOG_IMAGE_WORKERS = 8             # threads copying and hashing images
+
+    '''
+
+    def __init__(self, db, product_model, brand_model, category_model, app=None):
+        self.db = db
+        self.product_model = product_model
+        self.brand_model = brand_model
+        self.category_model = category_model
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.images_folder = app.config.get('UPLOADED_PHOTOS_DEST') or os.path.join(app.static_folder, "images")
+        self.batch_size = app.config.get('CATALOG_IMPORT_BATCH_SIZE', 1000)
+        self.image_workers = app.config.get('CATALOG_IMAGE_WORKERS', 8)
+        app.cli.add_command(self._cli())
+        app.extensions['catalog_transfer'] = self
+
+    def import_rows(self, rows, image_root, create_missing=True, on_error=None, on_batch=None):
+        '''Imports ``(line number, dict)`` rows; returns ``(imported, skipped)``.
+
+        :param image_root: Directory that relative image paths in the feed are read from.
+        :param on_error: Called with the line number and the RowError of each skipped row.
+        :param on_batch: Called with the running count after each committed batch.
+        '''
+        names = {"brand": self._name_map(self.brand_model), "category": self._name_map(self.category_model)}
+        imported = skipped = 0
+        os.makedirs(self.images_folder, exist_ok=True)
+        with ThreadPoolExecutor(max_workers=self.image_workers, thread_name_prefix="catalog-images") as pool:
+            batch = []
+            for number, row in rows:
+                batch.append((number, row))
+                if len(batch) >= self.batch_size:
+                    done, failed = self._import_batch(batch, names, pool, image_root, create_missing, on_error)
+                    imported, skipped = imported + done, skipped + failed
+                    batch = []
+                    if on_batch is not None:
+                        on_batch(imported)
+            if batch:
+                done, failed = self._import_batch(batch, names, pool, image_root, create_missing, on_error)
+                imported, skipped = imported + done, skipped + failed
+        if imported:
+            self._catalog_changed()
+        return imported, skipped
+
+    def export_rows(self, chunk_size=1000):
+        '''Yields every product as a dict of FIELDS, streamed ``chunk_size`` rows at a time.'''
+        product, brand, category = self.product_model, self.brand_model, self.category_model
+        query = (select(product.id, product.product_name, product.price, product.discount, product.stock,
+                        product.description, product.colors, brand.name, category.name,
+                        product.image_1, product.image_2, product.image_3)
+                 .outerjoin(brand, brand.id == product.brand_id)
+                 .outerjoin(category, category.id == product.category_id)
+                 .order_by(product.id)
+                 .execution_options(yield_per=chunk_size))
+        for row in self.db.session.execute(query):
+            yield dict(zip(FIELDS, row))
+
+    def _name_map(self, model):
+        return {name.casefold(): id for id, name in self.db.session.execute(select(model.id, model.name))}
+
+    def _import_batch(self, batch, names, pool, image_root, create_missing, on_error):
+        parsed = []
+        for number, row in batch:
+            try:
+                if isinstance(row, RowError):
+                    raise row
+                parsed.append((number, self._parse(row)))
+            except RowError as e:
+                if on_error is not None:
+                    on_error(number, e)
+        # Copy every image of the batch at once; identical paths are copied once
+        sources = {path for _number, values in parsed for path in values["images"] if path}
+        futures = {path: pool.submit(copy_image, self._image_path(path, image_root), self.images_folder)
+                   for path in sources}
+
+        session = self.db.session
+        connection = session.connection()
+        products = []
+        for number, values in parsed:
+            try:
+                images = [self._stored_image(futures, path) for path in values.pop("images")]
+                values["brand_id"] = self._resolve(connection, names, "brand", values.pop("brand"), create_missing)
+                values["category_id"] = self._resolve(connection, names, "category", values.pop("category"),
+                                                      create_missing)
+            except RowError as e:
+                if on_error is not None:
+                    on_error(number, e)
+                continue
+            values.update(zip(IMAGE_FIELDS, images))
+            values["image_variants"] = {}
+            products.append(values)
+        if products:
+            connection.execute(self.product_model.__table__.insert(), products)
+        session.commit()
+        return len(products), len(batch) - len(products)
+
+    def _parse(self, row):
+        values = {}
+        name = (row.get("product_name") or "").strip()
+        if not name:
+            raise RowError("product_name is required")
+        values["product_name"] = name[:250]
+        for field, required in (("price", True), ("discount", False), ("stock", True)):
+            raw = row.get(field)
+            if raw in (None, ""):
+                if required:
+                    raise RowError("%s is required" % field)
+                raw = 0
+            try:
+                values[field] = int(raw)
+            except (TypeError, ValueError):
+                raise RowError("%s must be a whole number, not %r" % (field, raw))
+            if values[field] < 0:
+                raise RowError("%s can't be negative" % field)
+        values["description"] = (row.get("description") or "")[:250]
+        values["colors"] = (row.get("colors") or "")[:250]
+        values["brand"] = (row.get("brand") or "").strip()
+        values["category"] = (row.get("category") or "").strip()
+        values["images"] = [(row.get(field) or "").strip() for field in IMAGE_FIELDS]
+        return values
+
+    @staticmethod
+    def _image_path(path, image_root):
+        return path if os.path.isabs(path) else os.path.join(image_root, path)
+
+    @staticmethod
+    def _stored_image(futures, path):
+        if not path:
+            return DEFAULT_IMAGE
+        try:
+            return futures[path].result()
+        except OSError as e:
+            raise RowError("image %s: %s" % (path, e.strerror or e))
+
+    def _resolve(self, connection, names, kind, name, create_missing):
+        if not name:
+            return None
+        key = name.casefold()
+        if key not in names[kind]:
+            if not create_missing:
+                raise RowError("unknown %s %r" % (kind, name))
+            model = self.brand_model if kind == "brand" else self.category_model
+            names[kind][key] = connection.execute(
+                model.__table__.insert().values(name=name[:250])).inserted_primary_key[0]
+        return names[kind][key]
+
+    def _catalog_changed(self):
+        extensions = self.app.extensions
+        if 'page_cache' in extensions:
+            extensions['page_cache'].invalidate()
+        if 'nav_facets' in extensions:
+            extensions['nav_facets'].invalidate()
+        if 'search_suggestions' in extensions:
+            extensions['search_suggestions'].build()
+
+    def _cli(self):
+        group = AppGroup("catalog", help="Import and export the product catalog.")
+
+        @group.command("import")
+        @click.argument("source", type=click.File("r", encoding="utf-8-sig"))
+        @click.option("--format", "file_format", type=click.Choice(["csv", "jsonl"]),
+                      help="Defaults to the file extension.")
+        @click.option("--images", "image_root", type=click.Path(file_okay=False),
+                      help="Directory relative image paths are read from; defaults to the feed's.")
+        @click.option("--no-create", is_flag=True, help="Skip rows naming an unknown brand or category.")
+        @click.option("--batch-size", type=int, help="Products per transaction.")
+        def import_command(source, file_format, image_root, no_create, batch_size):
+            '''Add the products in SOURCE, a CSV or JSONL file, or - for stdin.'''
+            if file_format is None:
+                file_format = "jsonl" if source.name.endswith((".jsonl", ".ndjson")) else "csv"
+            if image_root is None:
+                image_root = os.path.dirname(os.path.abspath(source.name)) if source.name != "<stdin>" else "."
+            if batch_size:
+                self.batch_size = batch_size
+            start = time.perf_counter()
+
+            def on_error(number, error):
+                click.echo("line %d: %s" % (number, error), err=True)
+
+            def on_batch(count):
+                click.echo("%d products, %.0f rows/s" % (count, count / (time.perf_counter() - start)), err=True)
+
+            imported, skipped = self.import_rows(read_rows(source, file_format), image_root,
+                                                 create_missing=not no_create, on_error=on_error, on_batch=on_batch)
+            elapsed = time.perf_counter() - start
+            click.echo("Imported %d products, skipped %d, in %.2fs (%.0f rows/s)"
+                       % (imported, skipped, elapsed, (imported + skipped) / elapsed if elapsed else 0))
+            if imported and 'image_derivatives' in self.app.extensions:
+                click.echo("Run `flask images backfill` to generate their thumbnails.")
+
+        @group.command("export")
+        @click.argument("target", type=click.File("w", encoding="utf-8"), default="-")
+        @click.option("--format", "file_format", type=click.Choice(["csv", "jsonl"]),
+                      help="Defaults to the file extension, or CSV.")
+        def export_command(target, file_format):
+            '''Write every product to TARGET, a CSV or JSONL file; stdout by default.'''
+            if file_format is None:
+                file_format = "jsonl" if target.name.endswith((".jsonl", ".ndjson")) else "csv"
+            start = time.perf_counter()
+            count = 0
+            if file_format == "csv":
+                writer = csv.DictWriter(target, FIELDS)
+                writer.writeheader()
+                write = writer.writerow
+            else:
+                def write(row):
+                    target.write(json.dumps(row, ensure_ascii=False) + "\n")
+            for row in self.export_rows():
+                write(row)
+                count += 1
+            target.flush()
+            elapsed = time.perf_counter() - start
+            click.echo("Exported %d products in %.2fs (%.0f rows/s)"
+                       % (count, elapsed, count / elapsed if elapsed else 0), err=True)
+
+        return group
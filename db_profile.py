@@ -0,0 +1,102 @@
+'''
+    Database profile
+
+    ----------------
+
+    Engine settings for the database named by ``DATABASE_URL``.
+
+    SQLite connections are switched to write-ahead logging, so readers no
+    longer block the writer and a commit no longer waits on an fsync of the
+    rollback journal; ``synchronous=NORMAL`` is safe in WAL mode. A busy
+    timeout makes a writer wait for the lock instead of failing straight
+    away with "database is locked", and the page cache and memory-mapped
+    I/O are sized for a small catalog kept hot in memory.
+
+    Server databases get an explicitly sized connection pool, with
+    connections checked before use and recycled periodically so ones
+    dropped by the server or a proxy are never handed out.
+
+'''
+
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+
+
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "busy_timeout": 5000,                 # milliseconds
+    "cache_size": -64 * 1024,             # negative means KiB: 64 MiB
+    "mmap_size": 256 * 1024 * 1024,
+    "temp_store": "MEMORY",
+}
+
+
+def engine_options(uri, config):
+    '''Returns ``create_engine`` keyword arguments for ``uri``.'''
+    if make_url(uri).get_backend_name() == "sqlite":
+        # Python's own sqlite3 busy handler, in seconds, on top of the pragma
+        return {"connect_args": {"timeout": config.get('SQLITE_PRAGMAS', SQLITE_PRAGMAS)["busy_timeout"] / 1000}}
+    return {
+        "pool_size": config.get('DB_POOL_SIZE', 10),
+        "max_overflow": config.get('DB_MAX_OVERFLOW', 20),
+        "pool_timeout": config.get('DB_POOL_TIMEOUT', 30),
+        "pool_recycle": config.get('DB_POOL_RECYCLE', 1800),
+        "pool_pre_ping": True,
+    }
+
+
+def apply_pragmas(dbapi_connection, pragmas):
+    cursor = dbapi_connection.cursor()
+    try:
+        for name, value in pragmas.items():
+            cursor.execute("PRAGMA %s = %s" % (name, value))
+    finally:
+        cursor.close()
+
+
+class DatabaseProfile(object):
+    '''Fills in the Flask-SQLAlchemy config; initialize it before the database, then watch its engines::
+
+        profile = DatabaseProfile(app)
+        db.init_app(app)
+        with app.app_context():
+            for engine in db.engines.values():
+                profile.watch(engine)
+
+    Config variables read from the app:
+
+        DATABASE_URL = "sqlite:///shop.db"
+        SQLITE_PRAGMAS = SQLITE_PRAGMAS
+        DB_POOL_SIZE = 10
+        DB_MAX_OVERFLOW = 20
+        DB_POOL_TIMEOUT = 30           # seconds to wait for a pooled connection
+        DB_POOL_RECYCLE = 1800         # seconds before a connection is replaced
+
+    '''
+
+    def __init__(self, app=None):
+        self.pragmas = SQLITE_PRAGMAS
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        uri = app.config.get('DATABASE_URL') or "sqlite:///shop.db"
+        app.config['SQLALCHEMY_DATABASE_URI'] = uri
+        options = engine_options(uri, app.config)
+        options.update(app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {}))
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = options
+        self.pragmas = app.config.get('SQLITE_PRAGMAS', SQLITE_PRAGMAS)
+        app.extensions['database_profile'] = self
+
+    def watch(self, engine):
+        '''Applies the pragmas to every new connection of ``engine``, if it is a SQLite one.
+
+        Listening on the engine rather than on all of them keeps each app's
+        settings to its own connections, however many apps are created.
+        '''
+        if engine.dialect.name == "sqlite" and not event.contains(engine, "connect", self._on_connect):
+            event.listen(engine, "connect", self._on_connect)
+
+    def _on_connect(self, dbapi_connection, connection_record):
+        apply_pragmas(dbapi_connection, self.pragmas)
@@ -0,0 +1,201 @@
+'''
+    Navbar facets
+
+    -------------
+
+    Cached provider for the brand/category dropdowns rendered by header.html.
+
+    Only brands and categories that actually have products are listed, each
+    one exactly once and with its product count. The result is kept in
+    process, per app, and rebuilt lazily after a commit that wrote a
+    Product, Brand or Category row.
+
+    Other processes' writes, e.g. another worker's or ``flask catalog
+    import``, are seen through the page cache's catalog version, which the
+    filesystem backend shares between processes, so the cached navbar
+    fragment and the facets it is rendered from change together. With a
+    per-process page cache they show up once the cached result is
+    ``NAV_FACETS_TTL`` seconds old.
+
+    Every brand and category, with or without products, is cached the same
+    way for the product form's select fields.
+
+    Async views load the facets before they render, with get_async(), into
+    ``g.nav_facets``, which the context processor then uses instead of
+    querying from the event loop.
+
+'''
+
+from collections import namedtuple
+import threading
+import time
+
+from flask import current_app, g, has_app_context
+from sqlalchemy import event, func, inspect
+from sqlalchemy.orm import Session
+
+
+Facet = namedtuple("Facet", ["id", "name", "product_count"])
+
+
+class NavFacets(object):
+    '''Jinja context processor exposing ``brands`` and ``categories`` to every template.
+
+    To initialize, pass the models used for the lookup and then the app::
+
+        facets = NavFacets(db, Brand, Category, Product)
+        facets.init_app(app)
+
+    ``hits`` and ``misses`` count cache lookups since start-up.
+
+    Config variables read from the app:
+
+        NAV_FACETS_TTL = 60    # seconds a result is kept; None keeps it until a write is seen
+
+    '''
+
+    def __init__(self, db, brand_model, category_model, product_model):
+        self.db = db
+        self.brand_model = brand_model
+        self.category_model = category_model
+        self.product_model = product_model
+        self.version = 0
+        self.ttl = 60
+        self.hits = 0
+        self.misses = 0
+        # (key, expiry, result) of each cached lookup
+        self._cached = None
+        self._choices = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.ttl = app.config.get('NAV_FACETS_TTL', 60)
+        app.context_processor(self._context_processor)
+        # Listened for once per process; each commit is handled by its own app's NavFacets
+        for name, listener in (("before_flush", NavFacets._before_flush), ("after_commit", NavFacets._after_commit),
+                               ("after_rollback", NavFacets._after_rollback)):
+            if not event.contains(Session, name, listener):
+                event.listen(Session, name, listener)
+        app.extensions['nav_facets'] = self
+
+    def invalidate(self):
+        with self._lock:
+            self.version += 1
+
+    def get(self):
+        '''Return a ``(brands, categories)`` pair of Facet lists; must run in an app context.'''
+        key, facets = self._lookup()
+        if facets is None:
+            facets = tuple([Facet(*row) for row in self.db.session.execute(query).all()]
+                           for query in self._queries())
+            self._keep(key, facets)
+        return facets
+
+    async def get_async(self, session):
+        '''get() for the async views: a miss is read through ``session``, an AsyncSession.'''
+        key, facets = self._lookup()
+        if facets is None:
+            facets = []
+            for query in self._queries():
+                facets.append([Facet(*row) for row in (await session.execute(query)).all()])
+            facets = tuple(facets)
+            self._keep(key, facets)
+        return facets
+
+    def choices(self):
+        '''Return every brand and every category as a pair of ``(id, name)`` lists.'''
+        key = self._key()
+        cached = self._fresh(self._choices, key)
+        if cached is not None:
+            return cached
+        choices = tuple([tuple(row) for row in self.db.session.execute(
+            self.db.select(model.id, model.name).order_by(model.name)).all()]
+            for model in (self.brand_model, self.category_model))
+        with self._lock:
+            if key[0] == self.version:
+                self._choices = (key, self._expiry(), choices)
+        return choices
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "version": self.version}
+
+    def _key(self):
+        # This process's own writes, and the catalog version of the page cache, if the app has one
+        page_cache = current_app.extensions.get('page_cache')
+        return self.version, page_cache.version if page_cache is not None else None
+
+    def _expiry(self):
+        return time.monotonic() + self.ttl if self.ttl is not None else None
+
+    @staticmethod
+    def _fresh(cached, key):
+        if cached is None:
+            return None
+        cached_key, expiry, result = cached
+        if cached_key != key or (expiry is not None and expiry <= time.monotonic()):
+            return None
+        return result
+
+    def _lookup(self):
+        '''Returns ``(key, cached facets)``; the facets are None on a miss.'''
+        key = self._key()
+        cached = self._fresh(self._cached, key)
+        with self._lock:
+            if cached is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return key, cached
+
+    def _keep(self, key, facets):
+        with self._lock:
+            # Only keep the result if nothing was written while we were loading.
+            if key[0] == self.version:
+                self._cached = (key, self._expiry(), facets)
+
+    def _queries(self):
+        for model, foreign_key in ((self.brand_model, self.product_model.brand_id),
+                                   (self.category_model, self.product_model.category_id)):
+            yield (self.db.select(model.id, model.name, func.count(self.product_model.id))
+                   .join(self.product_model, model.id == foreign_key)
+                   .group_by(model.id, model.name)
+                   .order_by(model.name))
+
+    def _context_processor(self):
+        brands, categories = g.nav_facets if "nav_facets" in g else self.get()
+        return {"brands": brands, "categories": categories}
+
+    def _touches_facets(self, session):
+        watched = (self.brand_model, self.category_model, self.product_model)
+        for obj in list(session.new) + list(session.deleted):
+            if isinstance(obj, watched):
+                return True
+        for obj in session.dirty:
+            if isinstance(obj, (self.brand_model, self.category_model)):
+                return True
+            if isinstance(obj, self.product_model):
+                # Stock and price edits don't change which facets are listed.
+                attrs = inspect(obj).attrs
+                if attrs.brand_id.history.has_changes() or attrs.category_id.history.has_changes():
+                    return True
+        return False
+
+    @staticmethod
+    def _current():
+        return current_app.extensions.get('nav_facets') if has_app_context() else None
+
+    @classmethod
+    def _before_flush(cls, session, flush_context, instances):
+        facets = cls._current()
+        if facets is not None and not session.info.get("nav_facets_dirty") and facets._touches_facets(session):
+            session.info["nav_facets_dirty"] = True
+
+    @classmethod
+    def _after_commit(cls, session):
+        facets = cls._current()
+        if session.info.pop("nav_facets_dirty", False) and facets is not None:
+            facets.invalidate()
+
+    @classmethod
+    def _after_rollback(cls, session):
+        session.info.pop("nav_facets_dirty", None)
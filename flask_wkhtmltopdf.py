@@ -13,12 +13,17 @@
 # Backward compatibility for 2.7
 from __future__ import absolute_import, division, print_function, unicode_literals
 from flask import render_template, make_response
-import celery
+import asyncio
 import subprocess
 import os
 import tempfile
 
 
+def _celery_task():
+    import celery
+    return celery.Task()
+
+
 class Wkhtmltopdf(object):
     '''Wkhtmltopdf class container to use the robust wkhtmltopdf library which is
     capable of generating a PDF from HTML, CSS, and JavaScript using a modified
@@ -62,9 +67,9 @@ class Wkhtmltopdf(object):
 
     def __init__(self, app=None):
         if app is not None:
-            self._init_app(app)
+            self.init_app(app)
 
-    def _init_app(self, app):
+    def init_app(self, app):
         '''Initalizes the app with Flask-WkHTMLtoPDF.
 
         :param app: The Flask application object.
@@ -75,13 +80,14 @@ class Wkhtmltopdf(object):
         self.add_path = app.config.get('WKHTMLTOPDF_BIN_PATH', None)
         self.pdf_dir_path = app.config.get('PDF_DIR_PATH', None)
 
-    # checks to see if condition is true before applying decorator.
-    def _maybe_decorate(condition, decorator):
-        return decorator if condition else lambda x: x
+    # checks to see if condition is true before building and applying the decorator,
+    # so celery is only imported when it is used
+    def _maybe_decorate(condition, decorator_factory):
+        return decorator_factory() if condition else lambda x: x
 
-    @_maybe_decorate(use_celery, celery.Task())
+    @_maybe_decorate(use_celery, _celery_task)
     def render_template_to_pdf(self, template_name_or_list, save=False, download=False, wkhtmltopdf_args=None,
-                               **context):
+                               filename=None, **context):
         '''Renders a template from the template folder with the given
         context and produces a pdf. As this can be resource intensive, the function
         can easily be decorated with celery.task() by setting the WKHTMLTOPDF_USE_CELERY to True.
@@ -89,7 +95,8 @@ class Wkhtmltopdf(object):
         :param template_name_or_list:    The name of the template to be
                                          rendered, or an iterable with template names.
                                          The first one existing will be rendered.
-        :param save:    Specifies whether to save the temporary pdf generated. Defaults to False.
+        :param save:    Specifies whether to keep the generated pdf under PDF_DIR_PATH. Defaults to False.
+        :param filename:    Name to save the pdf under when save is True. Defaults to a random name.
         :param download:    Specifies if the pdf should be displayed in the browser
                             or downloaded as an attachment. Defaults to False (in browser).
         :param context:    The variables that should be available in the
@@ -97,75 +104,100 @@ class Wkhtmltopdf(object):
         :param wkhtmltopdf_args: Optional list of arguments to send to wkhtmltopdf (list of -- options)
         '''
 
-        # Get the system's PATH and add wkhtmltopdf to it if necessary
-        path = os.getenv("PATH")
-        if "wkhtmltopdf" not in path:
-            if self.add_path is None:
-                raise ValueError(
-                    'WKHTMLTOPDF_BIN_PATH config variable must be set in the Flask app or added to the OS PATH')
-            os.environ["PATH"] += os.pathsep + self.add_path
-
-        # render appropriate template and write to a temp file
-        rendered = render_template(template_name_or_list, **context).encode('utf-8')
-        with tempfile.NamedTemporaryFile(suffix='.html', dir=os.path.dirname(__file__), delete=False,
-                                         mode='w') as temp_html:
-            temp_html.write(rendered)
-
-        # Checks to see if the pdf directory exists and generates a random pdf name
+        # render appropriate template; wkhtmltopdf reads it from stdin
+        rendered = render_template(template_name_or_list, **context)
+        binary_pdf = self.html_to_pdf(rendered, wkhtmltopdf_args)
+
+        if save is True:
+            filename = os.path.basename(self.save_pdf(binary_pdf, filename))
+        elif filename is None:
+            filename = 'document.pdf'
+
+        response = make_response(binary_pdf)
+        response.headers['Content-Type'] = 'application/pdf'
+        if download is True:
+            response.headers['Content-Disposition'] = 'attachment; filename=%s' % filename
+        else:
+            response.headers['Content-Disposition'] = 'inline; filename=%s' % filename
+
+        return response
+
+    def save_pdf(self, binary_pdf, filename=None):
+        '''Stores a pdf under PDF_DIR_PATH and returns its path. The file is written
+        under a temporary name and then renamed, so readers never see a partial pdf.
+
+        :param binary_pdf:    The pdf bytes.
+        :param filename:    Name of the file to create. Defaults to a random name.
+        '''
+        # Checks to see if the pdf directory exists
         if self.pdf_dir_path is None:
             raise ValueError('PDF_DIR_PATH config variable must be set in the Flask app')
         if not os.path.isdir(self.pdf_dir_path):
             os.makedirs(self.pdf_dir_path)
         with tempfile.NamedTemporaryFile(suffix='.pdf', dir=self.pdf_dir_path, delete=False) as temp_pdf:
-            pass
-
-        cli_options = ""
-
-        # Parse argument list supplied and add them as options to wkhtmltopdf
-        if wkhtmltopdf_args:
-            for argument in wkhtmltopdf_args:
-                if argument.startswith('--'):
-                    cli_options += ' ' + argument
-                else:
-                    cli_options += ' --' + argument
-
-        # Run wkhtmltopdf via the appropriate subprocess call
-        wkhtmltopdfargs = "wkhtmltopdf" + cli_options + " " + temp_html.name + " " + temp_pdf.name
-
-        # A work around for python 2.6
-        try:
-            subprocess.check_output(wkhtmltopdfargs, shell=True)
-        except:
-            def check_output(*popenargs, **kwargs):
-                process = subprocess.Popen(stdout=subprocess.PIPE, *popenargs, **kwargs)
-                output, unused_err = process.communicate()
-                retcode = process.poll()
-                if retcode:
-                    cmd = kwargs.get("args")
-                    if cmd is None:
-                        cmd = popenargs[0]
-                    error = subprocess.CalledProcessError(retcode, cmd)
-                    error.output = output
-                    raise error
-                return output
-
-            subprocess.check_output = check_output
-            subprocess.check_output(wkhtmltopdfargs, shell=True)
-
-        # Remove the temporary files created
-        os.remove(temp_html.name)
-
-        with open(temp_pdf.name, 'rb') as f:
-            binary_pdf = f.read()
-
-        response = make_response(binary_pdf)
-        response.headers['Content-Type'] = 'application/pdf'
-        if download is True:
-            response.headers['Content-Disposition'] = 'attachment; filename=%s.pdf' % temp_pdf.name
+            temp_pdf.write(binary_pdf)
+        if filename is None:
+            return temp_pdf.name
+        path = os.path.join(self.pdf_dir_path, os.path.basename(filename))
+        os.replace(temp_pdf.name, path)
+        return path
+
+    def html_to_pdf(self, html, wkhtmltopdf_args=None, timeout=None):
+        '''Converts an HTML string to PDF bytes. The HTML is piped to wkhtmltopdf's
+        stdin and the PDF read back from its stdout, so no temporary files are written.
+
+        :param html:    The HTML document, as str or bytes.
+        :param wkhtmltopdf_args: Optional list of arguments to send to wkhtmltopdf (list of -- options)
+        :param timeout:    Seconds to wait for wkhtmltopdf before giving up.
+        '''
+        return run_wkhtmltopdf(html, wkhtmltopdf_args, bin_path=self.add_path, timeout=timeout)
+
+
+def run_wkhtmltopdf(html, wkhtmltopdf_args=None, bin_path=None, timeout=None):
+    '''Runs wkhtmltopdf over stdin/stdout and returns the PDF bytes.'''
+    command, html = _command(html, wkhtmltopdf_args, bin_path)
+    process = subprocess.run(command, input=html, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=timeout)
+    return _check(command[0], process.returncode, process.stdout, process.stderr)
+
+
+async def run_wkhtmltopdf_async(html, wkhtmltopdf_args=None, bin_path=None, timeout=None):
+    '''run_wkhtmltopdf() for coroutines: the process is awaited instead of blocking the thread.'''
+    command, html = _command(html, wkhtmltopdf_args, bin_path)
+    process = await asyncio.create_subprocess_exec(*command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                                   stderr=subprocess.PIPE)
+    try:
+        stdout, stderr = await asyncio.wait_for(process.communicate(html), timeout)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+        raise subprocess.TimeoutExpired(command, timeout)
+    return _check(command[0], process.returncode, stdout, stderr)
+
+
+def _command(html, wkhtmltopdf_args, bin_path):
+    executable = 'wkhtmltopdf'
+    if bin_path is not None:
+        executable = os.path.join(bin_path, 'wkhtmltopdf')
+
+    # Parse argument list supplied and add them as options to wkhtmltopdf
+    cli_options = []
+    for argument in wkhtmltopdf_args or []:
+        if argument.startswith('--'):
+            cli_options.append(argument)
         else:
-            response.headers['Content-Disposition'] = 'inline; filename=%s.pdf' % temp_pdf.name
+            cli_options.append('--' + argument)
+
+    if not isinstance(html, bytes):
+        html = html.encode('utf-8')
+
+    # '-' as input and output tells wkhtmltopdf to use stdin and stdout
+    return [executable, '--quiet'] + cli_options + ['-', '-'], html
 
-        if save is False:
-            os.remove(temp_pdf.name)
 
-        return response
\ No newline at end of file
+def _check(executable, returncode, stdout, stderr):
+    if returncode != 0 or not stdout:
+        error = subprocess.CalledProcessError(returncode, executable)
+        error.output = stdout
+        error.stderr = stderr
+        raise error
+    return stdout
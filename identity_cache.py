@@ -0,0 +1,186 @@
+'''
+    Identity cache
+
+    --------------
+
+    Cached Flask-Login identities, so a logged-in page view runs no user query.
+
+    ``current_user`` is a slim Principal holding only the id, name and email
+    that the views and templates use on every request. It is cached per
+    process and app for ``ttl`` seconds and dropped as soon as a commit changes or
+    deletes the user, e.g. a profile or password update. Anything else is
+    read from the full User row, which is loaded on first access only.
+
+'''
+
+import threading
+import time
+
+from flask import current_app, has_app_context
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+
+class Principal(object):
+    '''The logged-in user as seen by Flask-Login.'''
+
+    __slots__ = ('id', 'name', 'email', '_user', '_loader')
+
+    is_authenticated = True
+    is_active = True
+    is_anonymous = False
+
+    def __init__(self, id, name, email, loader):
+        self.id = id
+        self.name = name
+        self.email = email
+        self._user = None
+        self._loader = loader
+
+    def get_id(self):
+        return str(self.id)
+
+    @property
+    def user(self):
+        '''The full User row, loaded on first use.'''
+        if self._user is None:
+            self._user = self._loader(self.id)
+        return self._user
+
+    def __getattr__(self, name):
+        # Only reached for attributes that aren't slots, i.e. anything beyond id, name and email
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.user, name)
+
+    def __eq__(self, other):
+        return getattr(other, 'id', None) == self.id and not getattr(other, 'is_anonymous', True)
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __repr__(self):
+        return "<Principal %r>" % self.id
+
+
+class IdentityCache(object):
+    '''Loads Principals for Flask-Login's user_loader.
+
+    To initialize, pass the database and user model, then your flask app's object::
+
+        identities = IdentityCache(db, User, app)
+
+        @login_manager.user_loader
+        def load_user(user_id):
+            return identities.load(user_id)
+
+    Config variables read from the app:
+
+        IDENTITY_CACHE_TTL = 300    # seconds
+
+    '''
+
+    def __init__(self, db, user_model, app=None):
+        self.db = db
+        self.user_model = user_model
+        self.ttl = 300
+        self.hits = 0
+        self.misses = 0
+        self.full_loads = 0
+        self._entries = {}
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.ttl = app.config.get('IDENTITY_CACHE_TTL', 300)
+        for name, listener in (("before_flush", IdentityCache._before_flush),
+                               ("after_commit", IdentityCache._after_commit),
+                               ("after_rollback", IdentityCache._after_rollback)):
+            if not event.contains(Session, name, listener):
+                event.listen(Session, name, listener)
+        app.extensions['identity_cache'] = self
+
+    def load(self, user_id):
+        '''Returns the Principal for ``user_id``, or None if there is no such user.'''
+        try:
+            user_id = int(user_id)
+        except (TypeError, ValueError):
+            return None
+        principal = self._cached(user_id)
+        if principal is not None:
+            return principal
+        return self._store(user_id, self.db.session.execute(self._select(user_id)).first())
+
+    async def load_async(self, user_id, session):
+        '''load() for the async views: a miss is read through ``session``, an AsyncSession.'''
+        try:
+            user_id = int(user_id)
+        except (TypeError, ValueError):
+            return None
+        principal = self._cached(user_id)
+        if principal is not None:
+            return principal
+        return self._store(user_id, (await session.execute(self._select(user_id))).first())
+
+    def invalidate(self, user_id=None):
+        '''Forgets one user, or everyone when ``user_id`` is None.'''
+        with self._lock:
+            if user_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(int(user_id), None)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "full_loads": self.full_loads,
+                "cached": len(self._entries)}
+
+    def _cached(self, user_id):
+        with self._lock:
+            cached = self._entries.get(user_id)
+            if cached is not None and cached[0] > time.monotonic():
+                self.hits += 1
+                return Principal(*cached[1], loader=self._load_user)
+            self.misses += 1
+        return None
+
+    def _select(self, user_id):
+        model = self.user_model
+        return self.db.select(model.id, model.name, model.email).where(model.id == user_id)
+
+    def _store(self, user_id, row):
+        if row is None:
+            return None
+        with self._lock:
+            self._entries[user_id] = (time.monotonic() + self.ttl, tuple(row))
+        return Principal(*row, loader=self._load_user)
+
+    def _load_user(self, user_id):
+        with self._lock:
+            self.full_loads += 1
+        return self.db.session.get(self.user_model, user_id)
+
+    @staticmethod
+    def _current():
+        return current_app.extensions.get('identity_cache') if has_app_context() else None
+
+    @classmethod
+    def _before_flush(cls, session, flush_context, instances):
+        identities = cls._current()
+        if identities is None:
+            return
+        for obj in list(session.dirty) + list(session.deleted):
+            if isinstance(obj, identities.user_model):
+                session.info.setdefault("identity_changes", set()).add(obj.id)
+
+    @classmethod
+    def _after_commit(cls, session):
+        changes = session.info.pop("identity_changes", ())
+        identities = cls._current()
+        if identities is not None:
+            for user_id in changes:
+                identities.invalidate(user_id)
+
+    @classmethod
+    def _after_rollback(cls, session):
+        session.info.pop("identity_changes", None)
@@ -0,0 +1,226 @@
+'''
+    Image derivatives
+
+    -----------------
+
+    Resized and WebP copies of uploaded product photos.
+
+    For every width in ``IMAGE_WIDTHS`` that is narrower than the original,
+    a thumbnail in the original's format and a WebP version are written
+    under ``static/<IMAGE_DERIVATIVES_FOLDER>``. Resizing runs in a process
+    pool so neither uploads nor the web workers wait on it; when a product's
+    images are done their paths are recorded in ``Product.image_variants``.
+    The pool's processes are spawned rather than forked, since a fork of a
+    threaded server can copy a lock another thread holds. Results are
+    written by a single thread, each in its own app context and session.
+    Until then, and when Pillow isn't installed, templates keep serving the
+    original.
+
+    ``flask images backfill`` generates the derivatives for products that
+    don't have them yet.
+
+'''
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from importlib.util import find_spec
+import multiprocessing
+import os
+import tempfile
+import threading
+
+import click
+from flask import current_app, url_for
+from flask.cli import AppGroup
+from sqlalchemy.orm import Session
+
+
+def render_variants(static_folder, images_folder, folder, name, widths, quality=82):
+    '''Writes the derivatives of one original and returns ``{format: {width: path}}``.
+
+    Paths are relative to the static folder. Runs in a pool worker process,
+    the only place Pillow is imported.
+    '''
+    from PIL import Image, ImageOps, features
+
+    stem, extension = os.path.splitext(name)
+    source_format = "PNG" if extension.lower() == ".png" else "JPEG"
+    formats = [(source_format.lower(), source_format, ".png" if source_format == "PNG" else ".jpg")]
+    if features.check("webp"):
+        formats.append(("webp", "WEBP", ".webp"))
+
+    variants = {}
+    with Image.open(os.path.join(static_folder, images_folder, name)) as original:
+        image = ImageOps.exif_transpose(original)
+        for width in sorted(widths):
+            if width >= image.width:
+                break
+            height = max(1, round(image.height * width / image.width))
+            resized = image.resize((width, height), Image.LANCZOS)
+            for key, image_format, suffix in formats:
+                frame = resized
+                if image_format == "JPEG" and frame.mode not in ("RGB", "L"):
+                    frame = frame.convert("RGB")
+                path = "%s/%s-%d%s" % (folder, stem, width, suffix)
+                _save(frame, os.path.join(static_folder, path), image_format, quality)
+                variants.setdefault(key, {})[str(width)] = path
+    return variants
+
+
+def _save(image, path, image_format, quality):
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    # Write to a temporary file first so a half-written image is never served
+    handle, temporary = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(handle, "wb") as output:
+            image.save(output, image_format, quality=quality, optimize=True)
+        os.replace(temporary, path)
+    except BaseException:
+        os.unlink(temporary)
+        raise
+
+
+def render_product(static_folder, images_folder, folder, names, widths):
+    '''Renders every image of a product; returns ``{name: variants}``, skipping unreadable files.'''
+    rendered = {}
+    for name in names:
+        try:
+            rendered[name] = render_variants(static_folder, images_folder, folder, name, widths)
+        except (OSError, ValueError):
+            continue
+    return rendered
+
+
+class ImageDerivatives(object):
+    '''Generates product image derivatives in the background.
+
+    To initialize, pass the database and product model, then your flask app's object::
+
+        images = ImageDerivatives(db, Product, app)
+
+    The model needs ``image_1`` to ``image_3`` and a JSON ``image_variants`` column.
+
+    Config variables read from the app:
+
+        IMAGE_WIDTHS = (160, 320, 640)        # thumbnail widths in pixels
+        IMAGE_WORKERS = 2                     # resizing processes
+        IMAGE_DERIVATIVES_FOLDER = "derived"  # under the static folder
+
+    '''
+
+    fields = ("image_1", "image_2", "image_3")
+
+    def __init__(self, db, product_model, app=None, images_folder="images"):
+        self.db = db
+        self.product_model = product_model
+        self.images_folder = images_folder
+        self.enabled = find_spec("PIL") is not None
+        self._pool = None
+        self._writer = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.widths = tuple(app.config.get('IMAGE_WIDTHS', (160, 320, 640)))
+        self.workers = app.config.get('IMAGE_WORKERS', 2)
+        self.folder = app.config.get('IMAGE_DERIVATIVES_FOLDER', "derived")
+        self.static_folder = app.static_folder
+        app.add_template_global(self.srcset, "image_srcset")
+        app.cli.add_command(self._cli())
+        app.extensions['image_derivatives'] = self
+
+    def submit(self, product):
+        '''Queues the derivatives of ``product``'s images; returns the Future, or None without Pillow.'''
+        if not self.enabled:
+            return None
+        names = [name for name in dict.fromkeys(getattr(product, field) for field in self.fields) if name]
+        future = self._executor().submit(render_product, self.static_folder, self.images_folder, self.folder,
+                                         names, self.widths)
+        product_id = product.id
+        writer = self._writer
+        # Called on the pool's own thread, which should only hand the result on
+        future.add_done_callback(lambda done: writer.submit(self._record, product_id, done))
+        return future
+
+    def srcset(self, name, variants, image_format=None):
+        '''Returns a ``srcset`` value for the image ``name``, or "" if it has no derivatives yet.
+
+        :param variants: The product's ``image_variants``.
+        :param image_format: "webp", or None for the original's format.
+        '''
+        by_format = (variants or {}).get(name)
+        if not by_format:
+            return ""
+        if image_format is None:
+            image_format = next((key for key in by_format if key != "webp"), None)
+        paths = by_format.get(image_format)
+        if not paths:
+            return ""
+        assets = current_app.extensions.get('assets')
+        url = assets.url if assets is not None else lambda filename: url_for('static', filename=filename)
+        return ", ".join("%s %sw" % (url(path), width)
+                         for width, path in sorted(paths.items(), key=lambda item: int(item[0])))
+
+    def shutdown(self):
+        with self._lock:
+            if self._pool is not None:
+                # Every done callback has run once the pool is shut down, so the writer has all the results
+                self._pool.shutdown(wait=True)
+                self._writer.shutdown(wait=True)
+                self._pool = None
+                self._writer = None
+
+    def _executor(self):
+        # Started on first use, so importing the app doesn't spawn processes
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=self.workers,
+                                                 mp_context=multiprocessing.get_context("spawn"))
+                self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="image-variants")
+            return self._pool
+
+    def _record(self, product_id, future):
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            self.app.logger.warning("Image derivatives failed for product %s: %r", product_id, future.exception())
+            return
+        model = self.product_model
+        with self.app.app_context(), Session(self.db.engine) as session:
+            product = session.get(model, product_id)
+            if product is None:
+                return
+            variants = dict(product.image_variants or {})
+            variants.update(future.result())
+            product.image_variants = variants
+            session.commit()
+
+    def _cli(self):
+        group = AppGroup("images", help="Manage product image derivatives.")
+
+        @group.command("backfill")
+        @click.option("--all", "everything", is_flag=True, help="Regenerate products that already have them.")
+        def backfill(everything):
+            '''Generate thumbnails and WebP copies of existing product images.'''
+            if not self.enabled:
+                raise click.ClickException("Generating image derivatives needs Pillow.")
+            model = self.product_model
+            futures = []
+            last_id = 0
+            while True:
+                products = self.db.session.execute(
+                    self.db.select(model).where(model.id > last_id).order_by(model.id).limit(500)
+                ).scalars().all()
+                if not products:
+                    break
+                futures.extend(self.submit(product) for product in products
+                               if everything or not product.image_variants)
+                last_id = products[-1].id
+            for future in futures:
+                future.exception()
+            self.shutdown()
+            click.echo("Generated derivatives for %d products" % len(futures))
+
+        return group
@@ -0,0 +1,234 @@
+'''
+    Inventory
+
+    ---------
+
+    Stock reservations for checkout.
+
+    Placing an order takes its stock with one conditional UPDATE per
+    product, ``stock = stock - qty WHERE id = ? AND stock >= qty``, in the
+    order's own transaction. The database does the check and the write
+    atomically, so concurrent checkouts never oversell and never wait on
+    each other's reads; if any line can't be covered the whole order rolls
+    back. Products are updated in id order so two checkouts can't deadlock.
+
+    Each reservation is held for ``INVENTORY_HOLD_TTL`` seconds. When the
+    order is paid its reservations are committed; held ones that expire,
+    i.e. abandoned checkouts, and those of deleted orders are released and
+    their stock is put back. An order paid after its hold expired takes its
+    stock again if it can; reservations it can't retake are marked "short"
+    for someone to look at.
+
+    The updates bypass the ORM, so the page cache is invalidated here when
+    a commit changes stock.
+
+'''
+
+from collections import Counter
+from datetime import datetime, timedelta
+import threading
+import time
+
+import click
+from flask import current_app, has_app_context
+from flask.cli import AppGroup
+from sqlalchemy import event, inspect, select
+from sqlalchemy.orm import Session
+
+from sales_rollups import PAID
+
+
+HELD = "held"
+COMMITTED = "committed"
+RELEASED = "released"
+SHORT = "short"
+
+
+class OutOfStock(Exception):
+    '''Raised by Inventory.reserve() when a product doesn't have the quantity asked for.'''
+
+    def __init__(self, product_id, quantity):
+        super().__init__("Product %s has fewer than %d in stock" % (product_id, quantity))
+        self.product_id = product_id
+        self.quantity = quantity
+
+
+class Inventory(object):
+    '''Reserves, commits and releases product stock.
+
+    To initialize, pass the database, product, reservation and order models, then your flask app's object::
+
+        inventory = Inventory(db, Product, StockReservation, CustomerOrder, app)
+
+        inventory.reserve(order.id, [(product_id, quantity), ...])
+        db.session.commit()
+
+    Config variables read from the app:
+
+        INVENTORY_HOLD_TTL = 900          # seconds an unpaid order keeps its stock
+        INVENTORY_SWEEP_INTERVAL = 60     # seconds between releases of expired holds
+
+    '''
+
+    def __init__(self, db, product_model, reservation_model, order_model, app=None):
+        self.db = db
+        self.product_model = product_model
+        self.reservation_model = reservation_model
+        self.order_model = order_model
+        self.ttl = 900
+        self.sweep_interval = 60
+        self._next_sweep = 0
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.ttl = app.config.get('INVENTORY_HOLD_TTL', 900)
+        self.sweep_interval = app.config.get('INVENTORY_SWEEP_INTERVAL', 60)
+        for name, listener in (("before_flush", Inventory._before_flush), ("after_commit", Inventory._after_commit),
+                               ("after_rollback", Inventory._after_rollback)):
+            if not event.contains(Session, name, listener):
+                event.listen(Session, name, listener)
+        app.cli.add_command(self._cli())
+        app.extensions['inventory'] = self
+
+    def reserve(self, order_id, lines):
+        '''Takes the stock for ``lines``, ``(product_id, quantity)`` pairs, in the current transaction.
+
+        Nothing is committed; commit or roll back with the order.
+
+        :raises OutOfStock: for the first product short of stock. The
+                            transaction must then be rolled back.
+        :raises ValueError: for a quantity below 1, before anything is written.
+        '''
+        wanted = Counter()
+        for product_id, quantity in lines:
+            # A negative quantity would put stock back, and lower the order's total
+            if int(quantity) <= 0:
+                raise ValueError("Quantity %r for product %s is not positive" % (quantity, product_id))
+            wanted[int(product_id)] += int(quantity)
+        session = self.db.session
+        # Expired holds are released in the same transaction, so their stock is available here
+        if self._sweep_due():
+            self._release(session, self.reservation_model.expires_at < datetime.utcnow())
+        connection = session.connection()
+        products = self.product_model.__table__
+        for product_id in sorted(wanted):
+            quantity = wanted[product_id]
+            taken = connection.execute(
+                products.update()
+                .where(products.c.id == product_id, products.c.stock >= quantity)
+                .values(stock=products.c.stock - quantity)
+            ).rowcount
+            if taken != 1:
+                raise OutOfStock(product_id, quantity)
+        now = datetime.utcnow()
+        connection.execute(self.reservation_model.__table__.insert(), [
+            {"order_id": order_id, "product_id": product_id, "quantity": quantity, "status": HELD,
+             "expires_at": now + timedelta(seconds=self.ttl), "created_at": now}
+            for product_id, quantity in sorted(wanted.items())])
+        session.info["inventory_changed"] = True
+
+    def release(self, order_id):
+        '''Puts back the stock an unpaid order still holds, in the current transaction; returns the count.'''
+        return self._release(self.db.session, self.reservation_model.order_id == order_id)
+
+    def release_expired(self):
+        '''Releases every expired hold and commits; returns the count.'''
+        count = self._release(self.db.session, self.reservation_model.expires_at < datetime.utcnow())
+        self.db.session.commit()
+        return count
+
+    def _sweep_due(self):
+        now = time.monotonic()
+        with self._lock:
+            if now < self._next_sweep:
+                return False
+            self._next_sweep = now + self.sweep_interval
+            return True
+
+    def _release(self, session, condition):
+        connection = session.connection()
+        reservations = self.reservation_model.__table__
+        products = self.product_model.__table__
+        model = self.reservation_model
+        held = connection.execute(
+            select(model.id, model.product_id, model.quantity).where(model.status == HELD, condition)
+        ).all()
+        released = 0
+        for reservation_id, product_id, quantity in held:
+            # Only the transaction that flips the reservation gives the stock back
+            if connection.execute(
+                    reservations.update().where(reservations.c.id == reservation_id, reservations.c.status == HELD)
+                    .values(status=RELEASED)).rowcount != 1:
+                continue
+            connection.execute(products.update().where(products.c.id == product_id)
+                               .values(stock=products.c.stock + quantity))
+            released += 1
+        if released:
+            session.info["inventory_changed"] = True
+        return released
+
+    def _commit(self, session, order_id):
+        connection = session.connection()
+        reservations = self.reservation_model.__table__
+        products = self.product_model.__table__
+        connection.execute(reservations.update()
+                           .where(reservations.c.order_id == order_id, reservations.c.status == HELD)
+                           .values(status=COMMITTED))
+        # Holds that expired before the payment came through
+        released = connection.execute(
+            select(reservations.c.id, reservations.c.product_id, reservations.c.quantity)
+            .where(reservations.c.order_id == order_id, reservations.c.status == RELEASED)
+        ).all()
+        for reservation_id, product_id, quantity in released:
+            taken = connection.execute(
+                products.update().where(products.c.id == product_id, products.c.stock >= quantity)
+                .values(stock=products.c.stock - quantity)
+            ).rowcount == 1
+            connection.execute(reservations.update().where(reservations.c.id == reservation_id)
+                               .values(status=COMMITTED if taken else SHORT))
+            if not taken:
+                self.app.logger.warning("Order %s was paid but product %s is out of stock", order_id, product_id)
+        if released:
+            session.info["inventory_changed"] = True
+
+    @staticmethod
+    def _current():
+        return current_app.extensions.get('inventory') if has_app_context() else None
+
+    @classmethod
+    def _before_flush(cls, session, flush_context, instances):
+        inventory = cls._current()
+        if inventory is None:
+            return
+        for obj in session.dirty:
+            if isinstance(obj, inventory.order_model):
+                history = inspect(obj).attrs.status.history
+                if history.has_changes() and obj.status == PAID:
+                    inventory._commit(session, obj.id)
+        for obj in session.deleted:
+            if isinstance(obj, inventory.order_model):
+                inventory._release(session, inventory.reservation_model.order_id == obj.id)
+
+    @classmethod
+    def _after_commit(cls, session):
+        if session.info.pop("inventory_changed", False) and has_app_context():
+            page_cache = current_app.extensions.get('page_cache')
+            if page_cache is not None:
+                page_cache.invalidate()
+
+    @classmethod
+    def _after_rollback(cls, session):
+        session.info.pop("inventory_changed", None)
+
+    def _cli(self):
+        group = AppGroup("inventory", help="Manage stock reservations.")
+
+        @group.command("release-expired")
+        def release_expired():
+            '''Put back the stock of unpaid orders whose hold has expired.'''
+            click.echo("Released %d expired reservations" % self.release_expired())
+
+        return group
@@ -0,0 +1,162 @@
+'''
+    Line items
+
+    ----------
+
+    Typed cart and order lines, hydrated in bulk.
+
+    Every product referenced by a cart or an order is loaded with a single
+    ``Product.id IN (...)`` query that also eager-loads its brand and
+    category. While building the lines the current product is compared with
+    what the customer saw, so price and stock drift are flagged in the same
+    pass.
+
+    Orders keep their lines in the ``order_items`` table. Orders placed
+    before that table existed, and not yet backfilled, still carry them as
+    a JSON snapshot; both read into the same LineItems.
+
+'''
+
+from sqlalchemy.orm import joinedload
+
+from totals import format_cents
+
+
+def display_price(cents):
+    '''An order line's unit price for display: whole dollars as before, otherwise dollars and cents.'''
+    return cents // 100 if cents % 100 == 0 else format_cents(cents)
+
+
+class LineItem(object):
+    '''One product line of a cart or order, as rendered by carts.html, order.html and pdf.html.'''
+
+    __slots__ = ('product_id', 'name', 'price', 'unit_price_cents', 'discount', 'quantity', 'color', 'image',
+                 'image_variants', 'colors', 'stock', 'brand', 'category', 'price_changed', 'out_of_stock')
+
+    def __init__(self, product_id, name, price, discount, quantity, color, image=None, colors="",
+                 stock=None, brand=None, category=None, price_changed=False, out_of_stock=False,
+                 unit_price_cents=None, image_variants=None):
+        self.product_id = product_id
+        self.name = name
+        self.price = price
+        self.unit_price_cents = int(price) * 100 if unit_price_cents is None else unit_price_cents
+        self.discount = discount
+        self.quantity = quantity
+        self.color = color
+        self.image = image
+        self.image_variants = image_variants
+        self.colors = colors
+        self.stock = stock
+        self.brand = brand
+        self.category = category
+        self.price_changed = price_changed
+        self.out_of_stock = out_of_stock
+
+    def to_order_row(self, order_id):
+        '''The ``order_items`` row stored with an order.'''
+        return {'order_id': order_id, 'product_id': self.product_id, 'product_name': self.name,
+                'unit_price_cents': self.unit_price_cents, 'discount': self.discount or 0,
+                'quantity': self.quantity, 'color': self.color}
+
+    def __repr__(self):
+        return "<LineItem %r x%r>" % (self.product_id, self.quantity)
+
+
+class LineItemLoader(object):
+    '''Builds LineItem lists for carts and orders.
+
+    To initialize, pass the database and the product model::
+
+        line_items = LineItemLoader(db, Product)
+
+    '''
+
+    def __init__(self, db, product_model):
+        self.db = db
+        self.product_model = product_model
+
+    def products(self, product_ids):
+        '''Returns ``{id: Product}`` for ``product_ids`` in one query, with brand and category loaded.'''
+        if not product_ids:
+            return {}
+        rows = self.db.session.execute(self._products_query(product_ids)).scalars()
+        return {product.id: product for product in rows}
+
+    def _products_query(self, product_ids):
+        model = self.product_model
+        return (self.db.select(model)
+                .where(model.id.in_(list(product_ids)))
+                .options(joinedload(model.brand), joinedload(model.category)))
+
+    def for_cart(self, lines):
+        '''Hydrates ``{product_id: CartLine}`` from the cart store, in cart order.
+
+        Products that no longer exist are dropped. ``price_changed`` is set when
+        the price differs from the one shown when the product was added.
+        '''
+        products = self.products(lines)
+        items = []
+        for product_id, line in lines.items():
+            product = products.get(product_id)
+            if product is None:
+                continue
+            items.append(LineItem(
+                product_id, product.product_name, product.price, product.discount, line.quantity, line.color,
+                image=product.image_1, image_variants=product.image_variants, colors=product.colors,
+                stock=product.stock,
+                brand=product.brand, category=product.category,
+                price_changed=line.price is not None and line.price != product.price,
+                out_of_stock=product.stock < line.quantity,
+            ))
+        return items
+
+    def for_order(self, order):
+        '''Hydrates the lines of a CustomerOrder.
+
+        Prices, names and discounts come from what was stored with the order,
+        so an order always shows what was ordered; ``price_changed`` flags
+        lines whose product has been repriced since.
+        '''
+        rows = self._order_rows(order)
+        return self._order_lines(rows, self.products([row[0] for row in rows]))
+
+    async def for_order_async(self, order, session):
+        '''for_order() for the async views, querying through ``session``, an AsyncSession.
+
+        The order's ``items`` must already be loaded, e.g. with ``selectinload``.
+        '''
+        rows = self._order_rows(order)
+        products = {}
+        if rows:
+            result = await session.execute(self._products_query([row[0] for row in rows]))
+            products = {product.id: product for product in result.scalars()}
+        return self._order_lines(rows, products)
+
+    @staticmethod
+    def _order_rows(order):
+        rows = [(row.product_id, row.product_name, row.unit_price_cents, row.discount, row.quantity, row.color)
+                for row in order.items]
+        if not rows and order.orders:
+            rows = [(int(key), line['name'], int(line['price']) * 100, line['discount'],
+                     int(line['quantity']), line['color'])
+                    for key, line in order.orders.items()]
+        return rows
+
+    @staticmethod
+    def _order_lines(rows, products):
+        items = []
+        for product_id, name, unit_price_cents, discount, quantity, color in rows:
+            product = products.get(product_id)
+            items.append(LineItem(
+                product_id, name, display_price(unit_price_cents), discount, quantity, color,
+                unit_price_cents=unit_price_cents,
+                image=product.image_1 if product else None,
+                image_variants=product.image_variants if product else None,
+                colors=product.colors if product else "",
+                stock=product.stock if product else 0,
+                brand=product.brand if product else None,
+                category=product.category if product else None,
+                price_changed=product is not None and product.price * 100 != unit_price_cents,
+                out_of_stock=product is None or product.stock < quantity,
+            ))
+        return items
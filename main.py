@@ -1,22 +1,42 @@
 
-from flask import Flask, session, render_template, request, redirect, url_for, flash, send_from_directory, make_response
+from flask import Flask, current_app, g, session, render_template, request, redirect, url_for, flash, send_from_directory, make_response, jsonify, abort, send_file
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.orm import relationship, DeclarativeBase, Mapped, mapped_column
+from sqlalchemy.orm import relationship, DeclarativeBase, Mapped, mapped_column, selectinload
 from flask_bootstrap import Bootstrap5
-from sqlalchemy import Integer, String, Boolean, Text, Column, ForeignKey, DateTime
+from sqlalchemy import Integer, String, Boolean, Text, Column, ForeignKey, Date, DateTime, Index, UniqueConstraint, text
 from flask_login import UserMixin, login_user, LoginManager, current_user, logout_user, login_required
-from werkzeug.security import generate_password_hash, check_password_hash
 from forms import RegistrationForm, LoginForm, AddBrand, AddCategory
 from flask_uploads import IMAGES, UploadSet, configure_uploads
+from werkzeug.local import LocalProxy
 import secrets
-import stripe
+from functools import partial, wraps
 # To convert html page to pdf
-import pdfkit
 from flask_wkhtmltopdf import Wkhtmltopdf
+from pdf_render import PdfRenderService, QueueFull
+from pdf_cache import PdfCache
+from facets import NavFacets
+from cart_store import CartStore
+from line_items import LineItemLoader
+from pagination import KeysetPaginator, InvalidCursor
+from search_index import ProductSearch
+from suggest import SearchSuggestions
+from totals import TotalsCache, compute_totals, format_cents
+from sales_rollups import SalesRollups
+from image_derivatives import ImageDerivatives
+from assets import Assets
+from page_cache import PageCache
+from db_profile import DatabaseProfile
+from identity_cache import IdentityCache
+from password_hashing import PasswordHasher, HashingBusy
+from payments import Payments, IN_PROGRESS, SUCCEEDED
+from inventory import Inventory, OutOfStock
+from catalog_io import CatalogTransfer
+from metrics import Metrics
+from async_serving import AsyncServing
 # from setup import setup
 
-from flask_msearch import Search
 from flask_migrate import Migrate
+import asyncio
 import json
 
 from flask_wtf import FlaskForm
@@ -25,42 +45,71 @@ from wtforms import FileField
 from flask_wtf.file import FileRequired, FileAllowed
 from wtforms.validators import DataRequired, URL, Email
 from datetime import datetime, date
+from typing import Optional
 
 
 import os
 
 
 publishable_key = os.environ.get("publishable_key", "dev")
-stripe.api_key = os.environ.get("secret_key", "dev")
 
 basedir = os.path.abspath(os.path.dirname(__file__))
-app = Flask(__name__)
-app.config['SECRET_KEY'] = os.environ.get("FlaskConfigKey", "dev")
 
-# Initialize wkhtmltopdf
-wkhtmltopdf = Wkhtmltopdf(app)
-# config = pdfkit.configuration()
+# Extensions that keep state, such as caches, pools and renderers, are created per app by
+# create_app() and kept in app.extensions; the views reach the current app's through these
 
 
-# Set destination for uploaded images
-app.config["UPLOADED_PHOTOS_DEST"] = os.path.join(basedir, "static/images")
+def extension(name):
+    return LocalProxy(lambda: current_app.extensions[name])
+
+
+# Request latency, SQL and template time at /metrics, in the Prometheus text format
+metrics = extension('metrics')
+
+# Invoice PDFs are rendered by a bounded worker pool, off the request thread
+pdf_renderer = extension('pdf_renderer')
+# Rendered invoices are kept on disk, keyed on the order's current state
+pdf_cache = extension('pdf_cache')
+
+# Order totals never change once placed, so they are cached per invoice
+order_totals = extension('order_totals')
+
+# Shopping carts are kept server side; the session only holds the cart ID
+cart = extension('cart_store')
+
 photos = UploadSet('photos', IMAGES)
-configure_uploads(app, photos)
 
+bootstrap = Bootstrap5()
 
-Bootstrap5(app)
+# Static files are linked by content hash and cached by browsers for a year; `flask assets build`
+assets = extension('assets')
 
 
 # Configure Flask-Login's Login Manager
 login_manager = LoginManager()
-login_manager.init_app(app)
 login_manager.login_message = "Please login first"
 
+# Passwords are hashed on a bounded pool; hashes with outdated settings are upgraded at login
+passwords = extension('password_hasher')
+
+
+def hashing_busy(template, form):
+    flash("We are handling a lot of sign-ins right now, please try again in a moment.", "danger")
+    response = make_response(render_template(template, form=form, current_user=current_user, datetime=datetime), 503)
+    response.headers['Retry-After'] = '5'
+    return response
 
-# Create a user_loader callback
-@login_manager.user_loader
-def load_user(user_id):
-    return db.get_or_404(User, user_id)
+
+def admin_required(view):
+    @wraps(view)
+    def decorated(*args, **kwargs):
+        if not current_user.is_authenticated:
+            return login_manager.unauthorized()
+        admins = {email.strip().lower() for email in current_app.config['ADMIN_EMAILS'].split(",") if email.strip()}
+        if current_user.email.lower() not in admins:
+            abort(403)
+        return view(*args, **kwargs)
+    return decorated
 
 
 # CREATE DB
@@ -68,17 +117,13 @@ class Base(DeclarativeBase):
     pass
 
 
-# Connect to Database
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///shop.db'
 db = SQLAlchemy(model_class=Base)
-# Initialize the database
-db.init_app(app)
 
 
-# Create and initialize the search app
-search = Search(db=db)
-search.init_app(app)
-migrate = Migrate(app, db)
+# Schema changes are managed with Alembic: `flask db upgrade` creates and updates the tables.
+# Batch mode lets SQLite alter tables. The FTS index has no model, so autogenerate must leave its tables alone.
+migrate = Migrate(directory=os.path.join(basedir, "migrations"), render_as_batch=True,
+                  include_name=lambda name, type_, parent_names: not (name or "").startswith("products_fts"))
 
 
 # CREATE USER TABLE IN DB with the UserMixin
@@ -87,7 +132,7 @@ class User(UserMixin, db.Model):
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     name: Mapped[str] = mapped_column(String(1000))
     email: Mapped[str] = mapped_column(String(100), unique=True)
-    password: Mapped[str] = mapped_column(String(100))
+    password: Mapped[str] = mapped_column(String(255))
     country: Mapped[str] = mapped_column(String(100))
     state: Mapped[str] = mapped_column(String(100))
     city: Mapped[str] = mapped_column(String(100))
@@ -102,10 +147,6 @@ class User(UserMixin, db.Model):
     #     return "<User %r>" % self.name
 
 
-with app.app_context():
-    db.create_all()
-
-
 class jsonEncodedDict(db.TypeDecorator):
     impl = db.Text
 
@@ -123,16 +164,82 @@ class jsonEncodedDict(db.TypeDecorator):
 
 # Create the customer order table in the database.
 class CustomerOrder(db.Model):
+    # Orders are always looked up by their customer and invoice
+    __table_args__ = (
+        Index("ix_customer_order_customer_id_invoice", "customer_id", "invoice"),
+    )
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     invoice: Mapped[str] = mapped_column(String(100), nullable=False, unique=True)
     status: Mapped[str] = mapped_column(String(100), nullable=False, default="Pending")
-    customer_id: Mapped[str] = mapped_column(String(100), nullable=False, unique=False)
+    customer_id: Mapped[int] = mapped_column(Integer, ForeignKey("users.id", name="fk_customer_order_customer_id_users"),
+                                             nullable=False)
     date_created: Mapped[str] = mapped_column(DateTime, nullable=False, default=datetime.utcnow)
+    # Legacy JSON snapshot of the lines; new orders store them in order_items
     orders: Mapped[str] = mapped_column(jsonEncodedDict)
+    items = relationship("OrderItem", back_populates="order", order_by="OrderItem.id",
+                         cascade="all, delete-orphan", passive_deletes=True)
 
     # def __repr__(self):
     #     return "<CustomerOrder %r>" % self.invoice
 
+
+# Create the order line items table in the database.
+class OrderItem(db.Model):
+    __tablename__ = "order_items"
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    order_id: Mapped[int] = mapped_column(Integer, ForeignKey("customer_order.id", ondelete="CASCADE"),
+                                          nullable=False, index=True)
+    order = relationship("CustomerOrder", back_populates="items")
+    # No foreign key: the line keeps its snapshot after the product is deleted
+    product_id: Mapped[int] = mapped_column(Integer, nullable=False, index=True)
+    product_name: Mapped[str] = mapped_column(String(250), nullable=False)
+    unit_price_cents: Mapped[int] = mapped_column(Integer, nullable=False)
+    discount: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    quantity: Mapped[int] = mapped_column(Integer, nullable=False)
+    # Lines backfilled from legacy orders can have no color
+    color: Mapped[Optional[str]] = mapped_column(String(250), nullable=True)
+
+
+# Create the payment attempts table in the database; see payments.py for the states.
+class PaymentAttempt(db.Model):
+    __tablename__ = "payment_attempts"
+    # A concurrent second attempt for the same order fails here instead of charging twice
+    __table_args__ = (
+        UniqueConstraint("order_id", "number", name="uq_payment_attempts_order_id_number"),
+    )
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    order_id: Mapped[int] = mapped_column(Integer, ForeignKey("customer_order.id", ondelete="CASCADE"),
+                                          nullable=False, index=True)
+    number: Mapped[int] = mapped_column(Integer, nullable=False)
+    idempotency_key: Mapped[str] = mapped_column(String(150), nullable=False, unique=True)
+    status: Mapped[str] = mapped_column(String(20), nullable=False, default="created", index=True)
+    amount_cents: Mapped[int] = mapped_column(Integer, nullable=False)
+    currency: Mapped[str] = mapped_column(String(3), nullable=False)
+    token: Mapped[str] = mapped_column(String(255), nullable=True)
+    email: Mapped[str] = mapped_column(String(250), nullable=True)
+    charge_id: Mapped[str] = mapped_column(String(100), nullable=True, index=True)
+    error: Mapped[str] = mapped_column(String(500), nullable=True)
+    created_at: Mapped[datetime] = mapped_column(DateTime, nullable=False, default=datetime.utcnow)
+    updated_at: Mapped[datetime] = mapped_column(DateTime, nullable=False, default=datetime.utcnow)
+
+
+# Create the stock reservations table in the database; see inventory.py for the states.
+class StockReservation(db.Model):
+    __tablename__ = "stock_reservations"
+    # Expired holds are found by status and expiry
+    __table_args__ = (
+        Index("ix_stock_reservations_status_expires_at", "status", "expires_at"),
+    )
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    order_id: Mapped[int] = mapped_column(Integer, ForeignKey("customer_order.id", ondelete="CASCADE"),
+                                          nullable=False, index=True)
+    # No foreign key, like order_items
+    product_id: Mapped[int] = mapped_column(Integer, nullable=False)
+    quantity: Mapped[int] = mapped_column(Integer, nullable=False)
+    status: Mapped[str] = mapped_column(String(20), nullable=False, default="held")
+    expires_at: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+    created_at: Mapped[datetime] = mapped_column(DateTime, nullable=False, default=datetime.utcnow)
+
 # Create the product brand table in the database
 class Brand(db.Model):
     __tablename__ = "brands"
@@ -150,15 +257,19 @@ class Category(db.Model):
     products = relationship("Product", back_populates="category")
 
 
-with app.app_context():
-    db.create_all()
-
-
 # Create the product table in the database.
 class Product(db.Model):
 
     __tablename__ = "products"
-    __searchable__ = ['product_name', 'description']
+    # Keyset pagination walks these indexes, all ordered by id: home the
+    # ids of in-stock products only, the brand and category pages their
+    # foreign keys.
+    __table_args__ = (
+        Index("ix_products_brand_id_id", "brand_id", "id"),
+        Index("ix_products_category_id_id", "category_id", "id"),
+        Index("ix_products_in_stock_id", "id", sqlite_where=text("stock > 0"), postgresql_where=text("stock > 0")),
+        Index("ix_products_price_id", "price", "id"),
+    )
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     product_name: Mapped[str] = mapped_column(String(250), nullable=False)
     price: Mapped[int] = mapped_column(Integer, nullable=False)
@@ -177,25 +288,130 @@ class Product(db.Model):
     image_1: Mapped[str] = mapped_column(String(250), nullable=False, default="image.jpg")
     image_2: Mapped[str] = mapped_column(String(250), nullable=False, default="image.jpg")
     image_3: Mapped[str] = mapped_column(String(250), nullable=False, default="image.jpg")
+    # Thumbnails and WebP copies of the images above, filled in by ImageDerivatives
+    image_variants: Mapped[str] = mapped_column(jsonEncodedDict, nullable=False, default=dict, server_default="{}")
 
     # image_1 = db.Column(db.String(150))
     # image_2 = db.Column(db.String(150))
     # image_3 = db.Column(db.String(150))
 
 
-with app.app_context():
-    db.create_all()
+# Create the sales rollup tables in the database. Revenue is in cents, after discounts and before tax.
+class SalesDaily(db.Model):
+    __tablename__ = "sales_daily"
+    day: Mapped[date] = mapped_column(Date, primary_key=True)
+    orders: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    units: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    revenue_cents: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+
+
+class ProductSales(db.Model):
+    __tablename__ = "sales_by_product"
+    product_id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=False)
+    product_name: Mapped[str] = mapped_column(String(250), nullable=False)
+    orders: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    units: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    revenue_cents: Mapped[int] = mapped_column(Integer, nullable=False, default=0, index=True)
+
+
+class BrandSales(db.Model):
+    __tablename__ = "sales_by_brand"
+    brand_id: Mapped[int] = mapped_column(Integer, ForeignKey("brands.id", ondelete="CASCADE"), primary_key=True,
+                                          autoincrement=False)
+    brand = relationship("Brand", lazy="joined")
+    orders: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    units: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    revenue_cents: Mapped[int] = mapped_column(Integer, nullable=False, default=0, index=True)
+
+
+# Full-text product search, kept in sync with the products table by triggers; created by the migrations
+product_search = extension('product_search')
+
+# Prefix index for search-as-you-type, built on the first lookup and patched on every catalog commit
+suggestions = extension('search_suggestions')
+
+
+# Product listings page by keyset cursors instead of OFFSET
+paginator = extension('keyset_paginator')
+
+
+def product_listing(select, count_key):
+    try:
+        return paginator.paginate(select, count_key, cursor=request.args.get("cursor"),
+                                  sort=request.args.get("sort", "newest"), per_page=8)
+    except InvalidCursor:
+        abort(400)
+
+
+# Catalog pages for anonymous visitors, and the navbar and product card fragments,
+# cached until the next catalog write
+page_cache = extension('page_cache')
+
+# Brands and categories for the navbar dropdowns and the product form, cached until the catalog changes
+nav_facets = extension('nav_facets')
+
+# Create a user_loader callback; current_user is a cached Principal, not a User row
+identities = extension('identity_cache')
+
+
+@login_manager.user_loader
+def load_user(user_id):
+    return identities.load(user_id)
+
+
+# Cart and order lines, with their products loaded in one query
+line_items = LineItemLoader(db, Product)
+
+# Product image thumbnails and WebP copies, generated in a process pool after upload
+images = extension('image_derivatives')
+
+# Bulk product feeds: `flask catalog import feed.csv` and `flask catalog export catalog.jsonl`
+catalog_transfer = extension('catalog_transfer')
+
+# Sales per day, product and brand, updated when an order is paid
+sales = SalesRollups(db, CustomerOrder, OrderItem, Product, SalesDaily, ProductSales, BrandSales)
+
+# Stripe charges are made by a worker pool with idempotency keys and confirmed by webhook
+payments = extension('payments')
 
+# Checkout reserves stock with conditional updates; unpaid holds are released after the TTL
+inventory = extension('inventory')
 
-with app.app_context():
-    brands = db.session.execute(db.select(Brand)).scalars().all()
-    categories = db.session.execute(db.select(Category)).scalars().all()
+# Served over ASGI, the I/O-bound endpoints run their async views on the event loop; see create_asgi_app()
+async_views = extension('async_serving')
 
 
+# Views are registered on the app by create_app(), under their function names
+ROUTES = []
+
+# The async views by endpoint, and the coroutines run before them, given to each app's AsyncServing
+ASYNC_VIEWS = {}
+ASYNC_BEFORE_REQUEST = []
+
+
+def route(rule, **options):
+    def decorator(view):
+        ROUTES.append((rule, view, options))
+        return view
+    return decorator
+
+
+def async_view(endpoint):
+    def decorator(view):
+        ASYNC_VIEWS[endpoint] = view
+        return view
+    return decorator
+
+
+def async_before_request(func):
+    ASYNC_BEFORE_REQUEST.append(func)
+    return func
+
 
 class AddProduct(FlaskForm):
-    brand = SelectField('Select a Brand', choices=[brand.name for brand in brands])
-    category = SelectField('Select a Category', choices=[category.name for category in categories])
+    # Choices are filled in per request from nav_facets, so new brands and categories show up at once
+    brand = SelectField('Select a Brand', coerce=int)
+    category = SelectField('Select a Category', coerce=int)
     product_name = StringField("Product Name", validators=[DataRequired()])
     price = IntegerField("Price", validators=[DataRequired()])
     discount = IntegerField("Discount", default=0)
@@ -208,27 +424,15 @@ class AddProduct(FlaskForm):
     submit = SubmitField("Submit")
 
 
-def MagerDicts(dict1, dict2):
-    if isinstance(dict1, list) and isinstance(dict2, list):
-        return dict1 + dict2
-    elif isinstance(dict1, dict) and isinstance(dict2, dict):
-        return dict(list(dict1.items()) + list(dict2.items()))
-    return False
-
-
-@app.route("/")
+@route("/")
+@PageCache.cached()
 def home():
-    page = request.args.get("page", 1, type=int)
-    products = Product.query.filter(Product.stock > 0).order_by(Product.id.desc()).paginate(page=page, per_page=8)
-    # brands = db.session.execute(db.select(Brand)).scalars().all()
-    # Join the Brand and the Product table, so we don't display empty brands
-    brands = Brand.query.join(Product, (Brand.id == Product.brand_id)).all()
-    # categories = db.session.execute(db.select(Category)).scalars().all()
-    categories = Category.query.join(Product, (Category.id == Product.category_id)).all()
-    return render_template("index.html", products=products, brands=brands, categories=categories, datetime=datetime)
+    products = product_listing(db.select(Product).where(Product.stock > 0), "home")
+    # The navbar brands and categories come from the nav_facets context processor
+    return render_template("index.html", products=products, datetime=datetime)
 
 
-@app.route('/register', methods=["GET", "POST"])
+@route('/register', methods=["GET", "POST"])
 def register():
     form = RegistrationForm()
     if form.validate_on_submit():
@@ -239,9 +443,12 @@ def register():
             # User already exists
             flash("You've already signed up with that email, log in instead!")
             return redirect(url_for('login'))
-        hash_and_salted_password = generate_password_hash(request.form.get("password"), method="pbkdf2", salt_length=5)
+        try:
+            hash_and_salted_password = passwords.hash(request.form.get("password"))
+        except HashingBusy:
+            return hashing_busy("register.html", form)
 
-        with app.app_context():
+        with current_app.app_context():
             new_user = User(name=request.form.get("name"),
                             email=request.form.get("email"),
                             password=hash_and_salted_password,
@@ -264,7 +471,7 @@ def register():
 
 
 
-@app.route('/login', methods=["GET", "POST"])
+@route('/login', methods=["GET", "POST"])
 def login():
     form = LoginForm()
     if form.validate_on_submit():
@@ -279,48 +486,63 @@ def login():
             flash("That email does not exist, please try again.", "danger")
             return redirect(url_for("login"))
         # Check stored password hash against entered password hashed.
-        elif not check_password_hash(user.password, password):
+        try:
+            valid, new_hash = passwords.verify_and_update(user.password, password)
+        except HashingBusy:
+            return hashing_busy("login.html", form)
+        if not valid:
             flash("Password incorrect, please try again.", "danger")
             return redirect(url_for("login"))
         else:
+            # Stored with an outdated method, work factor or salt length
+            if new_hash is not None:
+                user.password = new_hash
+                db.session.commit()
             login_user(user)
             flash(f"Welcome! {user.name}")
             return redirect(url_for("home"))
     return render_template("login.html", form=form, current_user=current_user, datetime=datetime)
 
 
-@app.route('/logout')
+@route('/logout')
 def logout():
     logout_user()
     return redirect(url_for('home'))
 
 
-# Remove unwanted details from shopping cart
-def update_shopping_cart():
-    for _key, product in session['Shoppcart'].items():
-        session.modified = True
-        del product['image']
-        del product['colors']
-    return update_shopping_cart
 # Create a get_order route
 @login_required
-@app.route('/get_order')
+@route('/get_order')
 def get_order():
     if current_user.is_authenticated:
         customer_id = current_user.id
         invoice = secrets.token_hex(5)
-        update_shopping_cart()
+        items = line_items.for_cart(cart.lines())
+        if not items:
+            return redirect(url_for('home'))
+        if any(item.out_of_stock for item in items):
+            flash("Some items in your cart are no longer available in that quantity.", "danger")
+            return redirect(url_for('get_carts'))
         try:
-            order = CustomerOrder(invoice=invoice, customer_id=customer_id, orders=session['Shoppcart'])
-            print(order.customer_id)
+            order = CustomerOrder(invoice=invoice, customer_id=customer_id)
             db.session.add(order)
+            db.session.flush()
+            # Keep only the details needed on the order and invoice, in one executemany
+            db.session.execute(db.insert(OrderItem), [item.to_order_row(order.id) for item in items])
+            # Take the stock in the same transaction; nothing is ordered if any line is short
+            inventory.reserve(order.id, [(item.product_id, item.quantity) for item in items])
             db.session.commit()
             # Clear the Shopping cart
-            session.pop('Shoppcart')
+            cart.clear()
             flash("Your order has been sent successfully.", "success")
             return redirect(url_for('orders', invoice=invoice))
-        except Exception as e:
-            print(e)
+        except OutOfStock:
+            db.session.rollback()
+            flash("Some items in your cart are no longer available in that quantity.", "danger")
+            return redirect(url_for('get_carts'))
+        except Exception:
+            db.session.rollback()
+            current_app.logger.exception("Checkout failed for %s", invoice)
             flash("Something went wrong", "danger")
             return redirect(url_for('get_carts'))
 
@@ -330,244 +552,290 @@ def get_order():
 
 # Create the orders route
 @login_required
-@app.route("/orders/<invoice>")
+@route("/orders/<invoice>")
 def orders(invoice):
     if current_user.is_authenticated:
-        grand_total = 0
-        sub_total = 0
         customer_id = current_user.id
-        customer = User.query.filter_by(id=customer_id).first()
-        orders = CustomerOrder.query.filter_by(customer_id=customer_id, invoice=invoice).order_by(CustomerOrder.id.desc()).first()
-        for _key, product in orders.orders.items():
-            discount = (product['discount']/100) * float(product['price'])
-            sub_total = float(product['price']) * int(product['quantity'])
-            sub_total -= discount
-            tax = ("%.2f" % (.06 * float(sub_total)))
-            grand_total = ("%.2f" % (1.06 * float(sub_total)))
+        customer = current_user.user
+        orders = CustomerOrder.query.filter_by(customer_id=customer_id, invoice=invoice).order_by(CustomerOrder.id.desc()).first_or_404()
+        items = line_items.for_order(orders)
+        totals = order_totals.get(invoice, items, current_app.config['TAX_RATE'])
+        payment = payments.latest(orders)
     else:
         return redirect(url_for("login"))
-    return render_template("order.html", invoice=invoice, tax=tax, sub_total=sub_total,
-                           grand_total=grand_total,customer=customer, orders=orders, datetime=datetime)
+    return render_template("order.html", invoice=invoice, totals=totals, tax=totals.tax, grand_total=totals.grand_total,
+                           customer=customer, orders=orders, items=items, payment=payment,
+                           payment_processing=payment is not None and payment.status in IN_PROGRESS,
+                           datetime=datetime)
 
 
 @login_required
-@app.route("/get_pdf/<invoice>", methods=["POST"])
+@route("/get_pdf/<invoice>", methods=["POST"])
 def get_pdf(invoice):
     if current_user.is_authenticated:
-        grand_total = 0
-        sub_total = 0
         customer_id = current_user.id
         if request.method == "POST":
-            customer = User.query.filter_by(id=customer_id).first()
-            orders = CustomerOrder.query.filter_by(customer_id=customer_id).order_by(CustomerOrder.id.desc()).first()
-            for _key, product in orders.orders.items():
-                discount = (product['discount']/100) * float(product['price'])
-                sub_total = float(product['price']) * int(product['quantity'])
-                sub_total -= discount
-                tax = ("%.2f" % (.06 * float(sub_total)))
-                grand_total = float("%.2f" % (1.06 * sub_total))
-
-            rendered = render_template("pdf.html", invoice=invoice, tax=tax, grand_total=grand_total,
-                                     customer=customer, orders=orders)
-            pdf = pdfkit.from_string(rendered, False)
-            response = make_response(pdf)
-            response.headers['content-Type'] = 'application/pdf'
-            response.headers['content-Disposition'] = 'inline: filename="+invoice+".pdf'
+            customer = current_user.user
+            orders = CustomerOrder.query.filter_by(customer_id=customer_id, invoice=invoice).first_or_404()
+            # Serve a previously rendered copy if the order hasn't changed since
+            cache_key = pdf_cache_key(orders)
+            if pdf_cache.get(cache_key) is not None:
+                return jsonify(status="done", download_url=url_for('invoice_pdf', invoice=invoice))
+            items = line_items.for_order(orders)
+            totals = order_totals.get(invoice, items, current_app.config['TAX_RATE'])
+            rendered = render_template("pdf.html", invoice=invoice, totals=totals, tax=totals.tax,
+                                       grand_total=totals.grand_total, customer=customer, orders=orders,
+                                       items=items, datetime=datetime)
+            try:
+                # Bound here, since the callback runs on a render thread outside the app context
+                job = pdf_renderer.submit(rendered, owner=customer_id, filename=invoice + ".pdf",
+                                          on_done=partial(pdf_cache.put, cache_key), key=cache_key)
+            except QueueFull:
+                return pdf_busy()
+            status_url = url_for('pdf_status', job_id=job.id)
+            response = jsonify(status=job.status, status_url=status_url)
+            response.status_code = 202
+            response.headers['Location'] = status_url
             return response
-    return request(url_for("orders"))
+    return redirect(url_for("login"))
 
 
-@login_required
-@app.route("/payment", methods=["POST"])
-def payment():
-    invoice = request.form.get('invoice')
-    amount = request.form.get('amount')
-    customer = stripe.Customer.create(
-        email=request.form['stripeEmail'],
-        source=request.form['stripeToken'],
-    )
+def pdf_busy():
+    response = jsonify(error="We are busy generating other invoices, please try again shortly.")
+    response.status_code = 503
+    response.headers['Retry-After'] = '5'
+    return response
 
-    charge = stripe.Charge.create(
-        customer=customer.id,
-        description='Myshop',
-        amount=amount,
-        currency='usd',
-    )
-    orders = CustomerOrder.query.filter_by(customer_id=current_user.id, invoice=invoice).order_by(CustomerOrder.id.desc()).first()
-    orders.status = "Paid"
-    db.session.commit()
-    return redirect(url_for('thanks'))
+
+def pdf_cache_key(order):
+    template = current_app.jinja_env.get_or_select_template("pdf.html")
+    return PdfCache.key(order.invoice, order.status, order.orders, os.path.getmtime(template.filename),
+                        current_app.config['TAX_RATE'])
+
+
+# Download a cached invoice PDF, answering 304 when the browser's copy is current
+@route("/invoice/<invoice>.pdf")
+@login_required
+def invoice_pdf(invoice):
+    order = CustomerOrder.query.filter_by(customer_id=current_user.id, invoice=invoice).first_or_404()
+    cache_key = pdf_cache_key(order)
+    path = pdf_cache.get(cache_key)
+    if path is None:
+        abort(404)
+    response = send_file(path, mimetype='application/pdf', download_name=invoice + ".pdf",
+                         etag=cache_key, conditional=True, max_age=0)
+    response.cache_control.private = True
+    return response
+
+
+# Poll a queued invoice PDF
+@route("/pdf_jobs/<job_id>")
+@login_required
+def pdf_status(job_id):
+    job = pdf_renderer.get(job_id, owner=current_user.id)
+    if job is None:
+        abort(404)
+    status = {"status": job.status}
+    if job.status == "done":
+        status["download_url"] = url_for('pdf_download', job_id=job.id)
+    elif job.status == "failed":
+        status["error"] = "The invoice could not be generated."
+    return jsonify(status)
+
+
+# Fetch a finished invoice PDF
+@route("/pdf_jobs/<job_id>/download")
+@login_required
+def pdf_download(job_id):
+    job = pdf_renderer.get(job_id, owner=current_user.id)
+    if job is None or job.status != "done":
+        abort(404)
+    if job.result is not None:
+        response = make_response(job.result)
+        response.headers['Content-Type'] = 'application/pdf'
+        response.headers['Content-Disposition'] = 'inline; filename="%s"' % job.filename
+        return response
+    # Rendered by another worker, which only shares the job's status; the PDF is in the cache
+    path = pdf_cache.get(job.key) if job.key else None
+    if path is None:
+        abort(404)
+    response = send_file(path, mimetype='application/pdf', download_name=job.filename, max_age=0)
+    response.cache_control.private = True
+    return response
 
 
-@app.route("/thanks")
+@login_required
+@route("/payment", methods=["POST"])
+def payment():
+    if not current_user.is_authenticated:
+        return redirect(url_for("login"))
+    invoice = request.form.get('invoice')
+    orders = CustomerOrder.query.filter_by(customer_id=current_user.id, invoice=invoice).first_or_404()
+    if orders.status == "Paid":
+        return redirect(url_for('thanks'))
+    # Charge what the order says, not what the form says
+    totals = order_totals.get(invoice, line_items.for_order(orders), current_app.config['TAX_RATE'])
+    # Returns the attempt in progress instead of charging again when the form is resubmitted
+    payments.start(orders, totals.grand_total_cents, request.form['stripeToken'], request.form.get('stripeEmail'))
+    return redirect(url_for('orders', invoice=invoice))
+
+
+# Polled by the order page while a payment is being confirmed
+@route("/payment/<invoice>/status")
+@login_required
+def payment_status(invoice):
+    orders = CustomerOrder.query.filter_by(customer_id=current_user.id, invoice=invoice).first_or_404()
+    attempt = payments.latest(orders)
+    if attempt is None:
+        abort(404)
+    status = {"status": attempt.status}
+    if attempt.status == SUCCEEDED:
+        status["redirect_url"] = url_for('thanks')
+    elif attempt.error:
+        status["error"] = attempt.error
+    return jsonify(status)
+
+
+@route("/thanks")
 def thanks():
     return render_template("thanks.html", datetime=datetime)
 
 
 
-@app.route("/search")
+@route("/search")
 def search():
-    search_word = request.args.get('q')
-    products = Product.query.msearch(search_word, fields=['product_name', 'description'], limit=6)
-    # Display tha brands and categories on the navbar dropdown
-    brands = Brand.query.join(Product, (Brand.id == Product.brand_id)).all()
-    categories = Category.query.join(Product, (Category.id == Product.category_id)).all()
-    return render_template('search.html', products=products, brands=brands, categories=categories, datetime=datetime)
+    search_word = request.args.get('q', '')
+    page = request.args.get("page", 1, type=int)
+    brand_id = request.args.get("brand", type=int)
+    category_id = request.args.get("category", type=int)
+    in_stock = request.args.get("in_stock", type=int) == 1
+    products = product_search.search(search_word, page=page, per_page=12, brand_id=brand_id,
+                                     category_id=category_id, in_stock=in_stock)
+    return render_template('search.html', products=products, search_word=search_word, brand_id=brand_id,
+                           category_id=category_id, in_stock=in_stock, datetime=datetime)
+
+
+# Suggest products, brands and categories while the customer types
+@route("/search/suggest")
+def search_suggest():
+    limit = min(request.args.get("limit", 8, type=int), 20)
+    endpoints = {"product": "show_product", "brand": "get_brand", "category": "get_category"}
+    results = [{"label": suggestion.label, "kind": suggestion.kind,
+                "url": url_for(endpoints[suggestion.kind], id=suggestion.id)}
+               for suggestion in suggestions.lookup(request.args.get("q", ""), limit)]
+    response = jsonify(suggestions=results)
+    response.cache_control.public = True
+    response.cache_control.max_age = 60
+    return response
+
+
+# Sales report, read from the rollup tables only
+@route("/admin/sales")
+@admin_required
+def admin_sales():
+    days = min(max(request.args.get("days", 30, type=int), 1), 366)
+    top = min(max(request.args.get("top", 10, type=int), 1), 100)
+    return jsonify(sales.report(days=days, top=top))
+
+
+# Page and fragment cache hit ratios
+@route("/admin/cache")
+@admin_required
+def admin_cache():
+    return jsonify(page_cache=page_cache.stats(), nav_facets=nav_facets.stats(), identities=identities.stats())
 
 
 # Display a single product
-@app.route("/product/<int:id>", methods=["GET", "POST"])
+@route("/product/<int:id>", methods=["GET", "POST"])
+@PageCache.cached()
 def show_product(id):
     product = db.get_or_404(Product, id)
-    # Display tha brands and categories on the navbar dropdown
-    brands = Brand.query.join(Product, (Brand.id == Product.brand_id)).all()
-    categories = Category.query.join(Product, (Category.id == Product.category_id)).all()
-    return render_template("show_product.html", product=product, brands=brands, categories=categories, datetime=datetime)
+    return render_template("show_product.html", product=product, datetime=datetime)
 
 # Add products to cart
-@app.route("/add_cart", methods=["POST"])
+@route("/add_cart", methods=["POST"])
 def add_cart():
     try:
-        product_id = request.form.get("product_id")
-        quantity = request.form.get('quantity')
+        product_id = request.form.get("product_id", type=int)
+        quantity = request.form.get('quantity', type=int)
         colors = request.form.get('colors')
-        product = Product.query.filter_by(id=product_id).first()
-        if product_id and quantity and colors and request.method == "POST":
-            DictItems = {
-                product_id:{'name': product.product_name, 'price':product.price, 'discount': product.discount,
-                            'color': colors, 'quantity': quantity, 'image': product.image_1, 'colors': product.colors
-                            }
-            }
-            if 'Shoppcart' in session:
-                print(session['Shoppcart'])
-                # Add a product to shopping cart even if the product is already in the shopping cart
-                if product_id in session['Shoppcart']:
-                    # for key , item in session['Shoppcart'].items():
-                    #     if int(key) == int(product_id):
-                    #         session.modified = True
-                    #         item['quantity'] += 1
-                    #         print(item["quantity"])
-                    print('This product is already in cart')
-                else:
-                    session['Shoppcart'] = MagerDicts(session['Shoppcart'], DictItems)
-                    return redirect(request.referrer)
-            else:
-                session['Shoppcart'] = DictItems
-                return redirect(request.referrer)
-    except Exception as e:
-        print(e)
+        product = db.session.get(Product, product_id) if product_id else None
+        if quantity is not None and quantity < 1:
+            flash("Please choose a quantity of at least 1.", "danger")
+        elif product is not None and quantity and colors:
+            if not cart.add(product_id, quantity, colors, product.price):
+                current_app.logger.debug("Product %s is already in the cart", product_id)
+    except Exception:
+        current_app.logger.exception("Adding product to the cart failed")
     finally:
         return redirect(request.referrer)
 
 # Display products on cart
-@app.route("/cart")
+@route("/cart")
 def get_carts():
-    # Display tha brands and categories on the navbar dropdown
-    brands = Brand.query.join(Product, (Brand.id == Product.brand_id)).all()
-    categories = Category.query.join(Product, (Category.id == Product.category_id)).all()
-    if "Shoppcart" not in session or len(session['Shoppcart']) <= 0:
+    items = line_items.for_cart(cart.lines())
+    if not items:
         return redirect(url_for('home'))
-    subtotal = 0
-    grandtotal = 0
-    for key , product in session['Shoppcart'].items():
-        discount = (product['discount']/100) * float(product['price']) * int(product['quantity'])
-        subtotal += float(product['price']) * int(product['quantity'])
-        subtotal -= discount
-        tax = ("%.2f" % (0.06 * float(subtotal)))
-        grandtotal = float("%.2f" % (1.06 * subtotal))
-    return render_template("carts.html", brands=brands, categories=categories, tax=tax, grandtotal=grandtotal, datetime=datetime)
-
-
-@app.route("/update_cart/<int:code>", methods=["GET", "POST"])
+    totals = compute_totals(items, current_app.config['TAX_RATE'])
+    return render_template("carts.html", items=items, totals=totals, tax=totals.tax, grandtotal=totals.grand_total,
+                           datetime=datetime)
+
+
+@route("/update_cart/<int:code>", methods=["GET", "POST"])
 def update_cart(code):
-    if 'Shoppcart' not in session or len(session['Shoppcart']) <= 0:
+    if cart.count() <= 0:
         return redirect(url_for('home'))
     if request.method == "POST":
-        quantity = request.form.get('quantity')
+        quantity = request.form.get('quantity', type=int)
         color = request.form.get('color')
-        try:
-            session.modified = True
-            for key , item in session['Shoppcart'].items():
-                if int(key) == code:
-                    item['quantity'] = quantity
-                    item['color'] = color
-                    flash("Item updated")
-                    return redirect(url_for('get_carts'))
-        except Exception as e:
-            print(e)
+        if quantity is not None and quantity < 1:
+            flash("Please choose a quantity of at least 1.", "danger")
             return redirect(url_for('get_carts'))
+        if quantity and cart.update(code, quantity, color):
+            flash("Item updated")
+    return redirect(url_for('get_carts'))
 
 
-@app.route("/delete_item/<int:id>")
+@route("/delete_item/<int:id>")
 def delete_item(id):
-    if 'Shoppcart' not in session or len(session['Shoppcart']) <= 0:
+    if cart.count() <= 0:
         return redirect(url_for('home'))
-    try:
-        session.modified = True
-        for key , item in session['Shoppcart'].items():
-            if int(key) == id:
-                session['Shoppcart'].pop(key, None)
-                return redirect(url_for('get_carts'))
-    except Exception as e:
-        print(e)
-        return redirect(url_for('get_carts'))
+    cart.remove(id)
+    return redirect(url_for('get_carts'))
 
 
-@app.route("/clear_cart", methods=["GET"])
+@route("/clear_cart", methods=["GET"])
 def clear_cart():
-    try:
-        session.pop("Shoppcart", None)
-        return redirect(url_for('home'))
-    except Exception as e:
-        print(e)
+    cart.clear()
+    return redirect(url_for('home'))
 
 
 
 # Display products by brand
-@app.route("/brand/<int:id>")
+@route("/brand/<int:id>")
+@PageCache.cached()
 def get_brand(id):
-    page = request.args.get("page", 1, type=int)
     get_brand= Brand.query.filter_by(id=id).first_or_404()
-    brand = Product.query.filter_by(brand=get_brand).paginate(page=page, per_page=8)
+    brand = product_listing(db.select(Product).where(Product.brand_id == get_brand.id), ("brand", get_brand.id))
     # brand = db.session.execute(db.select(Product).where(Product.brand_id==id)).scalars().all().paginate(page=page, per_page=2)
-    # Display tha brands and categories on the navbar dropdown
-    brands = Brand.query.join(Product, (Brand.id == Product.brand_id)).all()
-    categories = Category.query.join(Product, (Category.id == Product.category_id)).all()
-    return render_template("index.html", brand=brand, get_brand=get_brand, brands=brands,
-                           categories=categories, datetime=datetime)
+    return render_template("index.html", brand=brand, get_brand=get_brand, datetime=datetime)
 
 # Display products by category
-@app.route("/category/<int:id>")
+@route("/category/<int:id>")
+@PageCache.cached()
 def get_category(id):
-    page = request.args.get("page", 1, type=int)
     get_cat = Category.query.filter_by(id=id).first_or_404()
-    category = Product.query.filter_by(category=get_cat).paginate(page=page, per_page=8)
+    category = product_listing(db.select(Product).where(Product.category_id == get_cat.id), ("category", get_cat.id))
     # category = db.session.execute(db.select(Product).where(Product.category_id==id)).scalars().all()
-    # Display tha brands and categories on the navbar dropdown
-    brands = Brand.query.join(Product, (Brand.id == Product.brand_id)).all()
-    categories = Category.query.join(Product, (Category.id == Product.category_id)).all()
-    return render_template("index.html", category=category, get_cat=get_cat, brands=brands,
-                           categories=categories, datetime=datetime)
+    return render_template("index.html", category=category, get_cat=get_cat, datetime=datetime)
 
 
-@app.route("/add_product", methods=["GET", "POST"])
+@route("/add_product", methods=["GET", "POST"])
 def add_product():
     form = AddProduct()
+    form.brand.choices, form.category.choices = nav_facets.choices()
     if form.validate_on_submit():
-        with app.app_context():
-            requested_brand = request.form.get("brand")
-            requested_category = request.form.get("category")
-            for brand in brands:
-                if brand.name == requested_brand:
-                    brand_id = brand.id
-
-                    # print(brand_id)
-                    # print(requested_brand)
-
-            for category in categories:
-                if category.name == requested_category:
-                    category_id = category.id
-
+        with current_app.app_context():
             new_product = Product(
                                   product_name=request.form.get("product_name"),
                                   price=request.form.get("price"),
@@ -575,8 +843,8 @@ def add_product():
                                   stock=request.form.get("stock"),
                                   description=request.form.get("description"),
                                   colors=request.form.get("colors"),
-                                  brand_id=brand_id,
-                                  category_id=category_id,
+                                  brand_id=form.brand.data,
+                                  category_id=form.category.data,
                                   image_1=photos.save(request.files.get("image_1"), secrets.token_hex(10) + "."),
                                   image_2=photos.save(request.files.get("image_2"), secrets.token_hex(10) + "."),
                                   image_3=photos.save(request.files.get("image_3"), secrets.token_hex(10) + "."),
@@ -585,13 +853,15 @@ def add_product():
 
         db.session.add(new_product)
         db.session.commit()
+        # Pages show the originals until the resized copies are ready
+        images.submit(new_product)
 
         flash("Product added!")
         return redirect(url_for('home'))
-    return render_template("add_product.html", form=form, brands=brands, categories=categories, datetime=datetime)
+    return render_template("add_product.html", form=form, datetime=datetime)
 
 
-@app.route("/add_brand", methods=["GET", "POST"])
+@route("/add_brand", methods=["GET", "POST"])
 def add_brand():
     form = AddBrand()
     if form.validate_on_submit():
@@ -602,7 +872,7 @@ def add_brand():
             # Brand already exists
             flash("This brand already exist, add a category instead!")
             return redirect(url_for('add_category'))
-        with app.app_context():
+        with current_app.app_context():
             new_brand = Brand(name=request.form.get("brand"))
 
             db.session.add(new_brand)
@@ -612,7 +882,7 @@ def add_brand():
     return render_template("add_brand.html", form=form, datetime=datetime)
 
 
-@app.route("/add_category", methods=["GET", "POST"])
+@route("/add_category", methods=["GET", "POST"])
 def add_category():
     form = AddCategory()
     if form.validate_on_submit():
@@ -623,7 +893,7 @@ def add_category():
             # Category already exists
             flash("This category already exist, add a product instead!")
             return redirect(url_for('add_product'))
-        with app.app_context():
+        with current_app.app_context():
             new_category = Category(name=request.form.get("category"))
 
             db.session.add(new_category)
@@ -632,11 +902,237 @@ def add_category():
     return render_template("add_category.html", form=form, datetime=datetime)
 
 
+# The async views, used in place of the views above for their endpoints when served over ASGI.
+# They read the database through async_views.session() rather than db.session, so waiting on a
+# query, on Stripe or on wkhtmltopdf never blocks the event loop.
+
+@async_before_request
+async def load_identity():
+    # Flask-Login then finds the identity cached, instead of querying from the event loop
+    user_id = session.get("_user_id")
+    if user_id is not None:
+        async with async_views.session() as db_session:
+            await identities.load_async(user_id, db_session)
+
 
+@async_before_request
+async def load_template_context():
+    # Handed to the context processors through g, which would otherwise query while the template renders
+    async with async_views.session() as db_session:
+        g.nav_facets = await nav_facets.get_async(db_session)
+    g.cart_count = await cart.count_async()
 
 
+async def render_template_async(template, **context):
+    '''render_template() for the async views, on a thread when the page cache's fragments are files.'''
+    if page_cache.blocking:
+        return await asyncio.to_thread(render_template, template, **context)
+    return render_template(template, **context)
 
 
+async def product_listing_async(db_session, select, count_key):
+    try:
+        return await paginator.paginate_async(db_session, select, count_key, cursor=request.args.get("cursor"),
+                                              sort=request.args.get("sort", "newest"), per_page=8)
+    except InvalidCursor:
+        abort(400)
+
+
+async def customer_order_async(db_session, invoice):
+    '''The current user's order ``invoice`` with its items loaded, or a 404.'''
+    order = (await db_session.execute(
+        db.select(CustomerOrder).where(CustomerOrder.customer_id == current_user.id, CustomerOrder.invoice == invoice)
+        .options(selectinload(CustomerOrder.items)).limit(1))).scalar()
+    if order is None:
+        abort(404)
+    return order
+
+
+@async_view("home")
+@PageCache.cached_async()
+async def home_async():
+    async with async_views.session() as db_session:
+        products = await product_listing_async(db_session, db.select(Product).where(Product.stock > 0), "home")
+    return await render_template_async("index.html", products=products, datetime=datetime)
+
+
+@async_view("show_product")
+@PageCache.cached_async()
+async def show_product_async(id):
+    async with async_views.session() as db_session:
+        product = await db_session.get(Product, id)
+    if product is None:
+        abort(404)
+    return await render_template_async("show_product.html", product=product, datetime=datetime)
+
+
+@async_view("get_brand")
+@PageCache.cached_async()
+async def get_brand_async(id):
+    async with async_views.session() as db_session:
+        get_brand = await db_session.get(Brand, id)
+        if get_brand is None:
+            abort(404)
+        brand = await product_listing_async(db_session, db.select(Product).where(Product.brand_id == id),
+                                            ("brand", id))
+    return await render_template_async("index.html", brand=brand, get_brand=get_brand, datetime=datetime)
+
+
+@async_view("get_category")
+@PageCache.cached_async()
+async def get_category_async(id):
+    async with async_views.session() as db_session:
+        get_cat = await db_session.get(Category, id)
+        if get_cat is None:
+            abort(404)
+        category = await product_listing_async(db_session, db.select(Product).where(Product.category_id == id),
+                                               ("category", id))
+    return await render_template_async("index.html", category=category, get_cat=get_cat, datetime=datetime)
+
+
+@async_view("get_pdf")
+async def get_pdf_async(invoice):
+    if not current_user.is_authenticated:
+        return redirect(url_for("login"))
+    download_url = url_for('invoice_pdf', invoice=invoice)
+    async with async_views.session() as db_session:
+        orders = await customer_order_async(db_session, invoice)
+        # Serve a previously rendered copy if the order hasn't changed since
+        cache_key = pdf_cache_key(orders)
+        if pdf_cache.get(cache_key) is not None:
+            return jsonify(status="done", download_url=download_url)
+        customer = await db_session.get(User, current_user.id)
+        items = await line_items.for_order_async(orders, db_session)
+    totals = order_totals.get(invoice, items, current_app.config['TAX_RATE'])
+    rendered = render_template("pdf.html", invoice=invoice, totals=totals, tax=totals.tax,
+                               grand_total=totals.grand_total, customer=customer, orders=orders,
+                               items=items, datetime=datetime)
+    # Rendered while the request waits, so there is no job to poll
+    try:
+        pdf = await pdf_renderer.render_async(rendered)
+    except QueueFull:
+        return pdf_busy()
+    except Exception:
+        current_app.logger.exception("Rendering the invoice PDF for %s failed", invoice)
+        response = jsonify(error="The invoice could not be generated.")
+        response.status_code = 500
+        return response
+    await asyncio.to_thread(pdf_cache.put, cache_key, pdf)
+    return jsonify(status="done", download_url=download_url)
+
+
+@async_view("payment")
+async def payment_async():
+    if not current_user.is_authenticated:
+        return redirect(url_for("login"))
+    invoice = request.form.get('invoice')
+    async with async_views.session() as db_session:
+        orders = await customer_order_async(db_session, invoice)
+        if orders.status == "Paid":
+            return redirect(url_for('thanks'))
+        # Charge what the order says, not what the form says
+        items = await line_items.for_order_async(orders, db_session)
+        totals = order_totals.get(invoice, items, current_app.config['TAX_RATE'])
+        # The charge is awaited by a task on the event loop; the order page polls for the outcome
+        await payments.start_async(db_session, orders, totals.grand_total_cents, request.form['stripeToken'],
+                                   request.form.get('stripeEmail'))
+    return redirect(url_for('orders', invoice=invoice))
+
+
+def create_app(config=None):
+    '''Builds the shop's app; ``config`` overrides the settings read from the environment.
+
+    Nothing here touches the database: run ``flask db upgrade`` to create or update the tables.
+    '''
+    app = Flask(__name__)
+    app.config['SECRET_KEY'] = os.environ.get("FlaskConfigKey", "dev")
+    app.config['METRICS_SAMPLE_RATE'] = float(os.environ.get("METRICS_SAMPLE_RATE", 1.0))
+    app.config['METRICS_TOKEN'] = os.environ.get("METRICS_TOKEN")
+    app.config['PDF_RENDERER'] = os.environ.get("PDF_RENDERER", "wkhtmltopdf")
+    app.config['PDF_RENDER_WORKERS'] = int(os.environ.get("PDF_RENDER_WORKERS", 2))
+    app.config['PDF_RENDER_QUEUE_SIZE'] = int(os.environ.get("PDF_RENDER_QUEUE_SIZE", 16))
+    # Rendered invoices are cached here, outside of the public static folder
+    app.config['PDF_DIR_PATH'] = os.environ.get("PDF_DIR_PATH", os.path.join(app.instance_path, "pdf"))
+    app.config['PDF_CACHE_MAX_BYTES'] = int(os.environ.get("PDF_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+    # Sales tax applied to order subtotals
+    app.config['TAX_RATE'] = os.environ.get("TAX_RATE", "0.06")
+    app.config['CART_STORE'] = os.environ.get("CART_STORE", "memory")
+    app.config['CART_STORE_PATH'] = os.environ.get("CART_STORE_PATH")
+    # Set destination for uploaded images
+    app.config["UPLOADED_PHOTOS_DEST"] = os.path.join(basedir, "static/images")
+    # Thumbnail widths generated for each uploaded image, as a comma separated list
+    app.config['IMAGE_WIDTHS'] = [int(width) for width in os.environ.get("IMAGE_WIDTHS", "160,320,640").split(",")]
+    app.config['IMAGE_WORKERS'] = int(os.environ.get("IMAGE_WORKERS", 2))
+    app.config['PASSWORD_HASH_METHOD'] = os.environ.get("PASSWORD_HASH_METHOD", "scrypt:32768:8:1")
+    app.config['PASSWORD_SALT_LENGTH'] = int(os.environ.get("PASSWORD_SALT_LENGTH", 16))
+    app.config['PASSWORD_HASH_WORKERS'] = int(os.environ.get("PASSWORD_HASH_WORKERS", 2))
+    app.config['PASSWORD_HASH_QUEUE_SIZE'] = int(os.environ.get("PASSWORD_HASH_QUEUE_SIZE", 32))
+    # Users allowed to see the admin reports, as a comma separated list of emails
+    app.config['ADMIN_EMAILS'] = os.environ.get("ADMIN_EMAILS", "")
+    app.config['DATABASE_URL'] = os.environ.get("DATABASE_URL", "sqlite:///shop.db")
+    app.config['PAGE_CACHE_BACKEND'] = os.environ.get("PAGE_CACHE_BACKEND", "memory")
+    app.config['PAGE_CACHE_MAX_BYTES'] = int(os.environ.get("PAGE_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+    app.config['PAGE_CACHE_DIR'] = os.environ.get("PAGE_CACHE_DIR")
+    app.config['IDENTITY_CACHE_TTL'] = int(os.environ.get("IDENTITY_CACHE_TTL", 300))
+    # Point STRIPE_API_BASE at stripe_stub.py to run without Stripe
+    app.config['STRIPE_SECRET_KEY'] = os.environ.get("secret_key", "dev")
+    app.config['STRIPE_WEBHOOK_SECRET'] = os.environ.get("STRIPE_WEBHOOK_SECRET")
+    app.config['STRIPE_API_BASE'] = os.environ.get("STRIPE_API_BASE")
+    app.config['PAYMENT_WORKERS'] = int(os.environ.get("PAYMENT_WORKERS", 4))
+    app.config['INVENTORY_HOLD_TTL'] = int(os.environ.get("INVENTORY_HOLD_TTL", 900))
+    # Only read when served over ASGI; the async database URL defaults to DATABASE_URL with its async driver
+    app.config['ASYNC_DATABASE_URL'] = os.environ.get("ASYNC_DATABASE_URL")
+    app.config['ASYNC_WSGI_THREADS'] = int(os.environ.get("ASYNC_WSGI_THREADS", 32))
+    app.config.update(config or {})
+
+    # First, so the other extensions' request hooks are timed too
+    Metrics(app)
+    PdfRenderService(app)
+    PdfCache(Wkhtmltopdf(app), app)
+    TotalsCache(app=app)
+    # Amounts are computed in cents; templates format them with the cents filter
+    app.add_template_filter(format_cents, "cents")
+    CartStore(app)
+    configure_uploads(app, photos)
+    bootstrap.init_app(app)
+    Assets(app)
+    login_manager.init_app(app)
+    PasswordHasher(app)
+
+    # Connect to Database; SQLite runs in WAL mode, server databases get a sized pool
+    profile = DatabaseProfile(app)
+    db.init_app(app)
+    with app.app_context():
+        for engine in db.engines.values():
+            profile.watch(engine)
+    migrate.init_app(app, db)
+
+    ProductSearch(db, Product, app)
+    SearchSuggestions(db, Product, Brand, Category).init_app(app)
+    KeysetPaginator(db, Product, app=app)
+    PageCache(Product, Brand, Category).init_app(app)
+    NavFacets(db, Brand, Category, Product).init_app(app)
+    IdentityCache(db, User, app)
+    ImageDerivatives(db, Product, app)
+    CatalogTransfer(db, Product, Brand, Category, app)
+    sales.init_app(app)
+    Payments(db, PaymentAttempt, CustomerOrder, app)
+    Inventory(db, Product, StockReservation, CustomerOrder, app)
+    async_serving = AsyncServing(app)
+    for endpoint, view in ASYNC_VIEWS.items():
+        async_serving.view(endpoint)(view)
+    for func in ASYNC_BEFORE_REQUEST:
+        async_serving.before_request(func)
+
+    for rule, view, options in ROUTES:
+        app.add_url_rule(rule, view_func=view, **options)
+    return app
+
+
+def create_asgi_app(config=None):
+    '''Builds the app for an ASGI server, e.g. ``uvicorn --factory main:create_asgi_app``.'''
+    return create_app(config).extensions['async_serving']
+
 
 if __name__ == "__main__":
-    app.run(debug=True)
\ No newline at end of file
+    create_app().run(debug=True)
@@ -0,0 +1,284 @@
+'''
+    Metrics
+
+    -------
+
+    Per-request instrumentation, exposed in the Prometheus text format at
+    ``/metrics``.
+
+    Every request is counted and its latency added to a histogram per
+    endpoint; that costs two clock reads. A sample of requests, set by
+    ``METRICS_SAMPLE_RATE``, is also measured in detail: SQL statements and
+    the time spent in them, from SQLAlchemy cursor events, template render
+    time, and the size of the session cookie the browser sent. Sampled
+    responses carry a ``Server-Timing`` header, so the breakdown shows up in
+    the browser's network panel.
+
+    Calls to other services, such as Stripe charges and wkhtmltopdf renders,
+    run on worker threads; they are timed with ``external_call`` whether or
+    not a request is sampled.
+
+    Metrics are kept per process, like the memory page cache: with several
+    workers, scrape each of them or aggregate at the collector. Static files
+    served by the assets middleware never reach Flask and are not counted.
+    The request being measured is tracked in context variables rather than
+    thread locals, so async views sharing the event loop's thread are each
+    measured on their own.
+
+'''
+
+from bisect import bisect_left
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+import random
+import threading
+import time
+
+from flask import Response, abort, request
+from flask.signals import before_render_template, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+EXTERNAL_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+COOKIE_BUCKETS = (0, 128, 256, 512, 1024, 2048, 3072, 4096)
+
+# The current request's start time and RequestSample, per thread or asyncio task
+_started = ContextVar("metrics_started", default=None)
+_sample = ContextVar("metrics_sample", default=None)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=""):
+    pairs = ['%s="%s"' % (name, _escape(value)) for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{%s}" % ",".join(pairs) if pairs else ""
+
+
+class Counter(object):
+    '''A monotonically increasing count per combination of label values.'''
+
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for label_values, value in values:
+            yield "%s%s %s" % (self.name, _format_labels(self.labels, label_values), value)
+
+
+class Histogram(object):
+    '''Observations counted into cumulative ``le`` buckets, with their sum and count.'''
+
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0]
+            series[0][index] += 1
+            series[1] += value
+
+    def samples(self):
+        with self._lock:
+            series = sorted((label_values, (list(counts), total))
+                            for label_values, (counts, total) in self._series.items())
+        for label_values, (counts, total) in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                yield "%s_bucket%s %d" % (self.name, _format_labels(self.labels, label_values, 'le="%s"' % bound),
+                                          cumulative)
+            labels = _format_labels(self.labels, label_values)
+            yield "%s_sum%s %s" % (self.name, labels, round(total, 6))
+            yield "%s_count%s %d" % (self.name, labels, cumulative)
+
+
+class RequestSample(object):
+    '''What one sampled request spent its time on.'''
+
+    __slots__ = ("queries", "db_seconds", "template_seconds", "query_started", "templates")
+
+    def __init__(self):
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.template_seconds = 0.0
+        self.query_started = None
+        self.templates = []
+
+
+class Metrics(object):
+    '''Request, database, template and external call metrics, served at ``/metrics``.
+
+    To initialize, pass your flask app's object, before the other extensions
+    so that their request hooks are timed too::
+
+        metrics = Metrics(app)
+
+    Time a call to another service with::
+
+        with external_call(app, "stripe"):
+            ...
+
+    Config variables read from the app:
+
+        METRICS_SAMPLE_RATE = 1.0       # share of requests measured in detail; 0 turns it off
+        METRICS_SERVER_TIMING = True    # add a Server-Timing header to sampled responses
+        METRICS_TOKEN = None            # if set, /metrics requires "Authorization: Bearer <token>"
+
+    '''
+
+    def __init__(self, app=None):
+        self.requests = Counter("http_requests_total", "Requests handled, by endpoint, method and status.",
+                                ("endpoint", "method", "status"))
+        self.latency = Histogram("http_request_duration_seconds", "Time to produce a response, by endpoint.",
+                                 ("endpoint",))
+        self.queries = Histogram("http_request_db_queries", "SQL statements per sampled request, by endpoint.",
+                                 ("endpoint",), QUERY_BUCKETS)
+        self.db_time = Histogram("http_request_db_seconds", "Time in SQL statements per sampled request, by endpoint.",
+                                 ("endpoint",))
+        self.templates = Histogram("template_render_seconds", "Template render time in sampled requests.",
+                                   ("template",))
+        self.cookies = Histogram("session_cookie_bytes", "Size of the session cookie sent with sampled requests.",
+                                 (), COOKIE_BUCKETS)
+        self.external = Histogram("external_call_duration_seconds", "Calls to other services, by outcome.",
+                                  ("service", "outcome"), EXTERNAL_BUCKETS)
+        self.collectors = [self.requests, self.latency, self.queries, self.db_time, self.templates, self.cookies,
+                           self.external]
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.sample_rate = float(app.config.get('METRICS_SAMPLE_RATE', 1.0))
+        self.server_timing = app.config.get('METRICS_SERVER_TIMING', True)
+        self.token = app.config.get('METRICS_TOKEN')
+        self.cookie_name = app.config.get('SESSION_COOKIE_NAME', "session")
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.teardown_request(self._teardown_request)
+        if self.sample_rate > 0:
+            # They only touch the request's own sample, so one pair serves every app
+            for name, listener in (("before_cursor_execute", Metrics._before_cursor_execute),
+                                   ("after_cursor_execute", Metrics._after_cursor_execute)):
+                if not event.contains(Engine, name, listener):
+                    event.listen(Engine, name, listener)
+            before_render_template.connect(self._before_render, app)
+            template_rendered.connect(self._after_render, app)
+        app.add_url_rule("/metrics", "metrics", self.view)
+        app.extensions['metrics'] = self
+
+    @contextmanager
+    def time_external(self, service):
+        '''Observes how long the enclosed call to ``service`` took, and whether it raised.'''
+        outcome = "error"
+        start = time.perf_counter()
+        try:
+            yield
+            outcome = "ok"
+        finally:
+            self.external.observe(time.perf_counter() - start, service, outcome)
+
+    def render(self):
+        '''Returns every metric in the Prometheus text exposition format.'''
+        lines = []
+        for collector in self.collectors:
+            lines.append("# HELP %s %s" % (collector.name, collector.help))
+            lines.append("# TYPE %s %s" % (collector.name, collector.kind))
+            lines.extend(collector.samples())
+        return "\n".join(lines) + "\n"
+
+    def view(self):
+        if self.token and request.headers.get("Authorization") != "Bearer " + self.token:
+            abort(401)
+        response = Response(self.render(), mimetype="text/plain")
+        response.headers['Content-Type'] = "text/plain; version=0.0.4; charset=utf-8"
+        response.cache_control.no_store = True
+        return response
+
+    def _before_request(self):
+        _started.set(time.perf_counter())
+        _sample.set(RequestSample() if self.sample_rate > 0 and random.random() < self.sample_rate else None)
+
+    def _after_request(self, response):
+        started = _started.get()
+        if started is None:
+            return response
+        elapsed = time.perf_counter() - started
+        endpoint = request.endpoint or "<unmatched>"
+        self.requests.inc(endpoint, request.method, response.status_code)
+        self.latency.observe(elapsed, endpoint)
+        sample = _sample.get()
+        if sample is not None:
+            self.queries.observe(sample.queries, endpoint)
+            self.db_time.observe(sample.db_seconds, endpoint)
+            self.cookies.observe(len(request.cookies.get(self.cookie_name, "")))
+            if self.server_timing:
+                response.headers.add(
+                    "Server-Timing", 'app;dur=%.1f, db;dur=%.1f;desc="%d queries", tpl;dur=%.1f'
+                    % (elapsed * 1000, sample.db_seconds * 1000, sample.queries, sample.template_seconds * 1000))
+        return response
+
+    def _teardown_request(self, exception=None):
+        _started.set(None)
+        _sample.set(None)
+
+    @staticmethod
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        sample = _sample.get()
+        if sample is not None:
+            sample.query_started = time.perf_counter()
+
+    @staticmethod
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        sample = _sample.get()
+        if sample is not None and sample.query_started is not None:
+            sample.queries += 1
+            sample.db_seconds += time.perf_counter() - sample.query_started
+            sample.query_started = None
+
+    def _before_render(self, sender, template, context, **extra):
+        sample = _sample.get()
+        if sample is not None:
+            sample.templates.append(time.perf_counter())
+
+    def _after_render(self, sender, template, context, **extra):
+        sample = _sample.get()
+        if sample is not None and sample.templates:
+            elapsed = time.perf_counter() - sample.templates.pop()
+            self.templates.observe(elapsed, template.name or "<string>")
+            # Templates rendered inside another are already part of its time
+            if not sample.templates:
+                sample.template_seconds += elapsed
+
+
+def external_call(app, service):
+    '''Times a call to ``service`` if the app has Metrics; a no-op context manager otherwise.'''
+    metrics = app.extensions.get('metrics') if app is not None else None
+    return metrics.time_external(service) if metrics is not None else nullcontext()
@@ -0,0 +1,29 @@
+"""index in-stock products by id
+
+Revision ID: 1e7c3a9f5b20
+Revises: 0b7e4d2a9c58
+Create Date: 2026-10-19 09:41:27.510348
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '1e7c3a9f5b20'
+down_revision = '0b7e4d2a9c58'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # The home listing filters on stock > 0 and orders by id, which the
+    # (stock, id) index can't serve in order; it scanned the table instead.
+    op.drop_index('ix_products_stock_id', table_name='products', if_exists=True)
+    op.create_index('ix_products_in_stock_id', 'products', ['id'], unique=False, if_not_exists=True,
+                    sqlite_where=sa.text('stock > 0'), postgresql_where=sa.text('stock > 0'))
+
+
+def downgrade():
+    op.drop_index('ix_products_in_stock_id', table_name='products', if_exists=True)
+    op.create_index('ix_products_stock_id', 'products', ['stock', 'id'], unique=False, if_not_exists=True)
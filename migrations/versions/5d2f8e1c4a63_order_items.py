@@ -0,0 +1,132 @@
+"""order_items table, backfilled from the customer_order.orders JSON
+
+Revision ID: 5d2f8e1c4a63
+Revises: 8c4e2b7a1d90
+Create Date: 2026-10-18 14:26:51.902114
+
+"""
+import json
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5d2f8e1c4a63'
+down_revision = '8c4e2b7a1d90'
+branch_labels = None
+depends_on = None
+
+
+# Orders converted per round trip; only one batch is held in memory at a time
+BATCH_SIZE = 500
+
+customer_order = sa.table(
+    'customer_order',
+    sa.column('id', sa.Integer),
+    sa.column('orders', sa.Text),
+)
+
+order_items = sa.table(
+    'order_items',
+    sa.column('order_id', sa.Integer),
+    sa.column('product_id', sa.Integer),
+    sa.column('product_name', sa.String),
+    sa.column('unit_price_cents', sa.Integer),
+    sa.column('discount', sa.Integer),
+    sa.column('quantity', sa.Integer),
+    sa.column('color', sa.String),
+)
+
+
+def upgrade():
+    # The app's db.create_all() may have created the empty table already
+    op.create_table('order_items',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('order_id', sa.Integer(), nullable=False),
+    sa.Column('product_id', sa.Integer(), nullable=False),
+    sa.Column('product_name', sa.String(length=250), nullable=False),
+    sa.Column('unit_price_cents', sa.Integer(), nullable=False),
+    sa.Column('discount', sa.Integer(), nullable=False),
+    sa.Column('quantity', sa.Integer(), nullable=False),
+    sa.Column('color', sa.String(length=250), nullable=True),
+    sa.ForeignKeyConstraint(['order_id'], ['customer_order.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id'),
+    if_not_exists=True
+    )
+    with op.batch_alter_table('order_items', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_order_items_order_id'), ['order_id'], unique=False, if_not_exists=True)
+        batch_op.create_index(batch_op.f('ix_order_items_product_id'), ['product_id'], unique=False, if_not_exists=True)
+
+    backfill(op.get_bind())
+
+
+def downgrade():
+    restore(op.get_bind())
+
+    with op.batch_alter_table('order_items', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_order_items_product_id'))
+        batch_op.drop_index(batch_op.f('ix_order_items_order_id'))
+
+    op.drop_table('order_items')
+
+
+def order_batches(conn, where=None):
+    '''Yields customer_order rows BATCH_SIZE at a time, walking the primary key.'''
+    last_id = 0
+    while True:
+        select = sa.select(customer_order.c.id, customer_order.c.orders).where(customer_order.c.id > last_id)
+        if where is not None:
+            select = select.where(where)
+        rows = conn.execute(select.order_by(customer_order.c.id).limit(BATCH_SIZE)).all()
+        if not rows:
+            return
+        yield rows
+        last_id = rows[-1].id
+
+
+def backfill(conn):
+    '''Copies every JSON snapshot into order_items.
+
+    The snapshot is left in place, so the migration can be downgraded and
+    the app's read fallback keeps working while it runs.
+    '''
+    # Skip orders that already have lines, e.g. placed after create_all() made the table
+    pending = ~sa.exists().where(order_items.c.order_id == customer_order.c.id)
+    for rows in order_batches(conn, pending):
+        lines = []
+        for order_id, orders in rows:
+            for key, line in json.loads(orders or '{}').items():
+                lines.append({
+                    'order_id': order_id,
+                    'product_id': int(key),
+                    'product_name': line['name'],
+                    'unit_price_cents': int(line['price']) * 100,
+                    'discount': int(line.get('discount') or 0),
+                    'quantity': int(line['quantity']),
+                    'color': line.get('color'),
+                })
+        if lines:
+            conn.execute(order_items.insert(), lines)
+
+
+def restore(conn):
+    '''Writes the JSON snapshot back for orders placed after the upgrade.'''
+    empty = sa.or_(customer_order.c.orders.is_(None), customer_order.c.orders.in_(['', '{}']))
+    for rows in order_batches(conn, empty):
+        ids = [row.id for row in rows]
+        snapshots = {order_id: {} for order_id in ids}
+        lines = conn.execute(sa.select(order_items).where(order_items.c.order_id.in_(ids)))
+        for line in lines:
+            snapshots[line.order_id][str(line.product_id)] = {
+                'name': line.product_name,
+                # The old column held whole dollars
+                'price': line.unit_price_cents // 100,
+                'discount': line.discount,
+                'color': line.color,
+                'quantity': line.quantity,
+            }
+        for order_id, snapshot in snapshots.items():
+            if snapshot:
+                conn.execute(customer_order.update().where(customer_order.c.id == order_id)
+                             .values(orders=json.dumps(snapshot)))
@@ -0,0 +1,61 @@
+"""product search index
+
+Revision ID: 6a9d4c1e8b37
+Revises: 1e7c3a9f5b20
+Create Date: 2026-10-19 14:05:51.226914
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6a9d4c1e8b37'
+down_revision = '1e7c3a9f5b20'
+branch_labels = None
+depends_on = None
+
+
+# products_fts is an external-content FTS5 table over products, kept in step by the triggers
+SCHEMA = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5("
+    " product_name, description, content='products', content_rowid='id',"
+    " tokenize='unicode61 remove_diacritics 2', prefix='2 3')",
+    "CREATE TRIGGER IF NOT EXISTS products_fts_insert AFTER INSERT ON products BEGIN"
+    " INSERT INTO products_fts(rowid, product_name, description)"
+    " VALUES (new.id, new.product_name, new.description); END",
+    "CREATE TRIGGER IF NOT EXISTS products_fts_delete AFTER DELETE ON products BEGIN"
+    " INSERT INTO products_fts(products_fts, rowid, product_name, description)"
+    " VALUES ('delete', old.id, old.product_name, old.description); END",
+    "CREATE TRIGGER IF NOT EXISTS products_fts_update AFTER UPDATE OF product_name, description ON products BEGIN"
+    " INSERT INTO products_fts(products_fts, rowid, product_name, description)"
+    " VALUES ('delete', old.id, old.product_name, old.description);"
+    " INSERT INTO products_fts(rowid, product_name, description)"
+    " VALUES (new.id, new.product_name, new.description); END",
+]
+
+TRIGGERS = ['products_fts_insert', 'products_fts_delete', 'products_fts_update']
+
+
+def fts5_available(bind):
+    return bind.dialect.name == 'sqlite' and \
+        bind.execute(sa.text("SELECT sqlite_compileoption_used('ENABLE_FTS5')")).scalar() == 1
+
+
+def upgrade():
+    # Without FTS5, e.g. on other databases, product search falls back to LIKE matching
+    bind = op.get_bind()
+    if not fts5_available(bind):
+        return
+    # Databases searched before this revision already have the table, filled by the search on first use
+    for statement in SCHEMA:
+        op.execute(statement)
+    op.execute("INSERT INTO products_fts(products_fts) VALUES ('rebuild')")
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    for trigger in TRIGGERS:
+        op.execute("DROP TRIGGER IF EXISTS %s" % trigger)
+    op.execute("DROP TABLE IF EXISTS products_fts")
@@ -0,0 +1,55 @@
+"""hot path indexes and integer customer_id
+
+Revision ID: 8c4e2b7a1d90
+Revises: 3f5a1c2d9b7e
+Create Date: 2026-10-18 11:02:14.318407
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8c4e2b7a1d90'
+down_revision = '3f5a1c2d9b7e'
+branch_labels = None
+depends_on = None
+
+
+PRODUCT_INDEXES = [
+    ('ix_products_brand_id_id', ['brand_id', 'id']),
+    ('ix_products_category_id_id', ['category_id', 'id']),
+    ('ix_products_stock_id', ['stock', 'id']),
+    ('ix_products_price_id', ['price', 'id']),
+]
+
+
+def upgrade():
+    # Databases created by db.create_all() may already have these
+    for name, columns in PRODUCT_INDEXES:
+        op.create_index(name, 'products', columns, unique=False, if_not_exists=True)
+
+    # customer_id held str(current_user.id); make it a real foreign key.
+    # SQLite rebuilds the table, converting the digit strings through
+    # INTEGER affinity; PostgreSQL needs an explicit cast.
+    with op.batch_alter_table('customer_order', schema=None) as batch_op:
+        batch_op.alter_column('customer_id',
+                              existing_type=sa.String(length=100),
+                              type_=sa.Integer(),
+                              existing_nullable=False,
+                              postgresql_using='customer_id::integer')
+        batch_op.create_foreign_key('fk_customer_order_customer_id_users', 'users', ['customer_id'], ['id'])
+        batch_op.create_index('ix_customer_order_customer_id_invoice', ['customer_id', 'invoice'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('customer_order', schema=None) as batch_op:
+        batch_op.drop_index('ix_customer_order_customer_id_invoice')
+        batch_op.drop_constraint('fk_customer_order_customer_id_users', type_='foreignkey')
+        batch_op.alter_column('customer_id',
+                              existing_type=sa.Integer(),
+                              type_=sa.String(length=100),
+                              existing_nullable=False)
+
+    for name, _columns in reversed(PRODUCT_INDEXES):
+        op.drop_index(name, table_name='products', if_exists=True)
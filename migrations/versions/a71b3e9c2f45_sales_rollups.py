@@ -0,0 +1,65 @@
+"""sales rollup tables
+
+Revision ID: a71b3e9c2f45
+Revises: 5d2f8e1c4a63
+Create Date: 2026-10-18 16:08:37.524190
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a71b3e9c2f45'
+down_revision = '5d2f8e1c4a63'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Fill them afterwards with `flask sales rebuild`
+    op.create_table('sales_daily',
+    sa.Column('day', sa.Date(), nullable=False),
+    sa.Column('orders', sa.Integer(), nullable=False),
+    sa.Column('units', sa.Integer(), nullable=False),
+    sa.Column('revenue_cents', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('day'),
+    if_not_exists=True
+    )
+    op.create_table('sales_by_product',
+    sa.Column('product_id', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('product_name', sa.String(length=250), nullable=False),
+    sa.Column('orders', sa.Integer(), nullable=False),
+    sa.Column('units', sa.Integer(), nullable=False),
+    sa.Column('revenue_cents', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('product_id'),
+    if_not_exists=True
+    )
+    with op.batch_alter_table('sales_by_product', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_sales_by_product_revenue_cents'), ['revenue_cents'], unique=False,
+                              if_not_exists=True)
+
+    op.create_table('sales_by_brand',
+    sa.Column('brand_id', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('orders', sa.Integer(), nullable=False),
+    sa.Column('units', sa.Integer(), nullable=False),
+    sa.Column('revenue_cents', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['brand_id'], ['brands.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('brand_id'),
+    if_not_exists=True
+    )
+    with op.batch_alter_table('sales_by_brand', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_sales_by_brand_revenue_cents'), ['revenue_cents'], unique=False,
+                              if_not_exists=True)
+
+
+def downgrade():
+    with op.batch_alter_table('sales_by_brand', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_sales_by_brand_revenue_cents'))
+
+    op.drop_table('sales_by_brand')
+    with op.batch_alter_table('sales_by_product', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_sales_by_product_revenue_cents'))
+
+    op.drop_table('sales_by_product')
+    op.drop_table('sales_daily')
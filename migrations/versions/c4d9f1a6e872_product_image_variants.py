@@ -0,0 +1,27 @@
+"""product image variants
+
+Revision ID: c4d9f1a6e872
+Revises: a71b3e9c2f45
+Create Date: 2026-10-18 17:41:05.216733
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c4d9f1a6e872'
+down_revision = 'a71b3e9c2f45'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Generate the derivatives afterwards with `flask images backfill`
+    with op.batch_alter_table('products', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('image_variants', sa.Text(), server_default='{}', nullable=False))
+
+
+def downgrade():
+    with op.batch_alter_table('products', schema=None) as batch_op:
+        batch_op.drop_column('image_variants')
@@ -0,0 +1,33 @@
+"""longer password hashes
+
+Revision ID: e2b8d5f17c39
+Revises: c4d9f1a6e872
+Create Date: 2026-10-18 19:12:47.530118
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e2b8d5f17c39'
+down_revision = 'c4d9f1a6e872'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # scrypt and 1,000,000-iteration pbkdf2 hashes with a 16 character salt don't fit in 100
+    with op.batch_alter_table('users', schema=None) as batch_op:
+        batch_op.alter_column('password',
+                              existing_type=sa.String(length=100),
+                              type_=sa.String(length=255),
+                              existing_nullable=False)
+
+
+def downgrade():
+    with op.batch_alter_table('users', schema=None) as batch_op:
+        batch_op.alter_column('password',
+                              existing_type=sa.String(length=255),
+                              type_=sa.String(length=100),
+                              existing_nullable=False)
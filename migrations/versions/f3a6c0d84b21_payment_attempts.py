@@ -0,0 +1,53 @@
+"""payment attempts
+
+Revision ID: f3a6c0d84b21
+Revises: e2b8d5f17c39
+Create Date: 2026-10-18 20:03:31.774520
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f3a6c0d84b21'
+down_revision = 'e2b8d5f17c39'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Databases created by db.create_all() may already have the table
+    op.create_table('payment_attempts',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('order_id', sa.Integer(), nullable=False),
+    sa.Column('number', sa.Integer(), nullable=False),
+    sa.Column('idempotency_key', sa.String(length=150), nullable=False),
+    sa.Column('status', sa.String(length=20), nullable=False),
+    sa.Column('amount_cents', sa.Integer(), nullable=False),
+    sa.Column('currency', sa.String(length=3), nullable=False),
+    sa.Column('token', sa.String(length=255), nullable=True),
+    sa.Column('email', sa.String(length=250), nullable=True),
+    sa.Column('charge_id', sa.String(length=100), nullable=True),
+    sa.Column('error', sa.String(length=500), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['order_id'], ['customer_order.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('idempotency_key'),
+    sa.UniqueConstraint('order_id', 'number', name='uq_payment_attempts_order_id_number'),
+    if_not_exists=True
+    )
+    op.create_index('ix_payment_attempts_order_id', 'payment_attempts', ['order_id'], unique=False,
+                    if_not_exists=True)
+    op.create_index('ix_payment_attempts_status', 'payment_attempts', ['status'], unique=False,
+                    if_not_exists=True)
+    op.create_index('ix_payment_attempts_charge_id', 'payment_attempts', ['charge_id'], unique=False,
+                    if_not_exists=True)
+
+
+def downgrade():
+    op.drop_index('ix_payment_attempts_charge_id', table_name='payment_attempts')
+    op.drop_index('ix_payment_attempts_status', table_name='payment_attempts')
+    op.drop_index('ix_payment_attempts_order_id', table_name='payment_attempts')
+    op.drop_table('payment_attempts')
@@ -0,0 +1,365 @@
+'''
+    Page cache
+
+    ----------
+
+    Whole-page and fragment caching for the anonymous catalog.
+
+    Cache keys include a catalog version that is bumped after every commit
+    that writes a Product, Brand or Category row, stock changes included,
+    so entries never need to be deleted: a write makes them unreachable and
+    the backend ages them out.
+
+    Full pages are only cached and served for anonymous visitors without a
+    cart or pending flash messages; everyone else gets a freshly rendered
+    page. Fragments such as the navbar and product cards carry no per-user
+    data and are shared by all visitors.
+
+    Backends: ``memory``, an LRU capped in bytes per process, and
+    ``filesystem``, shared by every worker on the host. The filesystem
+    backend also keeps the catalog version, as the size of a file that each
+    bump appends one byte to, so all workers see a write at once. Its reads
+    and writes are file I/O, which ``cached_async()`` runs on a thread so
+    as not to block the event loop.
+
+'''
+
+import asyncio
+from collections import OrderedDict, defaultdict
+from functools import wraps
+import hashlib
+import os
+import pickle
+import tempfile
+import threading
+import time
+
+from flask import current_app, has_app_context, make_response, request, session
+from flask_login import current_user
+from markupsafe import Markup
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+
+class MemoryBackend(object):
+    '''Per-process LRU of entries, capped at ``max_bytes`` of cached bodies.'''
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.version = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key, entry, size):
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.size -= previous[1]
+            self._entries[key] = (entry, size)
+            self.size += size
+            while self.size > self.max_bytes and self._entries:
+                _key, (_entry, evicted) = self._entries.popitem(last=False)
+                self.size -= evicted
+
+    def get_version(self):
+        return self.version
+
+    def bump_version(self):
+        with self._lock:
+            self.version += 1
+
+
+class FileSystemBackend(object):
+    '''Entries pickled to files in ``directory``, oldest evicted past ``max_bytes``.'''
+
+    evict_every = 32
+
+    def __init__(self, directory, max_bytes=256 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.version_path = os.path.join(directory, "catalog.version")
+        self._puts = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(repr(key).encode("utf-8")).hexdigest() + ".cache")
+
+    def get(self, key):
+        try:
+            with open(self._path(key), "rb") as cached:
+                return pickle.load(cached)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def set(self, key, entry, size):
+        handle, temporary = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(handle, "wb") as output:
+                pickle.dump((entry, size), output, pickle.HIGHEST_PROTOCOL)
+            os.replace(temporary, self._path(key))
+        except BaseException:
+            os.unlink(temporary)
+            raise
+        with self._lock:
+            self._puts += 1
+            if self._puts % self.evict_every == 0:
+                self._evict()
+
+    def get_version(self):
+        try:
+            return os.stat(self.version_path).st_size
+        except OSError:
+            return 0
+
+    def bump_version(self):
+        # An O_APPEND write is atomic, so concurrent bumps from several workers all count
+        descriptor = os.open(self.version_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(descriptor, b".")
+        finally:
+            os.close(descriptor)
+
+    def _evict(self):
+        entries = []
+        total = 0
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(".cache"):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+        entries.sort()
+        for _mtime, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+
+class NullBackend(object):
+    '''Caches nothing.'''
+
+    def get(self, key):
+        return None
+
+    def set(self, key, entry, size):
+        pass
+
+    def get_version(self):
+        return 0
+
+    def bump_version(self):
+        pass
+
+
+class PageCache(object):
+    '''Caches catalog pages for anonymous visitors, and template fragments for everyone.
+
+    To initialize, pass the models that make up the catalog, then your flask app's object::
+
+        page_cache = PageCache(Product, Brand, Category)
+        page_cache.init_app(app)
+
+    Decorate views with ``@PageCache.cached()``, which caches in the current
+    app's PageCache, and wrap template fragments in::
+
+        {% call cache_fragment("product_card", product.id) %}...{% endcall %}
+
+    Config variables read from the app:
+
+        PAGE_CACHE_BACKEND = "memory"                  # memory, filesystem or null
+        PAGE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+        PAGE_CACHE_DIR = "<instance>/page_cache"       # for the filesystem backend
+        PAGE_CACHE_TTL = 300                           # seconds
+
+    '''
+
+    # Session keys that mean the page is personal: a login, a cart or a flash message
+    bypass_session_keys = ("_user_id", "cart_id", "_flashes")
+
+    def __init__(self, *catalog_models):
+        self.catalog_models = catalog_models
+        self.backend = NullBackend()
+        self.ttl = 300
+        self._stats = defaultdict(lambda: {"hits": 0, "misses": 0, "bypassed": 0})
+        self._stats_lock = threading.Lock()
+
+    def init_app(self, app):
+        backend = app.config.get('PAGE_CACHE_BACKEND', "memory")
+        max_bytes = app.config.get('PAGE_CACHE_MAX_BYTES', 64 * 1024 * 1024)
+        if backend == "filesystem":
+            self.backend = FileSystemBackend(
+                app.config.get('PAGE_CACHE_DIR') or os.path.join(app.instance_path, "page_cache"), max_bytes)
+        elif backend == "memory":
+            self.backend = MemoryBackend(max_bytes)
+        else:
+            self.backend = NullBackend()
+        self.ttl = app.config.get('PAGE_CACHE_TTL', 300)
+        app.add_template_global(self.fragment, "cache_fragment")
+        for name, listener in (("before_flush", PageCache._before_flush), ("after_commit", PageCache._after_commit),
+                               ("after_rollback", PageCache._after_rollback)):
+            if not event.contains(Session, name, listener):
+                event.listen(Session, name, listener)
+        app.extensions['page_cache'] = self
+
+    @property
+    def version(self):
+        return self.backend.get_version()
+
+    @property
+    def blocking(self):
+        '''Whether the backend reads and writes files, which async views keep off the event loop.'''
+        return isinstance(self.backend, FileSystemBackend)
+
+    def invalidate(self):
+        self.backend.bump_version()
+
+    @staticmethod
+    def cached():
+        '''Decorator caching a view's 200 GET responses for anonymous visitors.'''
+        def decorator(view):
+            @wraps(view)
+            def decorated(*args, **kwargs):
+                page_cache = current_app.extensions['page_cache']
+                key, response = page_cache._lookup(kwargs)
+                if response is not None:
+                    return response
+                if key is None:
+                    return view(*args, **kwargs)
+                return page_cache._store(key, make_response(view(*args, **kwargs)))
+            return decorated
+        return decorator
+
+    @staticmethod
+    def cached_async():
+        '''cached() for ``async def`` views; pages are shared with the sync view of the same endpoint.'''
+        def decorator(view):
+            @wraps(view)
+            async def decorated(*args, **kwargs):
+                page_cache = current_app.extensions['page_cache']
+                if page_cache.blocking:
+                    key, response = await asyncio.to_thread(page_cache._lookup, kwargs)
+                else:
+                    key, response = page_cache._lookup(kwargs)
+                if response is not None:
+                    return response
+                if key is None:
+                    return await view(*args, **kwargs)
+                response = make_response(await view(*args, **kwargs))
+                if page_cache.blocking:
+                    return await asyncio.to_thread(page_cache._store, key, response)
+                return page_cache._store(key, response)
+            return decorated
+        return decorator
+
+    def _lookup(self, view_args):
+        '''Returns ``(key, cached response)``; the key is None when the request isn't cacheable.'''
+        endpoint = request.endpoint
+        if not self._cacheable():
+            self._count(endpoint, "bypassed")
+            return None, None
+        key = ("page", endpoint, tuple(sorted(view_args.items())),
+               tuple(sorted(request.args.items(multi=True))), self.version)
+        entry = self._get(key)
+        if entry is None:
+            self._count(endpoint, "misses")
+            return key, None
+        self._count(endpoint, "hits")
+        body, status, headers = entry
+        response = current_app.response_class(body, status, headers)
+        response.headers['X-Cache'] = "HIT"
+        return key, response
+
+    def _store(self, key, response):
+        if response.status_code == 200 and not response.direct_passthrough \
+                and 'Set-Cookie' not in response.headers:
+            body = response.get_data()
+            headers = [(name, value) for name, value in response.headers.items()
+                       if name.lower() not in ("set-cookie", "content-length")]
+            self._set(key, (body, response.status_code, headers), len(body))
+        response.headers['X-Cache'] = "MISS"
+        return response
+
+    def fragment(self, name, *key, caller):
+        '''Jinja call-block helper: renders the block once per key and catalog version.'''
+        cache_key = ("fragment", name, key, self.version)
+        html = self._get(cache_key)
+        if html is None:
+            self._count("fragment:" + name, "misses")
+            html = str(caller())
+            self._set(cache_key, html, len(html))
+        else:
+            self._count("fragment:" + name, "hits")
+        return Markup(html)
+
+    def stats(self):
+        '''Returns hit counts and hit ratios per route and fragment.'''
+        with self._stats_lock:
+            stats = {name: dict(counts) for name, counts in self._stats.items()}
+        for counts in stats.values():
+            lookups = counts["hits"] + counts["misses"]
+            counts["hit_ratio"] = round(counts["hits"] / lookups, 4) if lookups else None
+        return {"version": self.version, "routes": stats}
+
+    def _cacheable(self):
+        if request.method != "GET" or current_user.is_authenticated:
+            return False
+        return not any(key in session for key in self.bypass_session_keys)
+
+    def _get(self, key):
+        cached = self.backend.get(key)
+        if cached is None:
+            return None
+        (expires, value), _size = cached
+        if expires < time.time():
+            return None
+        return value
+
+    def _set(self, key, value, size):
+        self.backend.set(key, (time.time() + self.ttl, value), size)
+
+    def _count(self, name, outcome):
+        with self._stats_lock:
+            self._stats[name][outcome] += 1
+
+    def _touches_catalog(self, session):
+        for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+            if isinstance(obj, self.catalog_models):
+                return True
+        return False
+
+    @staticmethod
+    def _current():
+        return current_app.extensions.get('page_cache') if has_app_context() else None
+
+    @classmethod
+    def _before_flush(cls, session, flush_context, instances):
+        page_cache = cls._current()
+        if page_cache is not None and not session.info.get("page_cache_dirty") \
+                and page_cache._touches_catalog(session):
+            session.info["page_cache_dirty"] = True
+
+    @classmethod
+    def _after_commit(cls, session):
+        page_cache = cls._current()
+        if session.info.pop("page_cache_dirty", False) and page_cache is not None:
+            page_cache.invalidate()
+
+    @classmethod
+    def _after_rollback(cls, session):
+        session.info.pop("page_cache_dirty", None)
@@ -0,0 +1,175 @@
+'''
+    Keyset pagination
+
+    -----------------
+
+    Seek-based pagination for product listings.
+
+    Instead of ``OFFSET n``, each page starts right after the sort key of the
+    last row on the previous page, e.g. ``WHERE id < :last_id ORDER BY id DESC``.
+    Backed by an index on the sort key, every page costs the same however deep
+    it is. The position is carried between requests as an opaque cursor.
+
+    Totals are a cached ``COUNT(*)`` per listing, refreshed every
+    ``count_ttl`` seconds, so they are approximate right after a write.
+
+'''
+
+import base64
+import binascii
+import json
+import threading
+import time
+
+from sqlalchemy import func, tuple_
+
+
+class InvalidCursor(ValueError):
+    '''Raised for a cursor that wasn't produced by this paginator.'''
+
+
+def encode_cursor(sort, values, direction):
+    payload = json.dumps([sort, values, direction], separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor):
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        sort, values, direction = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+    except (ValueError, TypeError, binascii.Error):
+        raise InvalidCursor(cursor)
+    if direction not in ("next", "prev") or not isinstance(values, list):
+        raise InvalidCursor(cursor)
+    return sort, values, direction
+
+
+class KeysetPage(object):
+    '''One page of results plus the cursors to its neighbours.'''
+
+    def __init__(self, items, sort, next_cursor, prev_cursor, total, per_page):
+        self.items = items
+        self.sort = sort
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+        self.total = total
+        self.per_page = per_page
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+    def __iter__(self):
+        return iter(self.items)
+
+
+class KeysetPaginator(object):
+    '''Paginates product selects by a named sort order.
+
+    To initialize, pass the database and the model being listed, then your flask app's object::
+
+        paginator = KeysetPaginator(db, Product, app=app)
+
+    Sort orders map a name to the model columns making up a unique key and
+    whether it is descending; the default lists newest products first.
+    '''
+
+    def __init__(self, db, model, sorts=None, count_ttl=60, app=None):
+        self.db = db
+        self.model = model
+        self.sorts = sorts or {
+            "newest": ((model.id,), True),
+            "price_asc": ((model.price, model.id), False),
+            "price_desc": ((model.price, model.id), True),
+        }
+        self.count_ttl = count_ttl
+        self._counts = {}
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['keyset_paginator'] = self
+
+    def paginate(self, select, count_key, cursor=None, sort="newest", per_page=8):
+        '''Returns a KeysetPage of ``select``.
+
+        :param select: A ``db.select(Model)`` with the listing's filters applied.
+        :param count_key: Hashable name of the listing, used to cache its total.
+        :param cursor: Cursor from a previous page's ``next_cursor``/``prev_cursor``.
+        :raises InvalidCursor: if ``cursor`` can't be decoded.
+        '''
+        plan = self._plan(select, cursor, sort, per_page)
+        total = self._cached_count(count_key)
+        if total is None:
+            total = self._store_count(count_key, self.db.session.execute(self._count_query(select)).scalar())
+        rows = self.db.session.execute(plan[0]).scalars().all()
+        return self._page(rows, plan, total, per_page)
+
+    async def paginate_async(self, session, select, count_key, cursor=None, sort="newest", per_page=8):
+        '''paginate() for the async views, querying through ``session``, an AsyncSession.'''
+        plan = self._plan(select, cursor, sort, per_page)
+        total = self._cached_count(count_key)
+        if total is None:
+            total = self._store_count(count_key, (await session.execute(self._count_query(select))).scalar())
+        rows = (await session.execute(plan[0])).scalars().all()
+        return self._page(rows, plan, total, per_page)
+
+    def _plan(self, select, cursor, sort, per_page):
+        '''Returns the page's query, and what _page() needs to turn its rows into a KeysetPage.'''
+        if sort not in self.sorts:
+            sort = "newest"
+        columns, descending = self.sorts[sort]
+        direction = "next"
+        values = None
+        if cursor:
+            cursor_sort, values, direction = decode_cursor(cursor)
+            if cursor_sort != sort or len(values) != len(columns):
+                raise InvalidCursor(cursor)
+
+        # Going back a page walks the index the other way and flips the rows afterwards.
+        backwards = direction == "prev"
+        reverse = descending != backwards
+        key = tuple_(*columns)
+        if values is not None:
+            select = select.where(key < tuple_(*values) if reverse else key > tuple_(*values))
+        select = select.order_by(*[column.desc() if reverse else column.asc() for column in columns])
+        return select.limit(per_page + 1), sort, columns, values, backwards
+
+    @staticmethod
+    def _page(rows, plan, total, per_page):
+        _query, sort, columns, values, backwards = plan
+        more = len(rows) > per_page
+        rows = rows[:per_page]
+        if backwards:
+            rows.reverse()
+
+        def key_of(row):
+            return [getattr(row, column.key) for column in columns]
+
+        next_cursor = prev_cursor = None
+        if rows:
+            if more or backwards:
+                next_cursor = encode_cursor(sort, key_of(rows[-1]), "next")
+            if values is not None and (more or not backwards):
+                prev_cursor = encode_cursor(sort, key_of(rows[0]), "prev")
+        return KeysetPage(rows, sort, next_cursor, prev_cursor, total, per_page)
+
+    def _count_query(self, select):
+        return select.with_only_columns(func.count()).select_from(self.model).order_by(None)
+
+    def _cached_count(self, count_key):
+        with self._lock:
+            cached = self._counts.get(count_key)
+            if cached is not None and cached[1] > time.monotonic():
+                return cached[0]
+        return None
+
+    def _store_count(self, count_key, total):
+        with self._lock:
+            self._counts[count_key] = (total, time.monotonic() + self.count_ttl)
+        return total
@@ -0,0 +1,150 @@
+'''
+    Password hashing
+
+    ----------------
+
+    Password hashing and checking, off the request thread and rate limited.
+
+    A key derivation function is deliberately slow: a burst of logins that
+    each run one inline can take every core from the catalog. Here the work
+    runs on a small thread pool (hashlib releases the GIL while deriving
+    keys), so at most ``PASSWORD_HASH_WORKERS`` hashes are computed at once
+    whatever the number of login requests. Requests past the wait queue fail
+    fast with HashingBusy instead of piling up.
+
+    The method and work factors are set with ``PASSWORD_HASH_METHOD``, in
+    werkzeug's ``generate_password_hash`` format. A stored hash made with
+    any other method or factors, or with a salt shorter than
+    ``PASSWORD_SALT_LENGTH``, still verifies, and ``verify_and_update``
+    returns a replacement for it so it is upgraded on the next login.
+
+'''
+
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+import threading
+
+from werkzeug.security import DEFAULT_PBKDF2_ITERATIONS, check_password_hash, generate_password_hash
+
+
+class HashingBusy(Exception):
+    '''Raised when a password can't be hashed or checked in time because the pool is saturated.'''
+
+
+def normalize_method(method):
+    '''Spells out werkzeug's defaults, e.g. "pbkdf2" becomes "pbkdf2:sha256:1000000".'''
+    name, *args = method.split(":")
+    if name == "scrypt":
+        defaults = ["32768", "8", "1"]
+    elif name == "pbkdf2":
+        defaults = ["sha256", str(DEFAULT_PBKDF2_ITERATIONS)]
+    else:
+        return method
+    return ":".join([name] + args + defaults[len(args):])
+
+
+class PasswordHasher(object):
+    '''Hashes and verifies passwords on a bounded worker pool.
+
+    To initialize, pass your flask app's object::
+
+        passwords = PasswordHasher(app)
+
+        valid, new_hash = passwords.verify_and_update(user.password, password)
+
+    Config variables read from the app:
+
+        PASSWORD_HASH_METHOD = "scrypt:32768:8:1"    # as for generate_password_hash
+        PASSWORD_SALT_LENGTH = 16
+        PASSWORD_HASH_WORKERS = 2                    # hashes computed at once
+        PASSWORD_HASH_QUEUE_SIZE = 32                # hashes allowed to wait for a worker
+        PASSWORD_HASH_TIMEOUT = 10                   # seconds a request waits for its hash
+
+    '''
+
+    def __init__(self, app=None):
+        self.hashed = 0
+        self.verified = 0
+        self.upgraded = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+        self._executor = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.method = normalize_method(app.config.get('PASSWORD_HASH_METHOD', "scrypt:32768:8:1"))
+        self.salt_length = app.config.get('PASSWORD_SALT_LENGTH', 16)
+        self.workers = app.config.get('PASSWORD_HASH_WORKERS', 2)
+        self.queue_size = app.config.get('PASSWORD_HASH_QUEUE_SIZE', 32)
+        self.timeout = app.config.get('PASSWORD_HASH_TIMEOUT', 10)
+        self._slots = threading.BoundedSemaphore(self.workers + self.queue_size)
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="password-hash")
+        app.extensions['password_hasher'] = self
+
+    def hash(self, password):
+        '''Returns a new hash of ``password`` with the configured method.
+
+        :raises HashingBusy: when the pool is saturated.
+        '''
+        new_hash = self._run(generate_password_hash, password, method=self.method, salt_length=self.salt_length)
+        with self._lock:
+            self.hashed += 1
+        return new_hash
+
+    def verify(self, stored_hash, password):
+        '''Returns whether ``password`` matches ``stored_hash``, whatever method made it.
+
+        :raises HashingBusy: when the pool is saturated.
+        '''
+        valid = self._run(check_password_hash, stored_hash, password)
+        with self._lock:
+            self.verified += 1
+        return valid
+
+    def needs_rehash(self, stored_hash):
+        '''Returns whether ``stored_hash`` was made with other settings than the configured ones.'''
+        try:
+            method, salt, _digest = stored_hash.split("$", 2)
+        except ValueError:
+            return True
+        return normalize_method(method) != self.method or len(salt) < self.salt_length
+
+    def verify_and_update(self, stored_hash, password):
+        '''Checks ``password``; returns ``(valid, new_hash)``.
+
+        ``new_hash`` is a hash with the current settings when the password is
+        valid but ``stored_hash`` is outdated, None otherwise.
+        '''
+        if not self.verify(stored_hash, password):
+            return False, None
+        if not self.needs_rehash(stored_hash):
+            return True, None
+        new_hash = self.hash(password)
+        with self._lock:
+            self.upgraded += 1
+        return True, new_hash
+
+    def stats(self):
+        return {"method": self.method, "hashed": self.hashed, "verified": self.verified,
+                "upgraded": self.upgraded, "rejected": self.rejected}
+
+    def _run(self, function, *args, **kwargs):
+        if not self._slots.acquire(blocking=False):
+            self._reject()
+            raise HashingBusy("%d password hashes already pending" % (self.workers + self.queue_size))
+        try:
+            future = self._executor.submit(function, *args, **kwargs)
+        except BaseException:
+            self._slots.release()
+            raise
+        # The slot is held until the hash is done, even if this request stops waiting for it
+        future.add_done_callback(lambda done: self._slots.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            self._reject()
+            raise HashingBusy("Password hash not done in %s seconds" % self.timeout)
+
+    def _reject(self):
+        with self._lock:
+            self.rejected += 1
@@ -0,0 +1,434 @@
+'''
+    Payments
+
+    --------
+
+    Stripe charges for orders, made off the request thread and safe to retry.
+
+    Paying an order records a PaymentAttempt and returns straight away; a
+    small worker pool then creates the charge through one pooled HTTP
+    client. Every attempt has an idempotency key derived from the invoice,
+    ``charge:<invoice>:<attempt number>``, so a retried or double-submitted
+    POST, a network retry and ``flask payments resume`` after a crash all
+    reach Stripe as the same charge. A new attempt, and so a new charge, is
+    only made once the previous one has failed.
+
+    An attempt moves ``created`` -> ``submitted`` -> ``pending`` ->
+    ``succeeded`` or ``failed``. Each move is a conditional UPDATE from the
+    states it may come from, so the worker and the webhook can report the
+    same charge in any order and the order is marked "Paid" exactly once.
+    Charges Stripe settles at once are settled by the worker; the others are
+    confirmed by the ``charge.succeeded``/``charge.failed`` webhook.
+
+    When Stripe can't be reached the attempt stays submitted, with a note
+    the order page shows, and the charge is retried in the background with
+    the same key after each of ``PAYMENT_RETRY_DELAYS``. After the last one
+    the attempt fails, so the customer can pay again. Stripe may have
+    taken the charge after all, so the webhook can still move a failed
+    attempt to succeeded, and paying again first looks the charge up by the
+    attempt id in its metadata: only once Stripe has no charge for the
+    attempt, or declined it, is a new attempt made with a new key. While
+    Stripe still can't be reached nothing is charged. Search results lag
+    writes by up to a minute, well within the retry delays. ``flask
+    payments resume`` covers attempts whose retries were lost to a restart.
+
+    Served over ASGI, the payment view calls start_async() instead: the
+    attempt is recorded through an AsyncSession and the charge is awaited by
+    a task on the event loop, through httpx, rather than holding a pool
+    thread for the length of the Stripe call. The states and keys are the
+    same, so either kind of worker, the webhook and ``flask payments
+    resume`` can pick up each other's attempts.
+
+    Set ``STRIPE_API_BASE`` to the address of ``stripe_stub.py`` to run
+    without Stripe, e.g. in tests and load runs. The stripe library is only
+    imported, and the client created, once a charge or webhook needs them.
+
+'''
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+from datetime import datetime
+import threading
+
+import click
+from flask import abort, request
+from flask.cli import AppGroup
+from sqlalchemy.exc import IntegrityError
+
+from metrics import external_call
+from sales_rollups import PAID
+
+
+CREATED = "created"
+SUBMITTED = "submitted"
+PENDING = "pending"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+
+# The states an attempt may move to each state from
+TRANSITIONS = {
+    SUBMITTED: (CREATED, SUBMITTED),
+    # From failed too: a charge given up on as unreachable may have gone through after all
+    PENDING: (CREATED, SUBMITTED, FAILED),
+    SUCCEEDED: (CREATED, SUBMITTED, PENDING, FAILED),
+    FAILED: (CREATED, SUBMITTED, PENDING),
+}
+
+IN_PROGRESS = (CREATED, SUBMITTED, PENDING)
+
+# Shown on the order page while a charge Stripe couldn't be reached for waits to be retried, and once it gives up
+RETRYING = "We couldn't reach our payment processor and are trying again..."
+UNREACHABLE = "We couldn't reach our payment processor. Please try again in a few minutes."
+
+
+class Payments(object):
+    '''Creates and confirms Stripe charges for orders.
+
+    To initialize, pass the database, payment attempt and order models, then your flask app's object::
+
+        payments = Payments(db, PaymentAttempt, CustomerOrder, app)
+
+        attempt = payments.start(order, amount_cents, request.form['stripeToken'], email)
+
+    In an async view, with an AsyncSession from the app's AsyncServing::
+
+        attempt = await payments.start_async(session, order, amount_cents, request.form['stripeToken'], email)
+
+    The webhook is served at ``/stripe/webhook``.
+
+    Config variables read from the app:
+
+        STRIPE_SECRET_KEY = None
+        STRIPE_WEBHOOK_SECRET = None      # webhook events are refused without it
+        STRIPE_API_BASE = None            # e.g. "http://127.0.0.1:12111" for the stub
+        STRIPE_TIMEOUT = 10               # seconds per HTTP request
+        STRIPE_MAX_RETRIES = 2            # network retries, safe thanks to the idempotency keys
+        PAYMENT_WORKERS = 4               # charges in flight at once; over ASGI, httpx's pool of 100 connections
+        PAYMENT_RETRY_DELAYS = (5, 30, 120)   # seconds before each retry of a charge Stripe couldn't be reached for
+
+    '''
+
+    def __init__(self, db, attempt_model, order_model, app=None):
+        self.db = db
+        self.attempt_model = attempt_model
+        self.order_model = order_model
+        self._executor = None
+        self._client = None
+        self._client_lock = threading.Lock()
+        self._async_client = None
+        self._tasks = set()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.currency = app.config.get('PAYMENT_CURRENCY', "usd")
+        self.webhook_secret = app.config.get('STRIPE_WEBHOOK_SECRET')
+        self.workers = app.config.get('PAYMENT_WORKERS', 4)
+        self.retry_delays = tuple(app.config.get('PAYMENT_RETRY_DELAYS', (5, 30, 120)))
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="payment")
+        app.add_url_rule("/stripe/webhook", "stripe_webhook", self.webhook, methods=["POST"])
+        app.cli.add_command(self._cli())
+        app.extensions['payments'] = self
+
+    @property
+    def client(self):
+        '''The StripeClient, created on first use.'''
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    import requests
+                    from requests.adapters import HTTPAdapter
+                    import stripe
+
+                    # One keep-alive connection per worker, instead of a new TLS handshake per charge
+                    http = requests.Session()
+                    http.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=self.workers))
+                    http.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=self.workers))
+                    self._client = self._stripe_client(
+                        stripe.RequestsClient(timeout=self.app.config.get('STRIPE_TIMEOUT', 10), session=http))
+        return self._client
+
+    @property
+    def async_client(self):
+        '''The StripeClient for start_async(), on httpx's asyncio client; created on first use.'''
+        if self._async_client is None:
+            import stripe
+
+            timeout = self.app.config.get('STRIPE_TIMEOUT', 10)
+            self._async_client = self._stripe_client(stripe.HTTPXClient(timeout=timeout))
+        return self._async_client
+
+    def _stripe_client(self, http_client):
+        import stripe
+
+        config = self.app.config
+        base = config.get('STRIPE_API_BASE')
+        return stripe.StripeClient(
+            config.get('STRIPE_SECRET_KEY') or "",
+            base_addresses={"api": base} if base else None,
+            max_network_retries=config.get('STRIPE_MAX_RETRIES', 2),
+            http_client=http_client,
+        )
+
+    def latest(self, order):
+        '''Returns the order's most recent PaymentAttempt, or None.'''
+        return self.db.session.execute(self._latest_query(order)).scalar()
+
+    def start(self, order, amount_cents, token, email=None):
+        '''Starts paying ``order``; returns its PaymentAttempt.
+
+        If an attempt is already in progress or has succeeded, that attempt is
+        returned and nothing is charged; so is a failed attempt whose charge may
+        yet have gone through, while Stripe can't be reached to tell.
+        '''
+        import stripe
+
+        attempt = self.latest(order)
+        if attempt is not None and attempt.status != FAILED:
+            return attempt
+        if attempt is not None and self._gave_up_on(attempt):
+            try:
+                charge = self._find_charge(attempt)
+            except stripe.StripeError:
+                return attempt
+            if charge is not None and charge["status"] != "failed":
+                self._record(attempt.id, charge)
+                return self.latest(order)
+        attempt = self._new_attempt(order, attempt, amount_cents, token, email)
+        self.db.session.add(attempt)
+        try:
+            self.db.session.commit()
+        except IntegrityError:
+            # A concurrent request for the same order got there first
+            self.db.session.rollback()
+            return self.latest(order)
+        self.submit(attempt.id)
+        return attempt
+
+    async def start_async(self, session, order, amount_cents, token, email=None):
+        '''start() for the async views, recording the attempt through ``session``, an AsyncSession.
+
+        The charge is made by a task on the running event loop.
+        '''
+        import stripe
+
+        attempt = (await session.execute(self._latest_query(order))).scalar()
+        if attempt is not None and attempt.status != FAILED:
+            return attempt
+        if attempt is not None and self._gave_up_on(attempt):
+            try:
+                charge = await self._find_charge_async(attempt)
+            except stripe.StripeError:
+                return attempt
+            if charge is not None and charge["status"] != "failed":
+                status, values = self._outcome(charge)
+                await self._transition_async(session, attempt.id, status, **values)
+                await session.refresh(attempt)
+                return attempt
+        attempt = self._new_attempt(order, attempt, amount_cents, token, email)
+        session.add(attempt)
+        try:
+            await session.commit()
+        except IntegrityError:
+            # A concurrent request for the same order got there first
+            await session.rollback()
+            return (await session.execute(self._latest_query(order))).scalar()
+        self.submit_async(attempt.id)
+        return attempt
+
+    def _latest_query(self, order):
+        model = self.attempt_model
+        return self.db.select(model).where(model.order_id == order.id).order_by(model.number.desc()).limit(1)
+
+    @staticmethod
+    def _gave_up_on(attempt):
+        '''Whether ``attempt`` failed because Stripe couldn't be reached, and so may have been charged anyway.'''
+        return attempt.status == FAILED and attempt.charge_id is None and attempt.error == UNREACHABLE
+
+    @staticmethod
+    def _search_params(attempt):
+        return {"query": "metadata['attempt_id']:'%d'" % attempt.id, "limit": 1}
+
+    def _find_charge(self, attempt):
+        '''Returns the charge Stripe made for ``attempt``, found by its metadata, or None.'''
+        with external_call(self.app, "stripe"):
+            found = self.client.v1.charges.search(params=self._search_params(attempt))
+        return found.data[0].to_dict() if found.data else None
+
+    async def _find_charge_async(self, attempt):
+        with external_call(self.app, "stripe"):
+            found = await self.async_client.v1.charges.search_async(params=self._search_params(attempt))
+        return found.data[0].to_dict() if found.data else None
+
+    def _new_attempt(self, order, previous, amount_cents, token, email):
+        number = previous.number + 1 if previous is not None else 1
+        return self.attempt_model(order_id=order.id, number=number,
+                                  idempotency_key="charge:%s:%d" % (order.invoice, number), status=CREATED,
+                                  amount_cents=amount_cents, currency=self.currency, token=token, email=email)
+
+    def submit(self, attempt_id, retry=0):
+        return self._executor.submit(self._charge, attempt_id, retry)
+
+    def submit_async(self, attempt_id, retry=0):
+        # Started in an empty context, so the charge isn't measured as part of the request that made it
+        task = contextvars.Context().run(asyncio.ensure_future, self._charge_async(attempt_id, retry))
+        # The loop only keeps weak references to its tasks
+        self._tasks.add(task)
+        task.add_done_callback(self._charge_done)
+        return task
+
+    def _charge_done(self, task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            # The attempt is left created or submitted; `flask payments resume` picks it up
+            self.app.logger.error("Charge task failed", exc_info=task.exception())
+
+    def _charge(self, attempt_id, retry=0):
+        import stripe
+
+        with self.app.app_context():
+            attempt = self.db.session.get(self.attempt_model, attempt_id)
+            if attempt is None or not self._transition(attempt_id, SUBMITTED):
+                return
+            order = self.db.session.get(self.order_model, attempt.order_id)
+            try:
+                with external_call(self.app, "stripe"):
+                    charge = self.client.v1.charges.create(params=self._charge_params(attempt, order),
+                                                           options={"idempotency_key": attempt.idempotency_key})
+            except (stripe.CardError, stripe.InvalidRequestError) as e:
+                self._transition(attempt_id, FAILED, error=(e.user_message or str(e))[:500])
+                return
+            except stripe.StripeError as e:
+                self.app.logger.warning("Charge for %s not created: %r", order.invoice, e)
+                if retry < len(self.retry_delays):
+                    self._transition(attempt_id, SUBMITTED, error=RETRYING)
+                    timer = threading.Timer(self.retry_delays[retry], self.submit, (attempt_id, retry + 1))
+                    timer.daemon = True
+                    timer.start()
+                else:
+                    self._transition(attempt_id, FAILED, error=UNREACHABLE)
+                return
+            self._record(attempt_id, charge.to_dict())
+
+    async def _charge_async(self, attempt_id, retry=0):
+        import stripe
+
+        async with self.app.extensions['async_serving'].session() as session:
+            attempt = await session.get(self.attempt_model, attempt_id)
+            if attempt is None:
+                return
+            order = await session.get(self.order_model, attempt.order_id)
+            # Its commit hands the connection back to the pool for as long as Stripe takes to answer
+            if not await self._transition_async(session, attempt_id, SUBMITTED):
+                return
+            try:
+                with external_call(self.app, "stripe"):
+                    charge = await self.async_client.v1.charges.create_async(
+                        params=self._charge_params(attempt, order),
+                        options={"idempotency_key": attempt.idempotency_key})
+            except (stripe.CardError, stripe.InvalidRequestError) as e:
+                await self._transition_async(session, attempt_id, FAILED, error=(e.user_message or str(e))[:500])
+                return
+            except stripe.StripeError as e:
+                self.app.logger.warning("Charge for %s not created: %r", order.invoice, e)
+                if retry < len(self.retry_delays):
+                    await self._transition_async(session, attempt_id, SUBMITTED, error=RETRYING)
+                    asyncio.get_running_loop().call_later(self.retry_delays[retry], self.submit_async, attempt_id,
+                                                          retry + 1)
+                else:
+                    await self._transition_async(session, attempt_id, FAILED, error=UNREACHABLE)
+                return
+            status, values = self._outcome(charge.to_dict())
+            await self._transition_async(session, attempt_id, status, **values)
+
+    @staticmethod
+    def _charge_params(attempt, order):
+        return {"amount": attempt.amount_cents, "currency": attempt.currency, "source": attempt.token,
+                "receipt_email": attempt.email, "description": "Myshop",
+                "metadata": {"invoice": order.invoice, "attempt_id": str(attempt.id)}}
+
+    @staticmethod
+    def _outcome(charge):
+        '''Returns the state a charge moves its attempt to, and the values recorded with it.'''
+        if charge["status"] == "succeeded":
+            return SUCCEEDED, {"charge_id": charge["id"], "error": None}
+        if charge["status"] == "failed":
+            return FAILED, {"charge_id": charge["id"], "error": (charge.get("failure_message") or "")[:500]}
+        return PENDING, {"charge_id": charge["id"], "error": None}
+
+    def _record(self, attempt_id, charge):
+        status, values = self._outcome(charge)
+        self._transition(attempt_id, status, **values)
+
+    def _transition(self, attempt_id, status, **values):
+        '''Moves an attempt to ``status`` if it is in a state that may; returns whether it moved.'''
+        moved = self.db.session.execute(self._move(attempt_id, status, values)).rowcount == 1
+        if moved and status == SUCCEEDED:
+            order_id = self.db.session.execute(self._order_id(attempt_id)).scalar()
+            # Through the ORM, so the sales rollups see the order become paid
+            self.db.session.get(self.order_model, order_id).status = PAID
+        self.db.session.commit()
+        return moved
+
+    async def _transition_async(self, session, attempt_id, status, **values):
+        moved = (await session.execute(self._move(attempt_id, status, values))).rowcount == 1
+        if moved and status == SUCCEEDED:
+            order_id = (await session.execute(self._order_id(attempt_id))).scalar()
+            # The AsyncSession flushes through the same ORM events as db.session
+            (await session.get(self.order_model, order_id)).status = PAID
+        await session.commit()
+        return moved
+
+    def _move(self, attempt_id, status, values):
+        model = self.attempt_model
+        if status in (SUCCEEDED, FAILED):
+            # Card tokens are single use; there is no reason to keep them
+            values["token"] = None
+        return (self.db.update(model).where(model.id == attempt_id, model.status.in_(TRANSITIONS[status]))
+                .values(status=status, updated_at=datetime.utcnow(), **values))
+
+    def _order_id(self, attempt_id):
+        model = self.attempt_model
+        return self.db.select(model.order_id).where(model.id == attempt_id)
+
+    def webhook(self):
+        if not self.webhook_secret:
+            abort(404)
+        import stripe
+
+        try:
+            event = stripe.Webhook.construct_event(request.get_data(), request.headers.get("Stripe-Signature"),
+                                                   self.webhook_secret)
+        except (ValueError, stripe.SignatureVerificationError):
+            abort(400)
+        if event.type in ("charge.succeeded", "charge.failed"):
+            charge = event.data.object.to_dict()
+            attempt_id = self._attempt_for(charge)
+            if attempt_id is not None:
+                self._record(attempt_id, charge)
+        return "", 200
+
+    def _attempt_for(self, charge):
+        model = self.attempt_model
+        attempt_id = (charge.get("metadata") or {}).get("attempt_id")
+        if attempt_id and attempt_id.isdigit():
+            return int(attempt_id)
+        return self.db.session.execute(self.db.select(model.id).where(model.charge_id == charge["id"])).scalar()
+
+    def _cli(self):
+        group = AppGroup("payments", help="Manage Stripe payments.")
+
+        @group.command("resume")
+        def resume():
+            '''Retry charges left unsubmitted, e.g. by a restart; Stripe dedupes them by idempotency key.'''
+            model = self.attempt_model
+            ids = self.db.session.execute(
+                self.db.select(model.id).where(model.status.in_((CREATED, SUBMITTED))).order_by(model.id)
+            ).scalars().all()
+            for future in [self.submit(attempt_id) for attempt_id in ids]:
+                future.result()
+            click.echo("Resubmitted %d payment attempts" % len(ids))
+
+        return group
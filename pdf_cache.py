@@ -0,0 +1,101 @@
+'''
+    Invoice PDF cache
+
+    -----------------
+
+    Content-addressed, size-capped disk cache for rendered invoice PDFs.
+
+    A PDF is stored under the hash of everything that goes into it: the
+    invoice, the order status, the serialized order lines and the mtime of
+    the template. Any change to one of those produces a new key, so entries
+    never need invalidating; stale ones simply age out. Eviction is least
+    recently used, tracked through the file's access time, and the file's
+    modification time is left alone so it can serve as Last-Modified.
+
+'''
+
+import hashlib
+import json
+import os
+import threading
+import time
+
+
+class PdfCache(object):
+    '''Stores PDFs through a Wkhtmltopdf instance under its PDF_DIR_PATH.
+
+    To initialize, pass the Wkhtmltopdf extension and your flask app's object::
+
+        pdf_cache = PdfCache(wkhtmltopdf, app)
+
+    Config variables read from the app:
+
+        PDF_CACHE_MAX_BYTES = 256 * 1024 * 1024    # total size before evicting
+
+    '''
+
+    def __init__(self, storage, app=None):
+        self.storage = storage
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.max_bytes = app.config.get('PDF_CACHE_MAX_BYTES', 256 * 1024 * 1024)
+        self.directory = self.storage.pdf_dir_path
+        app.extensions['pdf_cache'] = self
+
+    @staticmethod
+    def key(invoice, status, orders, template_mtime, *extra):
+        '''Returns the cache key for an order in its current state. Anything else
+        the rendered PDF depends on, such as the tax rate, can be passed as ``extra``.
+        '''
+        payload = json.dumps([invoice, status, orders, template_mtime] + list(extra), sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".pdf")
+
+    def get(self, key):
+        '''Returns the path of the cached PDF for ``key``, or None on a miss.'''
+        path = self.path(key)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        # Refresh the access time for LRU eviction but keep mtime for Last-Modified.
+        try:
+            os.utime(path, (time.time(), stat.st_mtime))
+        except OSError:
+            pass
+        return path
+
+    def put(self, key, binary_pdf):
+        '''Stores ``binary_pdf`` under ``key`` and evicts old entries if over the size cap.'''
+        path = self.storage.save_pdf(binary_pdf, key + ".pdf")
+        with self._lock:
+            self._evict()
+        return path
+
+    def _evict(self):
+        entries = []
+        total = 0
+        for entry in os.scandir(self.directory):
+            # Only touch files this cache created: a 64 hex digit key plus '.pdf'
+            if len(entry.name) != 68 or not entry.name.endswith(".pdf"):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_atime, stat.st_size, entry.path))
+            total += stat.st_size
+        entries.sort()
+        for _atime, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
@@ -0,0 +1,305 @@
+'''
+    PDF rendering service
+
+    ---------------------
+
+    Renders invoice PDFs off the request thread.
+
+    Jobs are submitted with the already rendered HTML and handed to a bounded
+    pool of workers, each of which drives one wkhtmltopdf process over
+    stdin/stdout. When every worker is busy and the wait queue is full,
+    submit() fails fast with QueueFull instead of piling up requests.
+
+    Each job's status is also written to a small JSON file under
+    ``PDF_JOB_DIR``, so a poll that lands on another worker process than
+    the one rendering still finds the job. Only the status is shared: the
+    PDF itself is handed to ``on_done``, e.g. to be stored in the PDF
+    cache, under the key recorded with the job.
+
+    Async views call render_async() instead, which awaits the wkhtmltopdf
+    process on the event loop. It is bounded by the same worker count and
+    wait queue, so there are never more processes than the pool would run.
+
+    Set ``PDF_RENDERER = 'fake'`` to use FakeRenderer, which needs no
+    wkhtmltopdf binary and is what the test and benchmark setups use.
+
+'''
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import os
+import re
+import secrets
+import tempfile
+import threading
+import time
+
+from flask_wkhtmltopdf import run_wkhtmltopdf, run_wkhtmltopdf_async
+from metrics import external_call
+
+
+class QueueFull(Exception):
+    '''Raised by PdfRenderService.submit() when no more jobs can be accepted.'''
+
+
+class WkhtmltopdfRenderer(object):
+    '''Converts HTML with the wkhtmltopdf binary, one process per render.'''
+
+    def __init__(self, bin_path=None, wkhtmltopdf_args=None, timeout=60):
+        self.bin_path = bin_path
+        self.wkhtmltopdf_args = wkhtmltopdf_args
+        self.timeout = timeout
+
+    def render(self, html):
+        return run_wkhtmltopdf(html, self.wkhtmltopdf_args, bin_path=self.bin_path, timeout=self.timeout)
+
+    async def render_async(self, html):
+        return await run_wkhtmltopdf_async(html, self.wkhtmltopdf_args, bin_path=self.bin_path,
+                                           timeout=self.timeout)
+
+
+class FakeRenderer(object):
+    '''Stand-in renderer that returns a small valid PDF without spawning a process.
+
+    :param delay: Seconds to sleep per render, to mimic wkhtmltopdf start-up cost.
+    '''
+
+    def __init__(self, delay=0):
+        self.delay = delay
+
+    def render(self, html):
+        if self.delay:
+            time.sleep(self.delay)
+        return self.pdf(html)
+
+    async def render_async(self, html):
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        return self.pdf(html)
+
+    @staticmethod
+    def pdf(html):
+        if not isinstance(html, bytes):
+            html = html.encode('utf-8')
+        text = "Invoice %s" % hashlib.sha256(html).hexdigest()[:16]
+        stream = ("BT /F1 12 Tf 72 720 Td (%s) Tj ET" % text).encode('latin-1')
+        objects = [
+            b"<< /Type /Catalog /Pages 2 0 R >>",
+            b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+            b"/Contents 4 0 R /Resources << /Font << /F1 5 0 R >> >> >>",
+            b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream",
+            b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+        ]
+        pdf = bytearray(b"%PDF-1.4\n")
+        offsets = []
+        for number, body in enumerate(objects, start=1):
+            offsets.append(len(pdf))
+            pdf += b"%d 0 obj\n" % number + body + b"\nendobj\n"
+        xref = len(pdf)
+        pdf += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+        for offset in offsets:
+            pdf += b"%010d 00000 n \n" % offset
+        pdf += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+        return bytes(pdf)
+
+
+class PdfJob(object):
+    '''A single render request and, once finished, its result.
+
+    A job read back from another process's status file has no ``result``;
+    its PDF is wherever ``on_done`` stored it, under ``key``.
+    '''
+
+    def __init__(self, html, owner=None, filename="invoice.pdf", on_done=None, key=None):
+        self.id = secrets.token_urlsafe(12)
+        self.owner = owner
+        self.filename = filename
+        self.key = key
+        self.on_done = on_done
+        self.status = "queued"
+        self.result = None
+        self.error = None
+        self.created = time.monotonic()
+        self.finished = None
+        self._html = html
+
+    @property
+    def done(self):
+        return self.status in ("done", "failed")
+
+    def record(self):
+        return {"owner": self.owner, "filename": self.filename, "key": self.key, "status": self.status,
+                "error": self.error}
+
+
+class PdfRenderService(object):
+    '''Bounded worker pool with a submit/poll/fetch API for PDF rendering.
+
+    To initialize, pass your flask app's object::
+
+        pdf_renderer = PdfRenderService(app)
+
+    Config variables read from the app:
+
+        PDF_RENDERER = 'wkhtmltopdf'    # or 'fake'
+        PDF_RENDER_WORKERS = 2          # concurrent wkhtmltopdf processes
+        PDF_RENDER_QUEUE_SIZE = 16      # jobs allowed to wait for a worker
+        PDF_RENDER_TIMEOUT = 60         # seconds before a render is killed
+        PDF_JOB_TTL = 600               # seconds a finished job stays fetchable
+        PDF_JOB_DIR = "<PDF_DIR_PATH>/jobs"    # job status files shared by the workers; None keeps them in process
+
+    '''
+
+    # Job ids are token_urlsafe() strings, so nothing else is read from the job directory
+    job_id_pattern = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+    def __init__(self, app=None, renderer=None):
+        self.renderer = renderer
+        self.jobs = {}
+        self.job_dir = None
+        self._lock = threading.Lock()
+        self._executor = None
+        self._slots = None
+        self._async_pending = 0
+        self._next_sweep = 0
+        self.app = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.workers = app.config.get('PDF_RENDER_WORKERS', 2)
+        self.queue_size = app.config.get('PDF_RENDER_QUEUE_SIZE', 16)
+        self.job_ttl = app.config.get('PDF_JOB_TTL', 600)
+        pdf_dir = app.config.get('PDF_DIR_PATH')
+        self.job_dir = app.config.get('PDF_JOB_DIR', os.path.join(pdf_dir, "jobs") if pdf_dir else None)
+        if self.renderer is None:
+            if app.config.get('PDF_RENDERER', 'wkhtmltopdf') == 'fake':
+                self.renderer = FakeRenderer()
+            else:
+                self.renderer = WkhtmltopdfRenderer(bin_path=app.config.get('WKHTMLTOPDF_BIN_PATH'),
+                                                    timeout=app.config.get('PDF_RENDER_TIMEOUT', 60))
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="pdf-render")
+        app.extensions['pdf_renderer'] = self
+
+    def submit(self, html, owner=None, filename="invoice.pdf", on_done=None, key=None):
+        '''Queues ``html`` for rendering and returns the PdfJob.
+
+        :param on_done: Optional callable receiving the PDF bytes, run on the worker
+                        before the job is reported as done.
+        :param key: Where ``on_done`` stores the PDF, e.g. its PdfCache key; recorded
+                    with the job's status for the other processes.
+        :raises QueueFull: when all workers are busy and the wait queue is full.
+        '''
+        job = PdfJob(html, owner=owner, filename=filename, on_done=on_done, key=key)
+        with self._lock:
+            self._expire()
+            pending = sum(1 for queued in self.jobs.values() if not queued.done)
+            if pending >= self.workers + self.queue_size:
+                raise QueueFull("%d PDF jobs already pending" % pending)
+            self.jobs[job.id] = job
+        self._save(job)
+        self._executor.submit(self._run, job)
+        return job
+
+    async def render_async(self, html):
+        '''Renders ``html`` on the running event loop and returns the PDF bytes.
+
+        :raises QueueFull: when as many renders as the pool takes are already running or waiting.
+        '''
+        if self._async_pending >= self.workers + self.queue_size:
+            raise QueueFull("%d PDF renders already pending" % self._async_pending)
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.workers)
+        self._async_pending += 1
+        try:
+            async with self._slots:
+                with external_call(self.app, "pdf"):
+                    return await self.renderer.render_async(html)
+        finally:
+            self._async_pending -= 1
+
+    def get(self, job_id, owner=None):
+        '''Returns the job with ``job_id``, or None if it is unknown, expired or not owned by ``owner``.
+
+        Jobs submitted to another process are read from their status file.
+        '''
+        with self._lock:
+            job = self.jobs.get(job_id)
+        if job is None:
+            job = self._load(job_id)
+        if job is None or (owner is not None and job.owner != owner):
+            return None
+        return job
+
+    def _run(self, job):
+        job.status = "running"
+        try:
+            with external_call(self.app, "pdf"):
+                job.result = self.renderer.render(job._html)
+            if job.on_done is not None:
+                job.on_done(job.result)
+            job.status = "done"
+        except Exception as e:
+            job.error = str(e) or e.__class__.__name__
+            job.status = "failed"
+        finally:
+            job._html = None
+            job.finished = time.monotonic()
+            self._save(job)
+
+    def _path(self, job_id):
+        return os.path.join(self.job_dir, job_id + ".json")
+
+    def _save(self, job):
+        if self.job_dir is None:
+            return
+        # Made on demand, like the PDF cache's own directory, so clearing the cache doesn't break rendering
+        os.makedirs(self.job_dir, exist_ok=True)
+        # Written whole and renamed into place, so a poll never reads half a file
+        handle, temporary = tempfile.mkstemp(dir=self.job_dir, suffix=".tmp")
+        try:
+            with os.fdopen(handle, "w") as output:
+                json.dump(job.record(), output)
+            os.replace(temporary, self._path(job.id))
+        except BaseException:
+            os.unlink(temporary)
+            raise
+
+    def _load(self, job_id):
+        if self.job_dir is None or not self.job_id_pattern.match(job_id):
+            return None
+        try:
+            with open(self._path(job_id)) as saved:
+                record = json.load(saved)
+        except (OSError, ValueError):
+            return None
+        job = PdfJob(None, owner=record["owner"], filename=record["filename"], key=record["key"])
+        job.id = job_id
+        job.status = record["status"]
+        job.error = record["error"]
+        return job
+
+    def _expire(self):
+        cutoff = time.monotonic() - self.job_ttl
+        for job_id in [job_id for job_id, job in self.jobs.items() if job.done and job.finished < cutoff]:
+            del self.jobs[job_id]
+        now = time.monotonic()
+        if self.job_dir is None or now < self._next_sweep:
+            return
+        self._next_sweep = now + 60
+        # Every worker's files, including those of jobs a restart cut short
+        cutoff = time.time() - self.job_ttl
+        try:
+            entries = list(os.scandir(self.job_dir))
+        except OSError:
+            return
+        for entry in entries:
+            try:
+                if entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+            except OSError:
+                pass
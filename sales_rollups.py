@@ -0,0 +1,261 @@
+'''
+    Sales rollups
+
+    -------------
+
+    Incrementally maintained sales aggregates for reporting.
+
+    Three small tables hold orders, units and revenue (in cents, after
+    discounts, before tax) per day, per product and per brand. When an order
+    becomes "Paid" its lines are added to them in the same transaction as
+    the status change; an order that stops being paid, or is deleted, is
+    subtracted again. Reports read the rollups only, so they cost the same
+    however many orders there are.
+
+    ``flask sales rebuild`` recomputes everything from the paid orders,
+    streaming them in chunks.
+
+'''
+
+from collections import namedtuple
+from datetime import date, timedelta
+from importlib import import_module
+import time
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import event, inspect, select
+from sqlalchemy.orm import Session
+
+from totals import compute_totals
+
+
+PAID = "Paid"
+
+# Dialects with INSERT .. ON CONFLICT DO UPDATE; only the one in use is imported
+UPSERT_DIALECTS = ("sqlite", "postgresql")
+
+SaleLine = namedtuple("SaleLine", ["product_id", "product_name", "brand_id", "unit_price_cents",
+                                   "discount", "quantity"])
+
+
+class SalesDeltas(object):
+    '''Changes to apply to the rollup tables, accumulated per key.'''
+
+    def __init__(self):
+        self.daily = {}
+        self.products = {}
+        self.brands = {}
+
+    def add_order(self, day, lines, sign=1):
+        '''Counts one order with its SaleLines, or takes it back out with ``sign=-1``.'''
+        if not lines:
+            return
+        totals = compute_totals(lines, 0)
+        order_units = order_revenue = 0
+        seen_products = set()
+        seen_brands = set()
+        for line, line_total in zip(lines, totals.lines):
+            units = line_total.quantity * sign
+            revenue = line_total.subtotal_cents * sign
+            order_units += units
+            order_revenue += revenue
+            product = self.products.setdefault(line.product_id, [line.product_name, 0, 0, 0])
+            product[0] = line.product_name
+            product[1] += sign if line.product_id not in seen_products else 0
+            product[2] += units
+            product[3] += revenue
+            seen_products.add(line.product_id)
+            if line.brand_id is not None:
+                brand = self.brands.setdefault(line.brand_id, [0, 0, 0])
+                brand[0] += sign if line.brand_id not in seen_brands else 0
+                brand[1] += units
+                brand[2] += revenue
+                seen_brands.add(line.brand_id)
+        daily = self.daily.setdefault(day, [0, 0, 0])
+        daily[0] += sign
+        daily[1] += order_units
+        daily[2] += order_revenue
+
+
+class SalesRollups(object):
+    '''Keeps the sales rollup tables in step with paid orders.
+
+    To initialize, pass the order models, the three rollup models and your
+    flask app's object::
+
+        sales = SalesRollups(db, CustomerOrder, OrderItem, Product,
+                             SalesDaily, ProductSales, BrandSales, app)
+
+    '''
+
+    def __init__(self, db, order_model, item_model, product_model,
+                 daily_model, product_sales_model, brand_sales_model, app=None, chunk_size=1000):
+        self.db = db
+        self.order_model = order_model
+        self.item_model = item_model
+        self.product_model = product_model
+        self.daily_model = daily_model
+        self.product_sales_model = product_sales_model
+        self.brand_sales_model = brand_sales_model
+        self.chunk_size = chunk_size
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        if not event.contains(Session, "before_flush", self._before_flush):
+            event.listen(Session, "before_flush", self._before_flush)
+        app.cli.add_command(self._cli())
+        app.extensions['sales_rollups'] = self
+
+    def report(self, days=30, top=10):
+        '''Returns the last ``days`` days and the ``top`` products and brands by revenue.'''
+        since = date.today() - timedelta(days=days - 1)
+        daily = self.daily_model
+        products = self.product_sales_model
+        brands = self.brand_sales_model
+        session = self.db.session
+        return {
+            "daily": [
+                {"day": row.day.isoformat(), "orders": row.orders, "units": row.units,
+                 "revenue_cents": row.revenue_cents}
+                for row in session.execute(select(daily).where(daily.day >= since).order_by(daily.day)).scalars()
+            ],
+            "products": [
+                {"product_id": row.product_id, "name": row.product_name, "orders": row.orders,
+                 "units": row.units, "revenue_cents": row.revenue_cents}
+                for row in session.execute(
+                    select(products).order_by(products.revenue_cents.desc()).limit(top)).scalars()
+            ],
+            "brands": [
+                {"brand_id": row.brand_id, "name": row.brand.name if row.brand else None, "orders": row.orders,
+                 "units": row.units, "revenue_cents": row.revenue_cents}
+                for row in session.execute(
+                    select(brands).order_by(brands.revenue_cents.desc()).limit(top)).scalars()
+            ],
+        }
+
+    def rebuild(self):
+        '''Recomputes all rollups from the paid orders; returns how many were counted.'''
+        session = self.db.session
+        order = self.order_model
+        deltas = SalesDeltas()
+        count = 0
+        last_id = 0
+        while True:
+            chunk = session.execute(
+                select(order.id, order.date_created, order.orders)
+                .where(order.status == PAID, order.id > last_id)
+                .order_by(order.id)
+                .limit(self.chunk_size)
+            ).all()
+            if not chunk:
+                break
+            lines = self.order_lines(session.connection(), chunk)
+            for order_id, created, _snapshot in chunk:
+                deltas.add_order(created.date(), lines.get(order_id, []))
+            count += len(chunk)
+            last_id = chunk[-1].id
+        connection = session.connection()
+        for model in (self.daily_model, self.product_sales_model, self.brand_sales_model):
+            connection.execute(model.__table__.delete())
+        self.apply(connection, deltas)
+        session.commit()
+        return count
+
+    def order_lines(self, connection, orders):
+        '''Returns ``{order_id: [SaleLine]}`` for ``(id, date_created, orders)`` rows.
+
+        Lines come from order_items, or from the JSON snapshot of orders that
+        haven't been backfilled. Every chunk costs two queries.
+        '''
+        item = self.item_model
+        product = self.product_model
+        ids = [row[0] for row in orders]
+        found = {}
+        for row in connection.execute(
+                select(item.order_id, item.product_id, item.product_name, item.unit_price_cents,
+                       item.discount, item.quantity)
+                .where(item.order_id.in_(ids))
+                .order_by(item.id)):
+            found.setdefault(row.order_id, []).append(
+                (row.product_id, row.product_name, row.unit_price_cents, row.discount, row.quantity))
+        for order_id, _created, snapshot in orders:
+            if order_id not in found and snapshot:
+                found[order_id] = [(int(key), line['name'], int(line['price']) * 100,
+                                    int(line.get('discount') or 0), int(line['quantity']))
+                                   for key, line in snapshot.items()]
+
+        product_ids = {line[0] for lines in found.values() for line in lines}
+        brand_ids = {}
+        if product_ids:
+            brand_ids = dict(connection.execute(
+                select(product.id, product.brand_id).where(product.id.in_(product_ids))).all())
+        return {order_id: [SaleLine(product_id, name, brand_ids.get(product_id), price, discount, quantity)
+                           for product_id, name, price, discount, quantity in lines]
+                for order_id, lines in found.items()}
+
+    def apply(self, connection, deltas):
+        for day, (orders, units, revenue) in deltas.daily.items():
+            self._add(connection, self.daily_model, {"day": day},
+                      {"orders": orders, "units": units, "revenue_cents": revenue})
+        for product_id, (name, orders, units, revenue) in deltas.products.items():
+            self._add(connection, self.product_sales_model, {"product_id": product_id},
+                      {"orders": orders, "units": units, "revenue_cents": revenue}, {"product_name": name})
+        for brand_id, (orders, units, revenue) in deltas.brands.items():
+            self._add(connection, self.brand_sales_model, {"brand_id": brand_id},
+                      {"orders": orders, "units": units, "revenue_cents": revenue})
+
+    def _add(self, connection, model, key, counters, replace=None):
+        '''Adds ``counters`` to the row at ``key``, creating it if missing.'''
+        table = model.__table__
+        replace = replace or {}
+        if connection.dialect.name in UPSERT_DIALECTS:
+            dialect = import_module("sqlalchemy.dialects." + connection.dialect.name)
+            insert = dialect.insert(table).values(**key, **counters, **replace)
+            updates = {name: table.c[name] + insert.excluded[name] for name in counters}
+            updates.update({name: insert.excluded[name] for name in replace})
+            connection.execute(insert.on_conflict_do_update(index_elements=list(key), set_=updates))
+            return
+        where = [table.c[name] == value for name, value in key.items()]
+        values = {name: table.c[name] + value for name, value in counters.items()}
+        values.update(replace)
+        if connection.execute(table.update().where(*where).values(**values)).rowcount == 0:
+            connection.execute(table.insert().values(**key, **counters, **replace))
+
+    def _before_flush(self, session, flush_context, instances):
+        changed = []
+        for obj in session.dirty:
+            if isinstance(obj, self.order_model):
+                history = inspect(obj).attrs.status.history
+                if not history.has_changes():
+                    continue
+                was_paid = PAID in (history.deleted or ())
+                sign = (obj.status == PAID) - was_paid
+                if sign:
+                    changed.append((obj, sign))
+        for obj in session.deleted:
+            if isinstance(obj, self.order_model):
+                history = inspect(obj).attrs.status.history
+                if PAID in (history.deleted or history.unchanged or ()):
+                    changed.append((obj, -1))
+        if not changed:
+            return
+        connection = session.connection()
+        lines = self.order_lines(connection, [(obj.id, obj.date_created, obj.orders) for obj, _sign in changed])
+        deltas = SalesDeltas()
+        for obj, sign in changed:
+            deltas.add_order(obj.date_created.date(), lines.get(obj.id, []), sign)
+        self.apply(connection, deltas)
+
+    def _cli(self):
+        group = AppGroup("sales", help="Manage the sales rollups.")
+
+        @group.command("rebuild")
+        def rebuild():
+            '''Recompute the sales rollups from every paid order.'''
+            start = time.perf_counter()
+            count = self.rebuild()
+            click.echo("Rolled up %d paid orders in %.2fs" % (count, time.perf_counter() - start))
+
+        return group
@@ -0,0 +1,157 @@
+'''
+    Product search
+
+    --------------
+
+    Full-text product search on SQLite FTS5.
+
+    ``products_fts`` is an external-content FTS5 table over the
+    ``product_name`` and ``description`` columns of ``products``. Triggers
+    keep it in sync on every insert, update and delete, so the index is
+    current as soon as a write commits, whichever code path made it.
+    Matches are ranked with BM25, weighting the product name above the
+    description, and every search term also matches as a prefix.
+
+    The table and triggers are created, and filled, by ``flask db upgrade``;
+    serving a search only checks, once per process, that the table is
+    there. ``flask search reindex`` rebuilds the index from the products
+    table.
+
+    On databases without FTS5, or not yet upgraded, the search falls back to
+    LIKE matching.
+
+'''
+
+from collections import namedtuple
+import re
+import threading
+import time
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import text
+
+
+# BM25 column weights: product_name, description
+RANK = "bm25(products_fts, 10.0, 1.0)"
+
+SearchPage = namedtuple("SearchPage", ["items", "page", "per_page", "has_prev", "has_next"])
+
+
+def match_expression(query):
+    '''Turns user input into an FTS5 query: every word must match, as a prefix.'''
+    words = re.findall(r"\w+", query or "", re.UNICODE)
+    return " ".join('"%s"*' % word for word in words)
+
+
+def search_sql(brand_id=None, category_id=None, in_stock=False):
+    '''The ranked id query for a set of filters; bind ``match``, ``limit`` and ``offset``.'''
+    sql = ("SELECT products.id FROM products_fts JOIN products ON products.id = products_fts.rowid"
+           " WHERE products_fts MATCH :match")
+    if brand_id is not None:
+        sql += " AND products.brand_id = :brand_id"
+    if category_id is not None:
+        sql += " AND products.category_id = :category_id"
+    if in_stock:
+        sql += " AND products.stock > 0"
+    return sql + " ORDER BY " + RANK + ", products.id DESC LIMIT :limit OFFSET :offset"
+
+
+class ProductSearch(object):
+    '''Ranked, filtered and paginated product search.
+
+    To initialize, pass the database and product model, then your flask app's object::
+
+        product_search = ProductSearch(db, Product)
+        product_search.init_app(app)
+
+    '''
+
+    def __init__(self, db, product_model, app=None):
+        self.db = db
+        self.product_model = product_model
+        self.enabled = False
+        self.checked = False
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.cli.add_command(self._cli())
+        app.extensions['product_search'] = self
+
+    def index_exists(self):
+        '''Whether the migrations created the FTS table; must run in an app context.'''
+        if self.db.engine.dialect.name != "sqlite":
+            return False
+        with self.db.engine.connect() as conn:
+            return conn.execute(text(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'products_fts'")).first() is not None
+
+    def ensure_index(self):
+        '''Runs index_exists() once per process, on first use.'''
+        if not self.checked:
+            with self._lock:
+                if not self.checked:
+                    self.enabled = self.index_exists()
+                    self.checked = True
+        return self.enabled
+
+    def reindex(self):
+        '''Rebuilds the whole index from the products table.'''
+        with self.db.engine.begin() as conn:
+            conn.execute(text("INSERT INTO products_fts(products_fts) VALUES ('rebuild')"))
+            conn.execute(text("INSERT INTO products_fts(products_fts) VALUES ('optimize')"))
+
+    def search(self, query, page=1, per_page=12, brand_id=None, category_id=None, in_stock=False):
+        '''Returns a SearchPage of products matching ``query``, best match first.'''
+        page = max(page, 1)
+        offset = (page - 1) * per_page
+        match = match_expression(query)
+        if not match:
+            return SearchPage([], page, per_page, False, False)
+        if self.ensure_index():
+            ids = self.db.session.execute(
+                text(search_sql(brand_id, category_id, in_stock)),
+                {"match": match, "brand_id": brand_id, "category_id": category_id,
+                 "limit": per_page + 1, "offset": offset},
+            ).scalars().all()
+        else:
+            ids = self._like_search(query, brand_id, category_id, in_stock, per_page + 1, offset)
+        has_next = len(ids) > per_page
+        ids = ids[:per_page]
+        model = self.product_model
+        products = {product.id: product for product in
+                    self.db.session.execute(self.db.select(model).where(model.id.in_(ids))).scalars()}
+        items = [products[product_id] for product_id in ids if product_id in products]
+        return SearchPage(items, page, per_page, page > 1, has_next)
+
+    def _like_search(self, query, brand_id, category_id, in_stock, limit, offset):
+        model = self.product_model
+        select = self.db.select(model.id)
+        for word in re.findall(r"\w+", query, re.UNICODE):
+            pattern = "%" + word + "%"
+            select = select.where(model.product_name.ilike(pattern) | model.description.ilike(pattern))
+        if brand_id is not None:
+            select = select.where(model.brand_id == brand_id)
+        if category_id is not None:
+            select = select.where(model.category_id == category_id)
+        if in_stock:
+            select = select.where(model.stock > 0)
+        select = select.order_by(model.id.desc()).limit(limit).offset(offset)
+        return self.db.session.execute(select).scalars().all()
+
+    def _cli(self):
+        group = AppGroup("search", help="Manage the product search index.")
+
+        @group.command("reindex")
+        def reindex():
+            '''Rebuild the product search index from the products table.'''
+            if not self.index_exists():
+                raise click.ClickException("Full-text search needs SQLite with FTS5 and `flask db upgrade`.")
+            start = time.perf_counter()
+            self.reindex()
+            count = self.db.session.execute(text("SELECT count(*) FROM products")).scalar()
+            click.echo("Indexed %d products in %.2fs" % (count, time.perf_counter() - start))
+
+        return group
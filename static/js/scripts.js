@@ -27,3 +27,34 @@ window.addEventListener('DOMContentLoaded', () => {
         scrollPos = currentTop;
     });
 })
+
+// Search-as-you-type suggestions for the navbar search box
+window.addEventListener('DOMContentLoaded', () => {
+    const searchInput = document.querySelector('input[data-suggest-url]');
+    if (!searchInput) {
+        return;
+    }
+    const datalist = document.getElementById(searchInput.getAttribute('list'));
+    let timer = null;
+    let lastQuery = '';
+    searchInput.addEventListener('input', function() {
+        clearTimeout(timer);
+        const query = searchInput.value.trim();
+        if (query.length < 2 || query === lastQuery) {
+            return;
+        }
+        timer = setTimeout(function() {
+            lastQuery = query;
+            fetch(searchInput.dataset.suggestUrl + '?q=' + encodeURIComponent(query))
+                .then(function(response) { return response.json(); })
+                .then(function(data) {
+                    datalist.innerHTML = '';
+                    data.suggestions.forEach(function(suggestion) {
+                        const option = document.createElement('option');
+                        option.value = suggestion.label;
+                        datalist.appendChild(option);
+                    });
+                });
+        }, 150);
+    });
+})
@@ -0,0 +1,260 @@
+'''
+    Stripe stub
+
+    -----------
+
+    A local stand-in for the part of the Stripe API the shop uses.
+
+    Serves ``POST /v1/charges``, ``GET /v1/charges/<id>`` and
+    ``GET /v1/charges/search`` by metadata, with Stripe's idempotency
+    rules: a repeated ``Idempotency-Key`` replays the first response, and
+    reusing a key with other parameters is an error. The token
+    decides the outcome: ``tok_chargeDeclined`` is declined, anything else
+    succeeds. Each charge's ``charge.succeeded`` or ``charge.failed`` event
+    is posted, signed like Stripe's, to the webhook URL if one is given.
+
+    With ``--confirm async`` charges come back ``pending`` and are only
+    settled by the webhook, after ``--confirm-delay`` seconds. ``--latency``
+    adds a delay to every API call. Point the shop at the stub with::
+
+        python stripe_stub.py --port 12111 --webhook http://127.0.0.1:5000/stripe/webhook
+        STRIPE_API_BASE=http://127.0.0.1:12111 STRIPE_WEBHOOK_SECRET=whsec_dev flask run
+
+    ``GET /_stub/stats`` returns the charges created and replayed.
+
+'''
+
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import hashlib
+import hmac
+import json
+import re
+import secrets
+import threading
+import time
+from urllib.parse import parse_qsl
+from urllib.request import Request, urlopen
+
+
+DECLINED_TOKENS = ("tok_chargeDeclined",)
+
+
+def sign(payload, secret, timestamp=None):
+    '''Returns a ``Stripe-Signature`` header value for ``payload``.'''
+    timestamp = int(time.time()) if timestamp is None else timestamp
+    signed = ("%d." % timestamp).encode("utf-8") + payload
+    return "t=%d,v1=%s" % (timestamp, hmac.new(secret.encode("utf-8"), signed, hashlib.sha256).hexdigest())
+
+
+def parse_form(body):
+    '''Decodes Stripe's form encoding, e.g. ``metadata[invoice]=x``, into nested dicts.'''
+    params = {}
+    for key, value in parse_qsl(body, keep_blank_values=True):
+        match = re.match(r"^(\w+)\[(\w+)\]$", key)
+        if match:
+            params.setdefault(match.group(1), {})[match.group(2)] = value
+        else:
+            params[key] = value
+    return params
+
+
+class _Server(ThreadingHTTPServer):
+    # socketserver listens with a backlog of 5; concurrent charges from the async payment path need more
+    request_queue_size = 1024
+
+
+class StubStripe(object):
+    '''The stub server; ``start()`` runs it on a background thread.
+
+    :param confirm: "sync" to settle charges in the response, "async" to settle them by webhook only.
+    '''
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0, confirm="sync", confirm_delay=0.5,
+                 webhook_url=None, webhook_secret="whsec_dev"):
+        self.latency = latency
+        self.confirm = confirm
+        self.confirm_delay = confirm_delay
+        self.webhook_url = webhook_url
+        self.webhook_secret = webhook_secret
+        self.charges = {}
+        self.created = 0
+        self.replayed = 0
+        self.webhooks_failed = 0
+        self._idempotency = {}
+        self._lock = threading.Lock()
+        self.server = _Server((host, port), self._handler())
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return "http://%s:%d" % (host, port)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, name="stripe-stub", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def stats(self):
+        return {"charges": self.created, "replayed": self.replayed, "webhooks_failed": self.webhooks_failed}
+
+    def create_charge(self, params, idempotency_key):
+        '''Returns ``(status code, body, replayed)`` for a charge request.'''
+        with self._lock:
+            if idempotency_key and idempotency_key in self._idempotency:
+                first_params, status, body = self._idempotency[idempotency_key]
+                if first_params != params:
+                    return 400, {"error": {"type": "idempotency_error", "message":
+                                 "Keys for idempotent requests can only be used with the same parameters "
+                                 "they were first used with."}}, False
+                self.replayed += 1
+                return status, body, True
+            status, body = self._charge(params)
+            if idempotency_key:
+                self._idempotency[idempotency_key] = (params, status, body)
+            return status, body, False
+
+    def search_charges(self, query):
+        '''Returns the charges matching a ``metadata['key']:'value'`` search query, newest first.'''
+        match = re.fullmatch(r"\s*metadata\['([^']+)'\]:'([^']*)'\s*", query or "")
+        if match is None:
+            return 400, {"error": {"type": "invalid_request_error", "param": "query",
+                                   "message": "The stub only searches by one metadata value."}}
+        key, value = match.groups()
+        with self._lock:
+            found = [charge for charge in self.charges.values() if charge["metadata"].get(key) == value]
+        found.sort(key=lambda charge: charge["created"], reverse=True)
+        return 200, {"object": "search_result", "url": "/v1/charges/search", "has_more": False,
+                     "next_page": None, "data": found}
+
+    def _charge(self, params):
+        try:
+            amount = int(params.get("amount", ""))
+        except ValueError:
+            return 400, {"error": {"type": "invalid_request_error", "param": "amount",
+                                   "message": "Invalid integer: %s" % params.get("amount")}}
+        if not params.get("source"):
+            return 400, {"error": {"type": "invalid_request_error", "param": "source",
+                                   "message": "Must provide source or customer."}}
+        declined = params["source"] in DECLINED_TOKENS
+        charge = {
+            "id": "ch_" + secrets.token_hex(12), "object": "charge", "amount": amount,
+            "currency": params.get("currency", "usd"), "description": params.get("description"),
+            "receipt_email": params.get("receipt_email"), "metadata": params.get("metadata", {}),
+            "created": int(time.time()), "livemode": False,
+            "status": "failed" if declined else "succeeded", "paid": not declined,
+            "failure_code": "card_declined" if declined else None,
+            "failure_message": "Your card was declined." if declined else None,
+        }
+        self.charges[charge["id"]] = charge
+        self.created += 1
+        self._notify(dict(charge))
+        if declined:
+            return 402, {"error": {"type": "card_error", "code": "card_declined", "charge": charge["id"],
+                                   "message": "Your card was declined."}}
+        if self.confirm == "async":
+            return 200, dict(charge, status="pending", paid=False)
+        return 200, charge
+
+    def _notify(self, charge):
+        if not self.webhook_url:
+            return
+        event = {"id": "evt_" + secrets.token_hex(12), "object": "event", "type": "charge." + charge["status"],
+                 "created": int(time.time()), "livemode": False, "data": {"object": charge}}
+        delay = self.confirm_delay if self.confirm == "async" else 0
+        threading.Timer(delay, self._post_event, args=(event,)).start()
+
+    def _post_event(self, event):
+        payload = json.dumps(event).encode("utf-8")
+        webhook = Request(self.webhook_url, data=payload, method="POST", headers={
+            "Content-Type": "application/json", "Stripe-Signature": sign(payload, self.webhook_secret)})
+        try:
+            with urlopen(webhook, timeout=10) as response:
+                response.read()
+        except OSError:
+            with self._lock:
+                self.webhooks_failed += 1
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0)).decode("utf-8")
+                if not self._authorized():
+                    return
+                if self.path.split("?")[0] != "/v1/charges":
+                    return self._send(404, {"error": {"type": "invalid_request_error",
+                                                      "message": "Unrecognized request URL"}})
+                if stub.latency:
+                    time.sleep(stub.latency)
+                status, payload, replayed = stub.create_charge(parse_form(body), self.headers.get("Idempotency-Key"))
+                self._send(status, payload, {"Idempotent-Replayed": "true"} if replayed else {})
+
+            def do_GET(self):
+                path = self.path.split("?")[0]
+                if path == "/_stub/stats":
+                    return self._send(200, stub.stats())
+                if not self._authorized():
+                    return
+                if path == "/v1/charges/search":
+                    query = dict(parse_qsl(self.path.partition("?")[2])).get("query")
+                    return self._send(*stub.search_charges(query))
+                charge = stub.charges.get(path[len("/v1/charges/"):]) if path.startswith("/v1/charges/") else None
+                if charge is None:
+                    return self._send(404, {"error": {"type": "invalid_request_error",
+                                                      "message": "No such charge"}})
+                self._send(200, charge)
+
+            def _authorized(self):
+                if self.headers.get("Authorization", "").startswith("Bearer "):
+                    return True
+                self._send(401, {"error": {"type": "invalid_request_error", "message": "No API key provided."}})
+                return False
+
+            def _send(self, status, payload, headers=()):
+                body = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.send_header("Request-Id", "req_" + secrets.token_hex(8))
+                for name, value in dict(headers).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the Stripe charges API.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=12111)
+    parser.add_argument("--latency", type=float, default=0, help="seconds added to every API call")
+    parser.add_argument("--confirm", choices=("sync", "async"), default="sync")
+    parser.add_argument("--confirm-delay", type=float, default=0.5, help="seconds before an async webhook")
+    parser.add_argument("--webhook", help="URL to post charge events to")
+    parser.add_argument("--webhook-secret", default="whsec_dev")
+    args = parser.parse_args()
+    stub = StubStripe(args.host, args.port, args.latency, args.confirm, args.confirm_delay, args.webhook,
+                      args.webhook_secret)
+    print("Stripe stub listening on %s" % stub.url)
+    try:
+        stub.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
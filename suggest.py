@@ -0,0 +1,250 @@
+'''
+    Search suggestions
+
+    ------------------
+
+    In-memory prefix index behind the search-as-you-type endpoint.
+
+    Every product, brand and category name is indexed once per word, so
+    typing "pro" suggests both "Pro Watch" and "iPhone 12 Pro". The index is
+    a sorted list searched with bisect; it is built on the first lookup and patched
+    after each commit that adds, renames or deletes one of those rows, so a
+    lookup never touches the database.
+
+    The index lives in each process, and only the process that made a
+    commit patches it. With several workers the others go on suggesting
+    the old names until they rebuild, which each one does when its index
+    is older than SUGGEST_REBUILD_SECONDS. The rebuild reads the names on a
+    background thread and swaps the new index in whole; lookups go on
+    using the current one meanwhile, so only the very first lookup waits.
+
+'''
+
+from bisect import bisect_left, insort
+from collections import namedtuple
+import re
+import threading
+import time
+
+from flask import current_app, has_app_context
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+
+Suggestion = namedtuple("Suggestion", ["kind", "id", "label"])
+
+
+def normalize(text):
+    return " ".join(re.findall(r"\w+", (text or "").lower(), re.UNICODE))
+
+
+class PrefixIndex(object):
+    '''Sorted ``(key, kind, id, label)`` entries with prefix lookup.'''
+
+    def __init__(self):
+        self._entries = []
+        self._labels = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._labels)
+
+    def add(self, kind, id, label):
+        with self._lock:
+            self._remove((kind, id))
+            self._labels[(kind, id)] = label
+            for key in self._keys(label):
+                insort(self._entries, (key, kind, id, label))
+
+    def remove(self, kind, id):
+        with self._lock:
+            self._remove((kind, id))
+
+    def load(self, rows):
+        '''Replaces the whole index with ``(kind, id, label)`` rows.'''
+        entries = []
+        labels = {}
+        for kind, id, label in rows:
+            labels[(kind, id)] = label
+            entries.extend((key, kind, id, label) for key in self._keys(label))
+        entries.sort()
+        with self._lock:
+            self._entries = entries
+            self._labels = labels
+
+    def lookup(self, prefix, limit=8):
+        '''Returns up to ``limit`` Suggestions whose name has a word starting with ``prefix``.'''
+        prefix = normalize(prefix)
+        if not prefix:
+            return []
+        found = []
+        seen = set()
+        with self._lock:
+            entries = self._entries
+            position = bisect_left(entries, (prefix,))
+            while position < len(entries) and len(found) < limit:
+                key, kind, id, label = entries[position]
+                if not key.startswith(prefix):
+                    break
+                if (kind, id) not in seen:
+                    seen.add((kind, id))
+                    found.append(Suggestion(kind, id, label))
+                position += 1
+        return found
+
+    @staticmethod
+    def _keys(label):
+        words = normalize(label).split(" ")
+        return {" ".join(words[start:]) for start in range(len(words)) if words[start]}
+
+    def _remove(self, ident):
+        label = self._labels.pop(ident, None)
+        if label is None:
+            return
+        kind, id = ident
+        for key in self._keys(label):
+            position = bisect_left(self._entries, (key, kind, id, label))
+            if position < len(self._entries) and self._entries[position] == (key, kind, id, label):
+                del self._entries[position]
+
+
+class SearchSuggestions(object):
+    '''Keeps a PrefixIndex of product, brand and category names in step with the database.
+
+    To initialize, pass the models to index, then your flask app's object::
+
+        suggestions = SearchSuggestions(db, Product, Brand, Category)
+        suggestions.init_app(app)
+
+    Config variables read from the app:
+
+        SUGGEST_REBUILD_SECONDS = 300    # age at which the index is reloaded; None keeps it until restart
+
+    '''
+
+    def __init__(self, db, product_model, brand_model, category_model):
+        self.db = db
+        self.index = PrefixIndex()
+        self.built = False
+        self.built_at = None
+        self.rebuild_seconds = 300
+        self.app = None
+        self._build_lock = threading.Lock()
+        # Changes committed while a rebuild reads the names, applied again on top of what it read
+        self._replay = None
+        self._replay_lock = threading.Lock()
+        # kind -> (model, name attribute)
+        self.sources = {
+            "brand": (brand_model, "name"),
+            "category": (category_model, "name"),
+            "product": (product_model, "product_name"),
+        }
+
+    def init_app(self, app):
+        self.app = app
+        self.rebuild_seconds = app.config.get('SUGGEST_REBUILD_SECONDS', 300)
+        for name, listener in (("after_flush", SearchSuggestions._after_flush),
+                               ("after_commit", SearchSuggestions._after_commit),
+                               ("after_rollback", SearchSuggestions._after_rollback)):
+            if not event.contains(Session, name, listener):
+                event.listen(Session, name, listener)
+        app.extensions['search_suggestions'] = self
+
+    def build(self):
+        '''Loads every name into the index; must run in an app context.'''
+        self.index.load(self._rows())
+        self.built = True
+        self.built_at = time.monotonic()
+
+    def lookup(self, prefix, limit=8):
+        if not self.built:
+            with self._build_lock:
+                if not self.built:
+                    self.build()
+        elif self._stale() and self._build_lock.acquire(blocking=False):
+            # Picks up other workers' writes; the thread releases the lock once the new index is in
+            threading.Thread(target=self._rebuild, name="suggest-rebuild", daemon=True).start()
+        return self.index.lookup(prefix, limit)
+
+    def _rows(self):
+        rows = []
+        for kind, (model, attribute) in self.sources.items():
+            for id, label in self.db.session.execute(self.db.select(model.id, getattr(model, attribute))):
+                rows.append((kind, id, label))
+        return rows
+
+    def _rebuild(self):
+        '''Reloads the index off the request threads, which keep using the current one until the swap.'''
+        try:
+            with self._replay_lock:
+                self._replay = []
+            with self.app.app_context():
+                rows = self._rows()
+            with self._replay_lock:
+                self.index.load(rows)
+                for change in self._replay:
+                    self._apply(*change)
+        except Exception:
+            self.app.logger.exception("Rebuilding the search suggestions failed")
+        finally:
+            with self._replay_lock:
+                self._replay = None
+            # Also after a failure, so it is retried an interval later rather than on every lookup
+            self.built_at = time.monotonic()
+            self._build_lock.release()
+
+    def _apply(self, kind, id, label):
+        if label is None:
+            self.index.remove(kind, id)
+        else:
+            self.index.add(kind, id, label)
+
+    def _stale(self):
+        return self.rebuild_seconds is not None and time.monotonic() - self.built_at >= self.rebuild_seconds
+
+    def _kind(self, obj):
+        for kind, (model, attribute) in self.sources.items():
+            if isinstance(obj, model):
+                return kind, attribute
+        return None, None
+
+    @staticmethod
+    def _current():
+        return current_app.extensions.get('search_suggestions') if has_app_context() else None
+
+    @classmethod
+    def _after_flush(cls, session, flush_context):
+        suggestions = cls._current()
+        if suggestions is None:
+            return
+        # Remember what changed; the index is only patched once the commit succeeds.
+        changes = session.info.setdefault("suggestion_changes", [])
+        for obj in session.new:
+            kind, attribute = suggestions._kind(obj)
+            if kind is not None:
+                changes.append((kind, obj.id, getattr(obj, attribute)))
+        for obj in session.dirty:
+            kind, attribute = suggestions._kind(obj)
+            # Stock and price updates don't touch the index
+            if kind is not None and inspect(obj).attrs[attribute].history.has_changes():
+                changes.append((kind, obj.id, getattr(obj, attribute)))
+        for obj in session.deleted:
+            kind, attribute = suggestions._kind(obj)
+            if kind is not None:
+                changes.append((kind, obj.id, None))
+
+    @classmethod
+    def _after_commit(cls, session):
+        changes = session.info.pop("suggestion_changes", ())
+        suggestions = cls._current()
+        if suggestions is None or not changes:
+            return
+        with suggestions._replay_lock:
+            for change in changes:
+                suggestions._apply(*change)
+            if suggestions._replay is not None:
+                suggestions._replay.extend(changes)
+
+    @classmethod
+    def _after_rollback(cls, session):
+        session.info.pop("suggestion_changes", None)
@@ -0,0 +1,58 @@
+'''Async views render without blocking calls on the event loop.'''
+
+import asyncio
+import threading
+
+from flask_migrate import upgrade
+import pytest
+
+import main
+
+
+async def get(asgi, path):
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    await asgi({"type": "http", "method": "GET", "path": path, "query_string": b"", "headers": []}, receive, send)
+    return messages[0]["status"], b"".join(message.get("body", b"") for message in messages[1:])
+
+
+def test_template_context_and_page_cache_io_stay_off_the_loop(tmp_path):
+    app = main.create_app({"DATABASE_URL": "sqlite:///" + str(tmp_path / "shop.db"), "CART_STORE": "sqlite",
+                           "CART_STORE_PATH": str(tmp_path / "carts.db"), "PAGE_CACHE_BACKEND": "filesystem",
+                           "PAGE_CACHE_DIR": str(tmp_path / "page_cache")})
+    with app.app_context():
+        upgrade()
+        main.db.session.add(main.Product(product_name="Pixel", price=100, stock=1, description="A phone",
+                                         colors="black", brand=main.Brand(name="Acme"),
+                                         category=main.Category(name="Phones")))
+        main.db.session.commit()
+    loop_threads = []
+
+    def off_the_loop(original):
+        def call(*args, **kwargs):
+            assert threading.current_thread() not in loop_threads, original.__name__
+            return original(*args, **kwargs)
+        return call
+
+    facets = app.extensions['nav_facets']
+    facets.get = lambda: pytest.fail("the navbar facets were queried while rendering")
+    backend = app.extensions['page_cache'].backend
+    backend.get, backend.set = off_the_loop(backend.get), off_the_loop(backend.set)
+
+    async def run():
+        loop_threads.append(threading.current_thread())
+        asgi = app.extensions['async_serving']
+        try:
+            return [await get(asgi, "/") for _ in range(2)]
+        finally:
+            await asgi.close()
+
+    (status, body), (cached_status, cached_body) = asyncio.run(run())
+    assert status == cached_status == 200
+    assert b"Acme (1)" in body and body == cached_body
@@ -0,0 +1,58 @@
+'''Apps built by create_app() in one process keep their own caches, pools and settings.'''
+
+from flask_migrate import upgrade
+
+import main
+from page_cache import MemoryBackend, NullBackend
+from pdf_render import FakeRenderer, WkhtmltopdfRenderer
+
+
+def make_app(tmp_path, name, **config):
+    config.update(DATABASE_URL="sqlite:///" + str(tmp_path / (name + ".db")),
+                  PDF_DIR_PATH=str(tmp_path / (name + "-pdf")), SUGGEST_REBUILD_SECONDS=None)
+    app = main.create_app(config)
+    with app.app_context():
+        upgrade()
+    return app
+
+
+def test_apps_on_separate_databases_share_no_state(tmp_path):
+    a = make_app(tmp_path, "a", PDF_RENDERER="fake", PAGE_CACHE_BACKEND="memory")
+    b = make_app(tmp_path, "b", PDF_RENDERER="wkhtmltopdf", PAGE_CACHE_BACKEND="null")
+
+    with a.app_context():
+        # Cached before the write, so A's own commit has to refresh them
+        assert main.nav_facets.choices() == ([], [])
+        assert main.suggestions.lookup("only") == []
+        main.db.session.add(main.Brand(name="OnlyInA"))
+        main.db.session.commit()
+        assert [name for _id, name in main.nav_facets.choices()[0]] == ["OnlyInA"]
+        assert [suggestion.label for suggestion in main.suggestions.lookup("only")] == ["OnlyInA"]
+
+    with b.app_context():
+        assert main.nav_facets.choices() == ([], [])
+        assert main.suggestions.lookup("only") == []
+        assert main.nav_facets.get() == ([], [])
+
+    assert isinstance(a.extensions['pdf_renderer'].renderer, FakeRenderer)
+    assert isinstance(b.extensions['pdf_renderer'].renderer, WkhtmltopdfRenderer)
+    assert isinstance(a.extensions['page_cache'].backend, MemoryBackend)
+    assert isinstance(b.extensions['page_cache'].backend, NullBackend)
+    for name in ('nav_facets', 'search_suggestions', 'page_cache', 'pdf_renderer', 'pdf_cache', 'cart_store',
+                 'identity_cache', 'order_totals', 'keyset_paginator', 'payments', 'inventory', 'async_serving'):
+        assert a.extensions[name] is not b.extensions[name], name
+    assert a.extensions['pdf_cache'].directory != b.extensions['pdf_cache'].directory
+
+
+def test_commits_invalidate_only_their_own_app(tmp_path):
+    a = make_app(tmp_path, "a")
+    b = make_app(tmp_path, "b")
+    with b.app_context():
+        version = main.nav_facets.stats()["version"]
+        page_version = main.page_cache.version
+    with a.app_context():
+        main.db.session.add(main.Category(name="Phones"))
+        main.db.session.commit()
+    with b.app_context():
+        assert main.nav_facets.stats()["version"] == version
+        assert main.page_cache.version == page_version
@@ -0,0 +1,40 @@
+'''The navbar facets pick up catalog writes made by other processes.'''
+
+from flask_migrate import upgrade
+
+import main
+from page_cache import FileSystemBackend
+
+
+def make_app(tmp_path, **config):
+    config.update(DATABASE_URL="sqlite:///" + str(tmp_path / "shop.db"))
+    app = main.create_app(config)
+    with app.app_context():
+        upgrade()
+    return app
+
+
+def write_elsewhere(name):
+    '''Adds a brand as another worker would, without this process's session events.'''
+    with main.db.engine.begin() as connection:
+        connection.execute(main.Brand.__table__.insert().values(name=name))
+
+
+def test_shared_page_cache_version_refreshes_facets(tmp_path):
+    directory = str(tmp_path / "page_cache")
+    app = make_app(tmp_path, PAGE_CACHE_BACKEND="filesystem", PAGE_CACHE_DIR=directory, NAV_FACETS_TTL=None)
+    with app.app_context():
+        assert main.nav_facets.choices() == ([], [])
+        write_elsewhere("Elsewhere")
+        assert main.nav_facets.choices() == ([], [])
+        # The other worker's commit bumps the version every worker reads
+        FileSystemBackend(directory).bump_version()
+        assert [name for _id, name in main.nav_facets.choices()[0]] == ["Elsewhere"]
+
+
+def test_facets_expire_with_a_per_process_page_cache(tmp_path):
+    app = make_app(tmp_path, PAGE_CACHE_BACKEND="memory", NAV_FACETS_TTL=0)
+    with app.app_context():
+        assert main.nav_facets.choices() == ([], [])
+        write_elsewhere("Elsewhere")
+        assert [name for _id, name in main.nav_facets.choices()[0]] == ["Elsewhere"]
@@ -0,0 +1,80 @@
+'''Paying again after Stripe couldn't be reached never charges an order twice.'''
+
+import socket
+
+from flask_migrate import upgrade
+import pytest
+
+import main
+from payments import FAILED, SUCCEEDED, UNREACHABLE
+from stripe_stub import StubStripe
+
+
+@pytest.fixture
+def stub():
+    stub = StubStripe().start()
+    yield stub
+    stub.stop()
+
+
+def closed_port():
+    with socket.socket() as listener:
+        listener.bind(("127.0.0.1", 0))
+        return listener.getsockname()[1]
+
+
+def make_app(tmp_path, api_base):
+    app = main.create_app({"DATABASE_URL": "sqlite:///" + str(tmp_path / "shop.db"), "STRIPE_API_BASE": api_base,
+                           "STRIPE_MAX_RETRIES": 0, "PAYMENT_RETRY_DELAYS": ()})
+    with app.app_context():
+        upgrade()
+        customer = main.User(name="Shopper", email="shopper@example.test", password="x", country="US", state="NY",
+                             city="New York", contact="555-0100", address="1 Main St", zipcode="10001")
+        main.db.session.add(customer)
+        main.db.session.flush()
+        order = main.CustomerOrder(invoice="inv1", customer_id=customer.id, orders={})
+        main.db.session.add(order)
+        main.db.session.flush()
+        # Given up on after its retries, though Stripe may have taken the charge
+        main.db.session.add(main.PaymentAttempt(order_id=order.id, number=1, idempotency_key="charge:inv1:1",
+                                                status=FAILED, error=UNREACHABLE, amount_cents=1000,
+                                                currency="usd"))
+        main.db.session.commit()
+    return app
+
+
+def attempts():
+    return main.PaymentAttempt.query.order_by(main.PaymentAttempt.number).all()
+
+
+def test_a_charge_that_went_through_is_recorded_instead_of_charging_again(tmp_path, stub):
+    app = make_app(tmp_path, stub.url)
+    with app.app_context():
+        first = attempts()[0]
+        stub.create_charge({"amount": "1000", "currency": "usd", "source": "tok_visa",
+                            "metadata": {"invoice": "inv1", "attempt_id": str(first.id)}}, "charge:inv1:1")
+        order = main.db.session.get(main.CustomerOrder, first.order_id)
+
+        attempt = main.payments.start(order, 1000, "tok_visa")
+
+        assert (attempt.number, attempt.status) == (1, SUCCEEDED)
+        assert len(attempts()) == 1 and stub.created == 1
+        assert main.db.session.get(main.CustomerOrder, first.order_id).status == "Paid"
+
+
+def test_a_charge_stripe_never_made_is_attempted_again(tmp_path, stub):
+    app = make_app(tmp_path, stub.url)
+    with app.app_context():
+        order = main.CustomerOrder.query.one()
+        attempt = main.payments.start(order, 1000, "tok_visa")
+        assert attempt.number == 2
+        assert attempt.idempotency_key == "charge:inv1:2"
+
+
+def test_nothing_is_charged_while_stripe_is_still_unreachable(tmp_path):
+    app = make_app(tmp_path, "http://127.0.0.1:%d" % closed_port())
+    with app.app_context():
+        order = main.CustomerOrder.query.one()
+        attempt = main.payments.start(order, 1000, "tok_visa")
+        assert (attempt.number, attempt.status) == (1, FAILED)
+        assert len(attempts()) == 1
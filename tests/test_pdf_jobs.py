@@ -0,0 +1,31 @@
+'''A PDF job submitted to one worker can be polled through another.'''
+
+import time
+
+from flask import Flask
+
+from pdf_render import PdfRenderService
+
+
+def make_service(tmp_path):
+    app = Flask(__name__)
+    app.config.update(PDF_DIR_PATH=str(tmp_path), PDF_RENDERER="fake")
+    return PdfRenderService(app)
+
+
+def test_job_status_is_shared_through_the_job_directory(tmp_path):
+    rendering, polled = make_service(tmp_path), make_service(tmp_path)
+    stored = {}
+    job = rendering.submit("<p>1001</p>", owner=7, filename="1001.pdf", key="abc",
+                           on_done=lambda pdf: stored.setdefault("abc", pdf))
+    # Polled as a client would, from the other worker
+    deadline = time.monotonic() + 5
+    seen = polled.get(job.id, owner=7)
+    while not seen.done and time.monotonic() < deadline:
+        time.sleep(0.01)
+        seen = polled.get(job.id, owner=7)
+    assert (seen.status, seen.filename, seen.key, seen.result) == ("done", "1001.pdf", "abc", None)
+    assert stored["abc"].startswith(b"%PDF")
+    assert polled.get(job.id, owner=8) is None
+    assert polled.get("../" + job.id) is None
+    assert polled.get("unknown") is None
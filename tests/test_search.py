@@ -0,0 +1,41 @@
+'''The product search index is created by the migrations, not by the first search.'''
+
+from flask_migrate import downgrade, upgrade
+from sqlalchemy import event, text
+
+import main
+
+
+def make_app(tmp_path):
+    return main.create_app({"DATABASE_URL": "sqlite:///" + str(tmp_path / "shop.db")})
+
+
+def add_product(name):
+    brand, category = main.Brand(name="Acme"), main.Category(name="Phones")
+    main.db.session.add(main.Product(product_name=name, price=100, stock=1, description="A phone", colors="black",
+                                     brand=brand, category=category))
+    main.db.session.commit()
+
+
+def test_search_reads_the_index_the_migration_built(tmp_path):
+    app = make_app(tmp_path)
+    with app.app_context():
+        upgrade(revision="1e7c3a9f5b20")
+        add_product("Pixel Fold")
+        # Products written before the revision are indexed by its rebuild
+        upgrade()
+        statements = []
+        event.listen(main.db.engine, "before_cursor_execute",
+                     lambda conn, cursor, statement, *args: statements.append(statement))
+        assert [product.product_name for product in main.product_search.search("pix").items] == ["Pixel Fold"]
+        assert not [statement for statement in statements if not statement.lstrip().upper().startswith("SELECT")]
+
+
+def test_search_falls_back_to_like_without_the_index(tmp_path):
+    app = make_app(tmp_path)
+    with app.app_context():
+        upgrade()
+        downgrade(revision="1e7c3a9f5b20")
+        add_product("Pixel Fold")
+        assert not main.db.session.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'products_fts'")).first()
+        assert [product.product_name for product in main.product_search.search("pix").items] == ["Pixel Fold"]
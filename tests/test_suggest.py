@@ -0,0 +1,25 @@
+'''Stale suggestion indexes are rebuilt in the background, not by the lookup that finds them stale.'''
+
+import time
+
+from flask_migrate import upgrade
+import pytest
+
+import main
+
+
+def test_stale_index_is_swapped_in_by_a_background_rebuild(tmp_path):
+    app = main.create_app({"DATABASE_URL": "sqlite:///" + str(tmp_path / "shop.db"), "SUGGEST_REBUILD_SECONDS": 0})
+    with app.app_context():
+        upgrade()
+        assert main.suggestions.lookup("else") == []
+        # As another worker would write it, without this process's session events
+        with main.db.engine.begin() as connection:
+            connection.execute(main.Brand.__table__.insert().values(name="Elsewhere"))
+        suggestions = app.extensions['search_suggestions']
+        # Only the very first lookup may build on the request thread
+        suggestions.build = lambda: pytest.fail("lookup() rebuilt the index inline")
+        deadline = time.monotonic() + 5
+        while not suggestions.lookup("else") and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert [suggestion.label for suggestion in suggestions.lookup("else")] == ["Elsewhere"]
@@ -0,0 +1,121 @@
+'''
+    Order totals
+
+    ------------
+
+    One totals engine for the cart page, the order page and the invoice PDF.
+
+    All arithmetic is done in integer cents. Each line is priced once: gross,
+    discount (rounded half up to the cent) and subtotal. Tax is applied once
+    to the order subtotal with a configurable Decimal rate, rather than being
+    recomputed inside the line loop.
+
+'''
+
+from collections import OrderedDict
+from decimal import Decimal, ROUND_HALF_UP
+import threading
+
+
+def format_cents(cents):
+    '''Formats an amount in cents as a dollar string, e.g. 123456 -> "1234.56".'''
+    sign = "-" if cents < 0 else ""
+    return "%s%d.%02d" % (sign, abs(cents) // 100, abs(cents) % 100)
+
+
+class LineTotal(object):
+    '''The priced amounts of one line, all in cents.'''
+
+    __slots__ = ('product_id', 'quantity', 'unit_price_cents', 'discount_percent',
+                 'gross_cents', 'discount_cents', 'subtotal_cents')
+
+    def __init__(self, product_id, quantity, unit_price_cents, discount_percent,
+                 gross_cents, discount_cents, subtotal_cents):
+        self.product_id = product_id
+        self.quantity = quantity
+        self.unit_price_cents = unit_price_cents
+        self.discount_percent = discount_percent
+        self.gross_cents = gross_cents
+        self.discount_cents = discount_cents
+        self.subtotal_cents = subtotal_cents
+
+
+class OrderTotals(object):
+    '''Per-line and order-level totals, in cents.'''
+
+    __slots__ = ('lines', 'subtotal_cents', 'discount_cents', 'tax_cents', 'grand_total_cents', 'tax_rate')
+
+    def __init__(self, lines, subtotal_cents, discount_cents, tax_cents, tax_rate):
+        self.lines = lines
+        self.subtotal_cents = subtotal_cents
+        self.discount_cents = discount_cents
+        self.tax_cents = tax_cents
+        self.grand_total_cents = subtotal_cents + tax_cents
+        self.tax_rate = tax_rate
+
+    @property
+    def tax(self):
+        return format_cents(self.tax_cents)
+
+    @property
+    def grand_total(self):
+        return format_cents(self.grand_total_cents)
+
+
+def compute_totals(items, tax_rate):
+    '''Prices ``items`` in a single pass.
+
+    :param items: Objects with ``product_id``, ``unit_price_cents``, ``discount``
+                  (percent) and ``quantity``, such as LineItem.
+    :param tax_rate: Tax rate as a Decimal or string, e.g. ``"0.06"``.
+    '''
+    tax_rate = Decimal(tax_rate)
+    lines = []
+    append = lines.append
+    subtotal = 0
+    discount_total = 0
+    for item in items:
+        quantity = int(item.quantity)
+        unit_price = int(item.unit_price_cents)
+        percent = int(item.discount or 0)
+        gross = unit_price * quantity
+        # Integer round-half-up of gross * percent / 100
+        discount = (gross * percent + 50) // 100
+        line_subtotal = gross - discount
+        subtotal += line_subtotal
+        discount_total += discount
+        append(LineTotal(item.product_id, quantity, unit_price, percent, gross, discount, line_subtotal))
+    tax = int((subtotal * tax_rate).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+    return OrderTotals(lines, subtotal, discount_total, tax, tax_rate)
+
+
+class TotalsCache(object):
+    '''LRU cache of OrderTotals per invoice.
+
+    An order's lines never change once it is placed, so the totals only
+    depend on the invoice and the tax rate.
+    '''
+
+    def __init__(self, maxsize=1024, app=None):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['order_totals'] = self
+
+    def get(self, invoice, items, tax_rate):
+        key = (invoice, str(tax_rate))
+        with self._lock:
+            totals = self._entries.get(key)
+            if totals is not None:
+                self._entries.move_to_end(key)
+                return totals
+        totals = compute_totals(items, tax_rate)
+        with self._lock:
+            self._entries[key] = totals
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return totals